@@ -0,0 +1,278 @@
+import argparse
+import asyncio
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal, Optional, TypedDict
+
+from prompt_peel.daemon import LatencyStats, latency_stats
+from prompt_peel.dsl import (
+    MessageBuilder,
+    empty,
+    history,
+    peel,
+    scope,
+    system_message,
+    top_k,
+    user_message,
+)
+from prompt_peel.memo import subtree_memo
+from prompt_peel.message import ChatMessage
+
+"""
+Load test of the render path with realistic synthetic chains at a target rate.
+Run with `python -m benchmarks.bench_load --mode async --qps 200 --concurrency 200 --duration 30`
+
+Every request builds a fresh `Chain` that shares the default `Cl100kBaseTokenCounter`, as a server would.
+Requests arrive on a fixed schedule whether or not earlier ones have finished, and latency is measured from the
+scheduled arrival, so time spent queueing behind slow renders is counted rather than hidden.
+Each interval reports throughput, latency percentiles, resident memory and the size of the subtree memo, to catch
+contention and caches that keep growing.
+"""
+
+Mode = Literal["sync", "thread", "async"]
+
+WORDS = (
+    "the model retrieves context from documents and ranks every chunk by relevance before the prompt is built"
+    " so that tokens are spent on what matters most while history and tools compete for the same budget"
+).split()
+
+
+class IntervalReport(TypedDict):
+    elapsed_s: float
+    requests: int
+    errors: int
+    throughput: float  # Requests finished per second during the interval
+    latency_ms: LatencyStats
+    rss_mb: float
+    memo_entries: int
+
+
+class Recorder:
+    """Collects latencies from any thread and hands them out one interval at a time"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._latencies: list[float] = []
+        self._errors = 0
+        self.all_latencies: list[float] = []
+        self.errors = 0
+
+    def record(self, latency_ms: float, succeeded: bool) -> None:
+        with self._lock:
+            self._latencies.append(latency_ms)
+            self._errors += not succeeded
+
+    def take(self) -> tuple[list[float], int]:
+        with self._lock:
+            latencies, errors = self._latencies, self._errors
+            self._latencies, self._errors = [], 0
+        self.all_latencies += latencies
+        self.errors += errors
+        return latencies, errors
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def build_elements(rng: random.Random) -> list[MessageBuilder]:
+    """A chat history, a retrieval `top_k` and an `Empty` reservation for the completion"""
+    turns: list[ChatMessage] = [
+        {
+            "role": "user" if index % 2 == 0 else "assistant",
+            "content": sentence(rng, rng.randint(5, 80)),
+        }
+        for index in range(rng.randint(2, 30))
+    ]
+    chunks = [
+        scope(sentence(rng, rng.randint(40, 200)) + "\n", priority=rng.randint(0, 999))
+        for _ in range(rng.randint(10, 120))
+    ]
+    return [
+        system_message("You are a helpful assistant. Answer from the context."),
+        history(*turns, priority=5_000),
+        user_message(
+            "Context:\n",
+            top_k(*chunks, top_k_value=20),
+            "Question: " + sentence(rng, 20),
+            priority=10_000,
+        ),
+        empty(rng.choice([256, 512, 1024])),
+    ]
+
+
+def resident_memory() -> float:
+    """Current resident memory in MB, or the peak where the current value cannot be read"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+class LoadTest:
+    def __init__(
+        self,
+        mode: Mode,
+        qps: float,
+        duration: float,
+        concurrency: int,
+        variants: int = 50,
+        token_spaces: tuple[int, ...] = (2_000, 4_000, 8_000),
+        seed: int = 0,
+    ) -> None:
+        rng = random.Random(seed)
+        self.mode = mode
+        self.qps = qps
+        self.duration = duration
+        self.concurrency = concurrency
+        # Requests reuse a pool of chain definitions, like a server seeing the same templates and documents again
+        self.variants = [build_elements(rng) for _ in range(variants)]
+        self.token_spaces = token_spaces
+        self.recorder = Recorder()
+        self._last_report = 0.0
+
+    def request(self, index: int) -> tuple[list[MessageBuilder], int]:
+        return (
+            self.variants[index % len(self.variants)],
+            self.token_spaces[index % len(self.token_spaces)],
+        )
+
+    def run(self, interval: float = 1.0) -> list[IntervalReport]:
+        reports: list[IntervalReport] = []
+        done = threading.Event()
+        started = self._last_report = time.monotonic()
+
+        def report() -> None:
+            while not done.wait(interval):
+                reports.append(self._report(started))
+                print_report(reports[-1])
+
+        reporter = threading.Thread(target=report, daemon=True)
+        reporter.start()
+        try:
+            if self.mode == "sync":
+                self._run_sync(started)
+            elif self.mode == "thread":
+                self._run_threads(started)
+            else:
+                asyncio.run(self._run_async(started))
+        finally:
+            done.set()
+            reporter.join()
+
+        reports.append(self._report(started))
+        print_report(reports[-1])
+        return reports
+
+    def summary(self) -> str:
+        latencies = latency_stats(self.recorder.all_latencies)
+        return (
+            f"{self.mode}: {len(self.recorder.all_latencies)} requests"
+            f" ({self.recorder.errors} errors) at a target of {self.qps:g}/s,"
+            f" p50 {latencies['p50']:.1f} ms, p95 {latencies['p95']:.1f} ms, p99 {latencies['p99']:.1f} ms"
+        )
+
+    def _arrivals(self, started: float) -> list[float]:
+        return [
+            started + index / self.qps for index in range(int(self.qps * self.duration))
+        ]
+
+    def _render(self, index: int, arrival: float) -> None:
+        elements, token_space = self.request(index)
+        try:
+            peel(*elements).render(token_space)
+            succeeded = True
+        except Exception:
+            succeeded = False
+        self.recorder.record((time.monotonic() - arrival) * 1000, succeeded)
+
+    def _run_sync(self, started: float) -> None:
+        for index, arrival in enumerate(self._arrivals(started)):
+            time.sleep(max(arrival - time.monotonic(), 0))
+            self._render(index, arrival)
+
+    def _run_threads(self, started: float) -> None:
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            for index, arrival in enumerate(self._arrivals(started)):
+                time.sleep(max(arrival - time.monotonic(), 0))
+                executor.submit(self._render, index, arrival)
+
+    async def _run_async(self, started: float) -> None:
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def render(index: int, arrival: float) -> None:
+            elements, token_space = self.request(index)
+            async with slots:
+                try:
+                    await peel(*elements).arender(token_space)
+                    succeeded = True
+                except Exception:
+                    succeeded = False
+            self.recorder.record((time.monotonic() - arrival) * 1000, succeeded)
+
+        tasks = []
+        for index, arrival in enumerate(self._arrivals(started)):
+            await asyncio.sleep(max(arrival - time.monotonic(), 0))
+            tasks.append(asyncio.create_task(render(index, arrival)))
+        await asyncio.gather(*tasks)
+
+    def _report(self, started: float) -> IntervalReport:
+        latencies, errors = self.recorder.take()
+        now = time.monotonic()
+        interval, self._last_report = now - self._last_report, now
+        return IntervalReport(
+            elapsed_s=now - started,
+            requests=len(latencies),
+            errors=errors,
+            throughput=len(latencies) / interval if interval else 0.0,
+            latency_ms=latency_stats(latencies),
+            rss_mb=resident_memory(),
+            memo_entries=len(subtree_memo),
+        )
+
+
+def print_report(report: IntervalReport) -> None:
+    latencies = report["latency_ms"]
+    print(
+        f"{report['elapsed_s']:>7.1f}s {report['throughput']:>8.1f} req/s {report['errors']:>4} errors"
+        f" p50 {latencies['p50']:>8.1f} ms p95 {latencies['p95']:>8.1f} ms p99 {latencies['p99']:>8.1f} ms"
+        f" rss {report['rss_mb']:>8.1f} MB memo {report['memo_entries']:>7}"
+    )
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Drive synthetic chains through the render path at a target rate"
+    )
+    parser.add_argument("--mode", choices=["sync", "thread", "async"], default="thread")
+    parser.add_argument(
+        "--qps", type=float, default=50, help="Target requests per second"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10, help="Seconds of arrivals"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=32,
+        help="Threads, or in-flight tasks for async",
+    )
+    parser.add_argument(
+        "--interval", type=float, default=1.0, help="Seconds between reports"
+    )
+    args = parser.parse_args(argv)
+
+    load_test = LoadTest(args.mode, args.qps, args.duration, args.concurrency)
+    load_test.run(args.interval)
+    print(load_test.summary())
+
+
+if __name__ == "__main__":
+    main()
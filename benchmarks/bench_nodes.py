@@ -0,0 +1,68 @@
+import sys
+import time
+import tracemalloc
+from typing import Callable
+
+from prompt_peel.dsl import compact_nodes, peel, scope, top_k, user_message
+from prompt_peel.lib import Chain
+
+"""
+Compare dict nodes with slotted compact nodes on a large retrieval style chain.
+Run with `python -m benchmarks.bench_nodes [chunks]`
+"""
+
+
+def build_chain(chunks: int) -> Chain:
+    return peel(
+        user_message(
+            top_k(
+                *[scope(f"Chunk {i}\n", priority=i) for i in range(chunks)],
+                top_k_value=chunks // 10,
+            ),
+        )
+    )
+
+
+def measure_memory(builder: Callable[[], Chain]) -> tuple[Chain, int]:
+    tracemalloc.start()
+    chain = builder()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return chain, peak
+
+
+def measure_traversal(chain: Chain, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chain.get_priorities()
+        chain._get_empty_tokens(chain.prompt_elements, 0)
+        chain.render_priority(0)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def build_compact_chain(chunks: int) -> Chain:
+    with compact_nodes():
+        return build_chain(chunks)
+
+
+def main(chunks: int) -> None:
+    dict_chain, dict_memory = measure_memory(lambda: build_chain(chunks))
+    compact_chain, compact_memory = measure_memory(lambda: build_compact_chain(chunks))
+
+    dict_time = measure_traversal(dict_chain)
+    compact_time = measure_traversal(compact_chain)
+
+    print(f"{chunks} chunks")
+    print(f"{'':10}{'peak memory':>16}{'traversal':>14}")
+    print(f"{'dict':10}{dict_memory / 2**20:>13.1f} MB{dict_time * 1000:>11.1f} ms")
+    print(
+        f"{'compact':10}{compact_memory / 2**20:>13.1f} MB"
+        f"{compact_time * 1000:>11.1f} ms"
+    )
+    print(f"memory reduction: {1 - compact_memory / dict_memory:.0%}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
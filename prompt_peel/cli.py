@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import islice
+from typing import IO, Any, ContextManager, Iterable, Iterator, Optional
+
+from prompt_peel.dsl import peel
+from prompt_peel.exceptions import InvalidPromptError
+from prompt_peel.lib import contains_type
+from prompt_peel.node import NodeType
+from prompt_peel.serialize import chain_from_json
+
+"""
+`prompt-peel` console script. Renders chain definitions in bulk:
+
+    prompt-peel chains.jsonl --token-space 8000 --workers 8 > rendered.jsonl
+
+Each input line is `{"id": ..., "elements": [...], "token_space": N, "deadline_ms": M}` where `elements` are JSON
+encoded nodes (see `prompt_peel/serialize.py`) and `id`, `token_space` and `deadline_ms` are optional. Each output line is
+`{"id": ..., "messages": [...], "priority": N}` plus the surviving `"tools"` if the chain has any, or `{"id": ..., "error": "..."}` if the chain cannot be rendered.
+Output keeps the input order and is written as results come in.
+"""
+
+
+def render_line(
+    line: str, token_space: int, with_stats: bool = False, allow_files: bool = True
+) -> tuple[str, bool]:
+    """
+    Render one JSONL chain definition. Returns the output line and whether rendering succeeded.
+    With `with_stats`, the output also holds the chain's `last_render_stats` as `"stats"`.
+    Without `allow_files`, chains with file or image nodes fail instead of reading from disk
+    """
+    request_id = None
+    try:
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise ValueError(f"Expected a JSON object, not {request!r}")
+        request_id = request.get("id")
+
+        chain = peel(*chain_from_json(request.get("elements")))
+        if not allow_files and contains_type(
+            chain.prompt_elements, NodeType.FILE, NodeType.IMAGE
+        ):
+            raise InvalidPromptError(
+                "File and image nodes are only read for clients of a Unix socket"
+            )
+        messages = chain.render(
+            request.get("token_space", token_space), request.get("deadline_ms")
+        )
+        result: dict[str, Any] = {
+            "id": request_id,
+            "messages": messages,
+            "priority": chain.last_render_stats["priority"],  # type: ignore
+        }
+        if with_stats:
+            result["stats"] = chain.last_render_stats
+        if tools := chain.render_tools():
+            result["tools"] = tools
+        succeeded = True
+    except Exception as error:
+        # Anything a chain raises, e.g. `OSError` reading a file node, fails its own line rather than the whole run
+        result = {"id": request_id, "error": f"{type(error).__name__}: {error}"}
+        succeeded = False
+
+    return json.dumps(result), succeeded
+
+
+def render_lines(lines: list[str], token_space: int) -> list[tuple[str, bool]]:
+    return [render_line(line, token_space) for line in lines]
+
+
+def render_stream(
+    lines: Iterable[str], token_space: int, workers: int, batch_size: int
+) -> Iterator[tuple[str, bool]]:
+    """
+    Render lines in input order. Batches are spread across `workers` processes, with a bounded number in flight
+    so that memory stays flat however long the input is.
+    """
+    lines = (line for line in lines if line.strip())
+    batches = iter(lambda: list(islice(lines, batch_size)), [])
+
+    if workers <= 1:
+        for batch in batches:
+            yield from render_lines(batch, token_space)
+        return
+
+    with ProcessPoolExecutor(workers) as executor:
+        pending: deque[Future[list[tuple[str, bool]]]] = deque()
+        for batch in batches:
+            pending.append(executor.submit(render_lines, batch, token_space))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+
+        while pending:
+            yield from pending.popleft().result()
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="prompt-peel",
+        description="Render JSONL chain definitions to JSONL chat messages",
+    )
+    parser.add_argument(
+        "input", nargs="?", default="-", help="JSONL file of chains (default: stdin)"
+    )
+    parser.add_argument(
+        "-o", "--output", default="-", help="JSONL file for results (default: stdout)"
+    )
+    parser.add_argument(
+        "--token-space",
+        type=int,
+        default=sys.maxsize,
+        help="Token budget for chains that do not set their own `token_space`",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Worker processes. 1 renders in the main process",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=64, help="Chains handed to a worker at once"
+    )
+    args = parser.parse_args(argv)
+
+    started = time.monotonic()
+    rendered = failed = 0
+    with _open(args.input, "r") as input, _open(args.output, "w") as output:
+        for line, succeeded in render_stream(
+            input, args.token_space, args.workers, args.batch_size
+        ):
+            output.write(line + "\n")
+            rendered += succeeded
+            failed += not succeeded
+
+    elapsed = time.monotonic() - started
+    print(
+        f"Rendered {rendered} chains ({failed} failed) in {elapsed:.2f}s,"
+        f" {(rendered + failed) / elapsed if elapsed else 0:.1f} chains/s"
+        f" with {max(args.workers, 1)} worker(s)",
+        file=sys.stderr,
+    )
+    return 1 if failed else 0
+
+
+def _open(path: str, mode: str) -> ContextManager[IO[str]]:
+    if path == "-":
+        return nullcontext(sys.stdin if mode == "r" else sys.stdout)
+    return open(path, mode, encoding="utf-8")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
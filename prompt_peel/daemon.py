@@ -0,0 +1,393 @@
+import argparse
+import asyncio
+import ipaddress
+import json
+import math
+import os
+import queue
+import socket
+import sys
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import IO, Any, Optional, TypedDict, Union
+
+from prompt_peel import exceptions
+from prompt_peel.cli import render_line
+from prompt_peel.dsl import MessageBuilder, peel, user_message
+from prompt_peel.exceptions import PromptError
+from prompt_peel.lib import RenderStats
+from prompt_peel.message import ChatMessage
+from prompt_peel.serialize import chain_to_json
+from prompt_peel.tool import ToolDefinition
+
+"""
+Long-lived render service. Short-lived jobs pay for loading the tokenizer and for cold caches before their first
+render; the daemon pays once and keeps encoders, token counts and the subtree memo warm across requests.
+
+    prompt-peel-daemon --socket /tmp/prompt-peel.sock --workers 4
+
+The wire format is newline delimited JSON over a Unix socket or localhost TCP. Each request line is a chain
+definition as read by the `prompt-peel` console script, and is answered by one line in order:
+
+    {"id": ..., "elements": [...], "token_space": N, "deadline_ms": M}
+    -> {"id": ..., "messages": [...], "priority": N, "stats": {...}, "tools": [...]} or {"id": ..., "error": "..."}
+
+The line `stats` is answered with the `ServiceStats` of the daemon.
+File and image nodes are read with the daemon's permissions, so they are only accepted on a Unix socket that only
+its own user can connect to. TCP clients are not authenticated: the daemon only listens on loopback addresses and
+answers chains with file or image nodes with an error line.
+`RenderClient(...).chain(*elements)` gives a `RemoteChain` that renders like a `Chain`, but in the daemon.
+"""
+
+MAX_LINE = 64 * 1024 * 1024  # Longest request line accepted, in bytes
+STATS_REQUEST = b"stats"
+
+
+class LatencyStats(TypedDict):
+    p50: float
+    p95: float
+    p99: float
+
+
+class ServiceStats(TypedDict):
+    uptime_s: float
+    requests: int
+    failed: int
+    in_flight: int
+    throughput: float  # Requests per second since the daemon started
+    latency_ms: LatencyStats  # Over the most recent requests, including time spent waiting for a worker
+
+
+def percentile(ordered: list[float], fraction: float) -> float:
+    """Nearest rank percentile of sorted values. 0 when there are none"""
+    if not ordered:
+        return 0.0
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def latency_stats(latencies: list[float]) -> LatencyStats:
+    ordered = sorted(latencies)
+    return LatencyStats(
+        p50=percentile(ordered, 0.5),
+        p95=percentile(ordered, 0.95),
+        p99=percentile(ordered, 0.99),
+    )
+
+
+def warm_up() -> None:
+    """Load the tokenizer in a worker before its first request"""
+    peel(user_message("warm up")).render()
+
+
+class RenderServer:
+    """
+    Serves renders on the Unix socket at `path`, or on `host`:`port` if there is no path (port 0 picks a free one).
+    Requests on one connection are answered in order. Connections are served concurrently and render on a pool
+    of `workers` processes, or on a thread of the daemon's process when `workers` is 1.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        workers: int = os.cpu_count() or 1,
+        token_space: int = sys.maxsize,
+        latency_window: int = 10_000,
+    ) -> None:
+        if path is None and not is_loopback(host):
+            raise ValueError(
+                f"The render daemon reads files for its clients, so it only listens on loopback, not {host}"
+            )
+        self.path = path
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.token_space = token_space
+        self._latencies: deque[float] = deque(maxlen=latency_window)
+        self._requests = 0
+        self._failed = 0
+        self._in_flight = 0
+        self._started = time.monotonic()
+        self._server: Optional[asyncio.Server] = None
+        self._executor: Optional[Executor] = None
+
+    async def start(self) -> None:
+        if self.workers > 1:
+            self._executor = ProcessPoolExecutor(self.workers, initializer=warm_up)
+        else:
+            self._executor = ThreadPoolExecutor(1, initializer=warm_up)
+
+        if self.path is not None:
+            # The socket is created without access for other users, rather than restricted after it is bound
+            umask = os.umask(0o077)
+            try:
+                self._server = await asyncio.start_unix_server(
+                    self._handle, self.path, limit=MAX_LINE
+                )
+            finally:
+                os.umask(umask)
+        else:
+            self._server = await asyncio.start_server(
+                self._handle, self.host, self.port, limit=MAX_LINE
+            )
+        self._started = time.monotonic()
+
+    @property
+    def address(self) -> Union[str, tuple[str, int]]:
+        """The socket path, or the host and port being listened on"""
+        if self.path is not None:
+            return self.path
+        if self._server is None:
+            return self.host, self.port
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return host, port
+
+    async def serve_forever(self) -> None:
+        if self._server is None:
+            await self.start()
+        await self._server.serve_forever()  # type: ignore
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def stats(self) -> ServiceStats:
+        uptime = time.monotonic() - self._started
+        return ServiceStats(
+            uptime_s=uptime,
+            requests=self._requests,
+            failed=self._failed,
+            in_flight=self._in_flight,
+            throughput=self._requests / uptime if uptime else 0.0,
+            latency_ms=latency_stats(list(self._latencies)),
+        )
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while line := await reader.readline():
+                if line.strip() == STATS_REQUEST:
+                    response = json.dumps(self.stats())
+                else:
+                    response = await self._render(line.decode("utf-8", "replace"))
+                writer.write(response.encode("utf-8", "surrogatepass") + b"\n")
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            # The client went away, or sent a line longer than MAX_LINE
+            pass
+        finally:
+            writer.close()
+
+    async def _render(self, line: str) -> str:
+        started = time.monotonic()
+        self._in_flight += 1
+        try:
+            response, succeeded = await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                render_line,
+                line,
+                self.token_space,
+                True,
+                self.path is not None,
+            )
+        except Exception as error:
+            # E.g. a worker process that died. The client gets an error line rather than a closed connection
+            response = json.dumps(
+                {"id": request_id(line), "error": f"{type(error).__name__}: {error}"}
+            )
+            succeeded = False
+        finally:
+            self._in_flight -= 1
+
+        self._requests += 1
+        self._failed += not succeeded
+        self._latencies.append((time.monotonic() - started) * 1000)
+        return response
+
+
+class RenderClient:
+    """
+    Client of a render daemon at a Unix socket `path`, or at `host`:`port`.
+    Connections are pooled, so one client can be shared by any number of threads.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        host: str = "127.0.0.1",
+        port: Optional[int] = None,
+        timeout: Optional[float] = 30.0,
+    ) -> None:
+        if path is None and port is None:
+            raise ValueError("A render daemon is reached by socket path or port")
+        self.path = path
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._idle: queue.SimpleQueue[tuple[socket.socket, IO[bytes]]] = (
+            queue.SimpleQueue()
+        )
+
+    def chain(self, *elements: MessageBuilder) -> "RemoteChain":
+        """Like `peel`, but the chain is rendered by the daemon"""
+        return RemoteChain(list(elements), self)
+
+    def request(self, line: str) -> dict[str, Any]:
+        connection = self._get_connection()
+        sock, reader = connection
+        try:
+            sock.sendall(line.encode("utf-8", "surrogatepass") + b"\n")
+            response = reader.readline()
+        except OSError:
+            sock.close()
+            raise
+        if not response:
+            sock.close()
+            raise ConnectionError("The render daemon closed the connection")
+
+        self._idle.put(connection)
+        return json.loads(response)  # type: ignore
+
+    def stats(self) -> ServiceStats:
+        return self.request(STATS_REQUEST.decode())  # type: ignore
+
+    def close(self) -> None:
+        while not self._idle.empty():
+            sock, _ = self._idle.get_nowait()
+            sock.close()
+
+    def _get_connection(self) -> tuple[socket.socket, IO[bytes]]:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        if self.path is not None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+        else:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, sock.makefile("rb")
+
+
+class RemoteChain:
+    """A chain rendered by a render daemon, with the rendering API of `Chain`. Elements are encoded once"""
+
+    def __init__(self, elements: list[MessageBuilder], client: RenderClient) -> None:
+        self.elements = chain_to_json(elements)
+        self.client = client
+        self.last_render_stats: Optional[RenderStats] = None
+        self._tools: list[ToolDefinition] = []
+
+    def render(
+        self, token_space: int = sys.maxsize, deadline_ms: Optional[float] = None
+    ) -> list[ChatMessage]:
+        request: dict[str, Any] = {
+            "elements": self.elements,
+            "token_space": token_space,
+        }
+        if deadline_ms is not None:
+            request["deadline_ms"] = deadline_ms
+        response = self.client.request(json.dumps(request))
+
+        if "error" in response:
+            raise remote_error(response["error"])
+        self.last_render_stats = response["stats"]
+        self._tools = response.get("tools", [])
+        return response["messages"]  # type: ignore
+
+    def render_tools(self) -> list[ToolDefinition]:
+        """Definitions of the tools that survived the last render"""
+        return self._tools
+
+
+def is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def request_id(line: str) -> Any:
+    """The `id` of a request line, or None if it has none"""
+    try:
+        request = json.loads(line)
+    except ValueError:
+        return None
+    return request.get("id") if isinstance(request, dict) else None
+
+
+def remote_error(message: str) -> PromptError:
+    """Raise errors of the daemon with their original type where it is one of ours"""
+    name, _, _ = message.partition(":")
+    error_type = getattr(exceptions, name, None)
+    if isinstance(error_type, type) and issubclass(error_type, PromptError):
+        return error_type(message)
+    return PromptError(message)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="prompt-peel-daemon",
+        description="Serve chain renders over a Unix socket or localhost",
+    )
+    parser.add_argument("--socket", help="Unix socket path to listen on")
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="Loopback host to listen on without --socket",
+    )
+    parser.add_argument(
+        "--port", type=int, default=8765, help="Port to listen on without --socket"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Worker processes. 1 renders on a thread of the daemon",
+    )
+    parser.add_argument(
+        "--token-space",
+        type=int,
+        default=sys.maxsize,
+        help="Token budget for chains that do not set their own `token_space`",
+    )
+    args = parser.parse_args(argv)
+
+    if args.socket is None and not is_loopback(args.host):
+        parser.error(f"--host must be a loopback address, not {args.host}")
+    server = RenderServer(
+        args.socket, args.host, args.port, args.workers, args.token_space
+    )
+
+    async def serve() -> None:
+        await server.start()
+        print(f"Listening on {server.address}", file=sys.stderr)
+        try:
+            await server.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+import hashlib
+import random
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Optional
+
+from prompt_peel.token_cache import content_hash
+
+"""
+Near-duplicate detection for retrieved text with MinHash signatures over word shingles.
+Signatures are cached by content hash in a bounded table, and candidates are found with locality sensitive hashing so that deduplicating
+thousands of chunks stays near-linear. NumPy is used to compute signatures if it is installed.
+"""
+
+SHINGLE_WORDS = 3
+PERMUTATIONS = 64
+BANDS = 16  # Signatures are split in bands of PERMUTATIONS / BANDS rows. Sharing a band makes a candidate pair
+
+MASK = (1 << 64) - 1
+_random = random.Random(0)
+SEEDS = [
+    (_random.getrandbits(64) | 1, _random.getrandbits(64)) for _ in range(PERMUTATIONS)
+]
+
+WORD = re.compile(r"\w+")
+
+MAX_CACHED_SIGNATURES = 100_000  # Least recently used first out
+_signatures: OrderedDict[bytes, Optional[tuple[int, ...]]] = OrderedDict()
+_signatures_lock = threading.Lock()
+
+
+def shingles(text: str) -> set[int]:
+    """64 bit hashes of the text's overlapping runs of `SHINGLE_WORDS` lowercase words"""
+    words = WORD.findall(text.lower())
+    runs = {
+        " ".join(words[start : start + SHINGLE_WORDS])
+        for start in range(max(len(words) - SHINGLE_WORDS + 1, 1))
+    }
+    return {
+        int.from_bytes(hashlib.blake2b(run.encode(), digest_size=8).digest(), "little")
+        for run in runs
+        if run
+    }
+
+
+def minhash_signature(text: str) -> Optional[tuple[int, ...]]:
+    """MinHash of the text's shingles under `PERMUTATIONS` hash functions. None for text without words"""
+    key = content_hash(text)
+    with _signatures_lock:
+        if key in _signatures:
+            _signatures.move_to_end(key)
+            return _signatures[key]
+
+    signature = _minhash_signature(text)
+    with _signatures_lock:
+        _signatures[key] = signature
+        while len(_signatures) > MAX_CACHED_SIGNATURES:
+            _signatures.popitem(last=False)
+    return signature
+
+
+def _minhash_signature(text: str) -> Optional[tuple[int, ...]]:
+    hashes = shingles(text)
+    if not hashes:
+        return None
+
+    try:
+        import numpy as np
+    except ImportError:
+        return tuple(min((a * x + b) & MASK for x in hashes) for a, b in SEEDS)
+
+    values = np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+    multipliers = np.array([a for a, _ in SEEDS], dtype=np.uint64)[:, None]
+    offsets = np.array([b for _, b in SEEDS], dtype=np.uint64)[:, None]
+    # uint64 arithmetic wraps around, which is the same as masking to 64 bits
+    with np.errstate(over="ignore"):
+        permuted = multipliers * values[None, :] + offsets
+    return tuple(int(value) for value in permuted.min(axis=1))
+
+
+def similarity(first: tuple[int, ...], second: tuple[int, ...]) -> float:
+    """Estimated Jaccard similarity of the shingles behind two signatures"""
+    return sum(a == b for a, b in zip(first, second)) / PERMUTATIONS
+
+
+def distinct(texts: list[str], threshold: float) -> list[int]:
+    """
+    Indices of the texts to keep, dropping any text at least `threshold` similar to an earlier kept one.
+    Pass texts in order of preference, e.g. by descending priority. Texts without words are always kept
+    """
+    rows = PERMUTATIONS // BANDS
+    buckets: dict[tuple[int, tuple[int, ...]], list[int]] = defaultdict(list)
+    signatures: dict[int, tuple[int, ...]] = {}
+    kept = []
+
+    for index, text in enumerate(texts):
+        signature = minhash_signature(text)
+        if signature is None:
+            kept.append(index)
+            continue
+
+        keys = [
+            (band, signature[band * rows : (band + 1) * rows]) for band in range(BANDS)
+        ]
+        candidates = {candidate for key in keys for candidate in buckets[key]}
+        if any(
+            similarity(signature, signatures[candidate]) >= threshold
+            for candidate in candidates
+        ):
+            continue
+
+        kept.append(index)
+        signatures[index] = signature
+        for key in keys:
+            buckets[key].append(index)
+
+    return kept
@@ -1,17 +1,47 @@
+import os
 import sys
+from contextlib import contextmanager
+from contextvars import ContextVar
 from enum import Enum
-from typing import Union
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Iterator,
+    Literal,
+    Optional,
+    Sequence,
+    TypeVar,
+    Union,
+    cast,
+)
 
-from prompt_peel.exceptions import PriorityError
+from prompt_peel.exceptions import InvalidPromptError, PriorityError
+from prompt_peel.image import ImageFormula, openai_image_tokens
+from prompt_peel.json_array import serialize_items
 from prompt_peel.lib import Chain
+from prompt_peel.relevance import select_relevant
+from prompt_peel.message import ChatMessage
 from prompt_peel.node import (
     ChatNode,
+    ChunkedNode,
+    DedupNode,
     EmptyNode,
+    FileNode,
+    HistoryNode,
+    ImageNode,
+    JsonArrayNode,
+    LazyNode,
     MinKNode,
     NodeType,
+    NormalizeNode,
     NonChatNode,
     ScopeNode,
+    TokenCap,
+    ToolNode,
     TopKNode,
+    TruncateNode,
+    to_compact,
 )
 
 """
@@ -19,40 +49,100 @@ DSL for building prompt chains inspired by JSX patterns.
 See README or test for examples on how to construct chains via this DSL.
 """
 
+T = TypeVar("T")
+CappedNodeT = TypeVar("CappedNodeT", ChatNode, ScopeNode)
+
+_compact_nodes: ContextVar[bool] = ContextVar("compact_nodes", default=False)
+
+
+@contextmanager
+def compact_nodes() -> Iterator[None]:
+    """
+    Nodes built inside this context are slotted `CompactNode` objects rather than dicts.
+    Use it for very large chains (e.g. hundreds of thousands of retrieved chunks) to cut memory use.
+    """
+    token = _compact_nodes.set(True)
+    try:
+        yield
+    finally:
+        _compact_nodes.reset(token)
+
+
+def _build(node: T) -> T:
+    if _compact_nodes.get():
+        return cast(T, to_compact(cast(dict[str, Any], node)))
+    return node
+
 
-def system_message(*children: NonChatNode, priority: int = sys.maxsize) -> ChatNode:
-    return {
-        "type": NodeType.CHAT,
-        "role": "system",
-        "priority": priority,
-        "children": with_validated_priority(priority, children),
-    }
+def system_message(
+    *children: NonChatNode,
+    priority: int = sys.maxsize,
+    cap: Optional[TokenCap] = None,
+) -> ChatNode:
+    return _build(
+        with_validated_cap(
+            ChatNode(
+                type=NodeType.CHAT,
+                role="system",
+                priority=priority,
+                children=with_validated_priority(priority, children),
+            ),
+            cap,
+        )
+    )
 
 
-def user_message(*children: NonChatNode, priority: int = sys.maxsize) -> ChatNode:
-    return {
-        "type": NodeType.CHAT,
-        "role": "user",
-        "priority": priority,
-        "children": with_validated_priority(priority, children),
-    }
+def user_message(
+    *children: NonChatNode,
+    priority: int = sys.maxsize,
+    cap: Optional[TokenCap] = None,
+) -> ChatNode:
+    return _build(
+        with_validated_cap(
+            ChatNode(
+                type=NodeType.CHAT,
+                role="user",
+                priority=priority,
+                children=with_validated_priority(priority, children),
+            ),
+            cap,
+        )
+    )
 
 
-def assistant_message(*children: NonChatNode, priority: int = sys.maxsize) -> ChatNode:
-    return {
-        "type": NodeType.CHAT,
-        "role": "assistant",
-        "priority": priority,
-        "children": with_validated_priority(priority, children),
-    }
+def assistant_message(
+    *children: NonChatNode,
+    priority: int = sys.maxsize,
+    cap: Optional[TokenCap] = None,
+) -> ChatNode:
+    return _build(
+        with_validated_cap(
+            ChatNode(
+                type=NodeType.CHAT,
+                role="assistant",
+                priority=priority,
+                children=with_validated_priority(priority, children),
+            ),
+            cap,
+        )
+    )
 
 
-def scope(*children: NonChatNode, priority: int = sys.maxsize) -> ScopeNode:
-    return {
-        "type": NodeType.SCOPE,
-        "priority": priority,
-        "children": with_validated_priority(priority, children),
-    }
+def scope(
+    *children: NonChatNode,
+    priority: int = sys.maxsize,
+    cap: Optional[TokenCap] = None,
+) -> ScopeNode:
+    return _build(
+        with_validated_cap(
+            ScopeNode(
+                type=NodeType.SCOPE,
+                priority=priority,
+                children=with_validated_priority(priority, children),
+            ),
+            cap,
+        )
+    )
 
 
 def top_k(
@@ -62,12 +152,43 @@ def top_k(
     Ensure there are a MAXIMUM of `top_k_value` children in the output
     Children will be sorted based on their priority
     """
-    return {
-        "type": NodeType.TOP_K,
-        "priority": priority,
-        "top_k": top_k_value,
-        "children": with_validated_priority(priority, children),
-    }
+    return _build(
+        TopKNode(
+            type=NodeType.TOP_K,
+            priority=priority,
+            top_k=top_k_value,
+            children=with_validated_priority(priority, children),
+        )
+    )
+
+
+def top_k_relevant(
+    query: Any,
+    embeddings: Any,
+    texts: Sequence[str],
+    top_k_value: int,
+    priority: int = sys.maxsize,
+) -> TopKNode:
+    """
+    `top_k` over retrieved chunks ranked by relevance to a query. Requires NumPy
+    `embeddings` is a matrix with one row per chunk of `texts`. Every chunk is scored against the `query` vector
+    at once and nodes are only built for the `top_k_value` most relevant, so candidates can number in the 100ks
+    The most relevant chunk has `priority` and each next one less, so peeling drops the least relevant first
+    """
+    if len(embeddings) != len(texts):
+        raise InvalidPromptError(
+            f"Got {len(embeddings)} embeddings for {len(texts)} chunks of text"
+        )
+
+    indices, _ = select_relevant(query, embeddings, top_k_value)
+    return top_k(
+        *[
+            scope(texts[index], priority=priority - rank)
+            for rank, index in enumerate(indices.tolist())
+        ],
+        top_k_value=top_k_value,
+        priority=priority,
+    )
 
 
 def min_k(
@@ -77,37 +198,272 @@ def min_k(
     Ensure there are a MINIMUM of `min_k_value` children in the output
     Children will be sorted based on their priority
     """
-    return {
-        "type": NodeType.MIN_K,
-        "priority": priority,
-        "min_k": min_k_value,
-        "children": with_validated_priority(priority, children),
-    }
+    return _build(
+        MinKNode(
+            type=NodeType.MIN_K,
+            priority=priority,
+            min_k=min_k_value,
+            children=with_validated_priority(priority, children),
+        )
+    )
+
+
+def dedup(
+    *children: NonChatNode, threshold: float = 0.8, priority: int = sys.maxsize
+) -> DedupNode:
+    """
+    Drop children whose text is at least `threshold` similar (estimated Jaccard similarity of word shingles)
+    to a higher priority child. The remaining children keep their order
+    """
+    if not 0 < threshold <= 1:
+        raise InvalidPromptError(f"Dedup threshold must be in (0, 1], not {threshold}")
+
+    return _build(
+        DedupNode(
+            type=NodeType.DEDUP,
+            priority=priority,
+            threshold=threshold,
+            children=with_validated_priority(priority, children),
+        )
+    )
+
+
+def normalize(*children: NonChatNode, priority: int = sys.maxsize) -> NormalizeNode:
+    """
+    Opt in to collapsing token wasting whitespace in the children's text: trailing spaces, runs of blank lines
+    and spaces, common indentation and markdown table padding. Fenced code blocks are left untouched
+    Tokens saved are reported in `Chain.last_render_stats`
+    """
+    return _build(
+        NormalizeNode(
+            type=NodeType.NORMALIZE,
+            priority=priority,
+            children=with_validated_priority(priority, children),
+        )
+    )
 
 
 def empty(tokens: int, priority: int = sys.maxsize) -> EmptyNode:
-    return {
-        "type": NodeType.EMPTY,
-        "priority": priority,
-        "tokens": tokens,
-    }
+    return _build(
+        EmptyNode(
+            type=NodeType.EMPTY,
+            priority=priority,
+            tokens=tokens,
+        )
+    )
 
 
-MessageBuilder = Union[ChatNode, EmptyNode]
+def truncate(
+    text: str,
+    priority: int = sys.maxsize,
+    keep: Literal["head", "tail"] = "head",
+) -> TruncateNode:
+    """
+    Text that is cut on token boundaries to fill whatever space is left once the optimal priority is chosen
+    `keep` decides whether the start ("head") or the end ("tail") of the text is kept
+    """
+    if keep not in ("head", "tail"):
+        raise InvalidPromptError(f"Truncate must keep 'head' or 'tail', not '{keep}'")
+
+    return _build(
+        TruncateNode(
+            type=NodeType.TRUNCATE,
+            priority=priority,
+            text=text,
+            keep=keep,
+        )
+    )
+
+
+def lazy(
+    provider: Callable[[], Union[str, Awaitable[str]]],
+    tokens: int,
+    priority: int = sys.maxsize,
+) -> LazyNode:
+    """
+    Text that is expensive to produce. `provider` is only called if the node survives peeling
+    Until then, the node reserves its estimated `tokens` like an `Empty` node
+    Async providers (retrieval calls, cache lookups, ...) require `Chain.arender`
+    """
+    return _build(
+        LazyNode(
+            type=NodeType.LAZY,
+            priority=priority,
+            provider=provider,
+            tokens=tokens,
+        )
+    )
+
+
+def file(
+    path: Union[str, os.PathLike[str]],
+    start: int = 0,
+    end: Optional[int] = None,
+    encoding: str = "utf-8",
+    priority: int = sys.maxsize,
+) -> FileNode:
+    """
+    Text from a file, or from its byte range `start:end`. The file is only read if the node survives peeling
+    Until then, the node reserves its token count, which is cached on disk next to the file
+    """
+    return _build(
+        FileNode(
+            type=NodeType.FILE,
+            priority=priority,
+            path=os.fspath(path),
+            start=start,
+            end=end,
+            encoding=encoding,
+        )
+    )
+
+
+def image(
+    source: Union[str, os.PathLike[str], bytes],
+    formula: ImageFormula = openai_image_tokens,
+    priority: int = sys.maxsize,
+) -> ImageNode:
+    """
+    An image from a file path or buffer. Its dimensions are read from the header and `formula` turns them into
+    the tokens it costs (see `prompt_peel/image.py` for provider formulas)
+    The full image is only loaded if the node survives peeling. Images are sent by `Chain.render_payload`
+    """
+    return _build(
+        ImageNode(
+            type=NodeType.IMAGE,
+            priority=priority,
+            source=source if isinstance(source, bytes) else os.fspath(source),
+            formula=formula,
+        )
+    )
+
+
+def json_array(
+    items: Sequence[Any],
+    priorities: Optional[Sequence[int]] = None,
+    indent: Optional[int] = None,
+    priority: int = sys.maxsize,
+) -> JsonArrayNode:
+    """
+    A list of records (search results, rows, log entries) rendered as a JSON array that is peeled element by element.
+    `priorities` has one priority per item; by default items take the priority of the node. Items are serialized
+    once here, their token counts are added up during peeling, and what is rendered is always valid JSON.
+    """
+    if priorities is None:
+        priorities = [priority] * len(items)
+    if len(priorities) != len(items):
+        raise InvalidPromptError(
+            f"JSON arrays need one priority per item, got {len(priorities)} for {len(items)} items"
+        )
+    if any(
+        item_priority != sys.maxsize and item_priority > priority
+        for item_priority in priorities
+    ):
+        raise PriorityError("Children cannot have higher priority than parent")
+
+    try:
+        elements = serialize_items(list(items), indent)
+    except (TypeError, ValueError) as error:
+        raise InvalidPromptError(f"JSON array items must be JSON serializable: {error}")
+
+    return _build(
+        JsonArrayNode(
+            type=NodeType.JSON_ARRAY,
+            priority=priority,
+            elements=elements,
+            priorities=list(priorities),
+            indent=indent,
+        )
+    )
+
+
+def chunked(
+    text: str,
+    chunk_tokens: int,
+    overlap: int = 0,
+    priority_fn: Optional[Callable[[int, int], int]] = None,
+    top_k_value: Optional[int] = None,
+    priority: int = sys.maxsize,
+) -> ChunkedNode:
+    """
+    A long document cut into chunks of `chunk_tokens` tokens, consecutive chunks sharing `overlap` tokens
+    The text is tokenized once per chain and chunks are only decoded if they survive peeling
+    `priority_fn(index, chunk_count)` gives each chunk its priority. By default chunks inherit this node's priority
+    With `top_k_value`, at most that many chunks are kept, as with `top_k`
+    """
+    if chunk_tokens <= 0:
+        raise InvalidPromptError(
+            f"Chunks must hold at least one token, not {chunk_tokens}"
+        )
+    if not 0 <= overlap < chunk_tokens:
+        raise InvalidPromptError(
+            f"Chunk overlap must be between 0 and {chunk_tokens - 1} tokens, not {overlap}"
+        )
+
+    return _build(
+        ChunkedNode(
+            type=NodeType.CHUNKED,
+            priority=priority,
+            text=text,
+            chunk_tokens=chunk_tokens,
+            overlap=overlap,
+            priority_fn=priority_fn,
+            top_k=top_k_value,
+        )
+    )
+
+
+def history(*turns: ChatMessage, priority: int = sys.maxsize) -> HistoryNode:
+    """
+    A conversation history of role/content turns, oldest first
+    The newest turn has `priority` and each older turn one less, so peeling drops whole turns from the start
+    Turns are counted once per chain and messages are never emitted empty
+    """
+    return _build(
+        HistoryNode(
+            type=NodeType.HISTORY,
+            priority=priority,
+            turns=list(turns),
+        )
+    )
+
+
+def tool(
+    name: str,
+    description: str,
+    parameters: dict[str, Any],
+    priority: int = sys.maxsize,
+) -> ToolNode:
+    """
+    A top level tool (function calling) definition with a JSON schema of its `parameters`
+    The schema's token cost counts against the budget, so low priority tools are peeled like any other node
+    """
+    return _build(
+        ToolNode(
+            type=NodeType.TOOL,
+            priority=priority,
+            name=name,
+            description=description,
+            parameters=parameters,
+        )
+    )
+
+
+MessageBuilder = Union[ChatNode, EmptyNode, HistoryNode, ToolNode]
 
 
 def with_validated_priority(
     parent_priority: int, children: tuple[NonChatNode, ...]
 ) -> list[NonChatNode]:
     # It is a strange pattern to have children with higher priorities than the parent
-    # If the child has a default priority, we will set it to the priority of the parent
-    for child in children:
-        if not isinstance(child, str) and child["priority"] == sys.maxsize:
-            child["priority"] = parent_priority
+    # If the child has a default priority, it takes on the priority of its parent when the chain is rendered.
+    # Children are never modified, so one subtree can be shared between parents with different priorities.
 
     # If the child has a hardcoded priority, throw an exception
     if any(
-        not isinstance(child, str) and child["priority"] > parent_priority
+        not isinstance(child, str)
+        and child["priority"] != sys.maxsize
+        and child["priority"] > parent_priority
         for child in children
     ):
         raise PriorityError("Children cannot have higher priority than parent")
@@ -116,6 +472,25 @@ def with_validated_priority(
     return list(children)
 
 
+def with_validated_cap(node: CappedNodeT, cap: Optional[TokenCap]) -> CappedNodeT:
+    """
+    Cap the tokens of a message or scope. An int is a number of tokens and a float in (0, 1] a share of the
+    token space. Lower priority children are dropped until the content fits, along with the overall token space
+    """
+    if cap is None:
+        return node
+    if isinstance(cap, bool) or not isinstance(cap, (int, float)):
+        raise InvalidPromptError(f"Token caps must be an int or a float, not {cap!r}")
+    if isinstance(cap, int) and cap < 0:
+        raise InvalidPromptError(f"Token caps cannot be negative, got {cap}")
+    if isinstance(cap, float) and not 0 < cap <= 1:
+        raise InvalidPromptError(
+            f"Token caps given as a share of the token space must be in (0, 1], got {cap}"
+        )
+    node["cap"] = cap
+    return node
+
+
 def peel(*prompt_element_builder: MessageBuilder) -> Chain:
     return Chain(list(prompt_element_builder))
 
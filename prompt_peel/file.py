@@ -0,0 +1,72 @@
+import json
+import mmap
+import os
+from typing import Any
+
+from prompt_peel.node import FileNode
+from prompt_peel.token_counter import TokenCounter
+
+"""
+Helpers for file backed text leaves.
+Files are memory mapped so only the requested byte range is paged in, and token counts are cached in a sidecar
+next to the file so they survive between processes.
+"""
+
+SIDECAR_SUFFIX = ".peel-tokens.json"
+
+
+def read_file(node: FileNode) -> str:
+    with open(node["path"], "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return ""  # Empty files cannot be memory mapped
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return mapped[node["start"] : node["end"]].decode(
+                node["encoding"], errors="replace"
+            )
+
+
+def count_file_tokens(node: FileNode, token_counter: TokenCounter) -> int:
+    """Count the tokens of a file node. Counts are reused until the file's size or modification time changes"""
+    stat = os.stat(node["path"])
+    sidecar = node["path"] + SIDECAR_SUFFIX
+    key = f"{token_counter.name}:{node['encoding']}:{node['start']}:{node['end']}"
+
+    entries = _read_sidecar(sidecar)
+    entry = entries.get(key)
+    if (
+        entry is not None
+        and entry["mtime_ns"] == stat.st_mtime_ns
+        and entry["size"] == stat.st_size
+    ):
+        return int(entry["tokens"])
+
+    tokens = token_counter.count_batch([read_file(node)])[0]
+    entries[key] = {
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "tokens": tokens,
+    }
+    _write_sidecar(sidecar, entries)
+    return tokens
+
+
+def _read_sidecar(sidecar: str) -> dict[str, Any]:
+    try:
+        with open(sidecar) as file:
+            entries = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return entries if isinstance(entries, dict) else {}
+
+
+def _write_sidecar(sidecar: str, entries: dict[str, Any]) -> None:
+    # Write then rename so concurrent readers never see a partial file. The cache is best effort,
+    # e.g. the directory may be read only
+    temporary = f"{sidecar}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, "w") as file:
+            json.dump(entries, file)
+        os.replace(temporary, sidecar)
+    except OSError:
+        pass
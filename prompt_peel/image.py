@@ -0,0 +1,133 @@
+import io
+import math
+import os
+import struct
+from typing import IO, Callable, Literal, TypedDict, Union
+
+from prompt_peel.exceptions import InvalidPromptError
+
+"""
+Helpers for image leaves.
+Dimensions are parsed from the first bytes of PNG, JPEG, GIF and WebP files so that the token cost of an image is
+known without decoding it, or even reading it in full.
+"""
+
+ImageFormat = Literal["png", "jpeg", "gif", "webp"]
+ImageFormula = Callable[[int, int], int]  # (width, height) -> tokens
+
+
+class RenderedImage(TypedDict):
+    media_type: str
+    data: bytes
+
+
+def openai_image_tokens(width: int, height: int) -> int:
+    """High detail: fit within 2048x2048, scale the short side down to 768, then 170 tokens per 512px tile plus 85"""
+    scale = min(1.0, 2048 / max(width, height))
+    scale *= min(1.0, 768 / (min(width, height) * scale))
+    tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return 170 * tiles + 85
+
+
+def openai_low_detail_image_tokens(width: int, height: int) -> int:
+    return 85
+
+
+def anthropic_image_tokens(width: int, height: int) -> int:
+    """Images are scaled to fit a 1568px long edge and cost about one token per 750 pixels"""
+    scale = min(1.0, 1568 / max(width, height))
+    return math.ceil(width * scale * height * scale / 750)
+
+
+IMAGE_FORMULAS: dict[str, ImageFormula] = {
+    "openai": openai_image_tokens,
+    "openai_low": openai_low_detail_image_tokens,
+    "anthropic": anthropic_image_tokens,
+}
+
+MEDIA_TYPES: dict[ImageFormat, str] = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "gif": "image/gif",
+    "webp": "image/webp",
+}
+
+# JPEG start of frame markers hold the dimensions. C4, C8 and CC share the range but are other segments
+JPEG_START_OF_FRAME = {0xC0 + n for n in range(16)} - {0xC4, 0xC8, 0xCC}
+
+
+def image_size(source: Union[str, bytes]) -> tuple[ImageFormat, int, int]:
+    """Format, width and height of an image file (path) or buffer (bytes), read from its header"""
+    if isinstance(source, bytes):
+        return _read_size(io.BytesIO(source))
+    with open(source, "rb") as file:
+        return _read_size(file)
+
+
+def load_image(source: Union[str, bytes]) -> RenderedImage:
+    data = source if isinstance(source, bytes) else _read(source)
+    image_format, _, _ = image_size(data)
+    return RenderedImage(media_type=MEDIA_TYPES[image_format], data=data)
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def _read_size(file: IO[bytes]) -> tuple[ImageFormat, int, int]:
+    header = file.read(30)
+
+    if header.startswith(b"\x89PNG\r\n\x1a\n") and header[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", header[16:24])
+        return "png", width, height
+
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        width, height = struct.unpack("<HH", header[6:10])
+        return "gif", width, height
+
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        chunk = header[12:16]
+        if chunk == b"VP8 ":
+            width, height = struct.unpack("<HH", header[26:30])
+            return "webp", width & 0x3FFF, height & 0x3FFF
+        if chunk == b"VP8L":
+            bits = int.from_bytes(header[21:25], "little")
+            return "webp", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X":
+            width = int.from_bytes(header[24:27], "little") + 1
+            height = int.from_bytes(header[27:30], "little") + 1
+            return "webp", width, height
+
+    if header[:2] == b"\xff\xd8":
+        return _read_jpeg_size(file)
+
+    raise InvalidPromptError(
+        "Images must be PNG, JPEG, GIF or WebP with a readable header"
+    )
+
+
+def _read_jpeg_size(file: IO[bytes]) -> tuple[ImageFormat, int, int]:
+    # Walk the segments after the start of image marker, skipping their data, until a start of frame
+    file.seek(2)
+    while True:
+        marker = file.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            break
+        if marker[1] == 0xFF:  # Fill byte before the real marker
+            file.seek(-1, os.SEEK_CUR)
+            continue
+
+        length_bytes = file.read(2)
+        if len(length_bytes) < 2:
+            break
+        (length,) = struct.unpack(">H", length_bytes)
+        if marker[1] in JPEG_START_OF_FRAME:
+            frame = file.read(5)
+            if len(frame) < 5:
+                break
+            height, width = struct.unpack(">HH", frame[1:5])
+            return "jpeg", width, height
+        file.seek(length - 2, os.SEEK_CUR)
+
+    raise InvalidPromptError("JPEG image has no readable dimensions")
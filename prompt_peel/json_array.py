@@ -0,0 +1,37 @@
+import json
+import textwrap
+from typing import Any, Optional
+
+"""
+JSON arrays for `JsonArray` nodes.
+Each element is serialized once, and kept elements are joined with the delimiters of the array's layout, so any
+subset of them is a valid JSON array. Joining every element gives the same text as `json.dumps` of the list.
+"""
+
+
+def serialize_items(items: list[Any], indent: Optional[int]) -> list[str]:
+    if indent is None:
+        return [
+            json.dumps(item, ensure_ascii=False, separators=(",", ":"))
+            for item in items
+        ]
+    return [
+        textwrap.indent(
+            json.dumps(item, ensure_ascii=False, indent=indent), " " * indent
+        )
+        for item in items
+    ]
+
+
+def delimiters(indent: Optional[int]) -> tuple[str, str, str]:
+    """Opening bracket, separator and closing bracket of a non-empty array"""
+    if indent is None:
+        return "[", ",", "]"
+    return "[\n", ",\n", "\n]"
+
+
+def join_elements(elements: list[str], indent: Optional[int]) -> str:
+    if not elements:
+        return "[]"
+    opening, separator, closing = delimiters(indent)
+    return opening + separator.join(elements) + closing
@@ -1,16 +1,58 @@
+import asyncio
 import sys
 import textwrap
-from functools import reduce
-from typing import List, Set, Union
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from functools import partial, reduce
+from itertools import accumulate
+from operator import neg
+from typing import Awaitable, Optional, Set, TypedDict, Union
 
+from prompt_peel.dedup import distinct
 from prompt_peel.exceptions import (
     InsufficientChildrenError,
+    InvalidPromptError,
     PriorityError,
+    PromptError,
     UnknownNodeError,
 )
+from prompt_peel.file import count_file_tokens, read_file
+from prompt_peel.normalize import count_saved_tokens, normalize_text
+from prompt_peel.image import RenderedImage, image_size, load_image
+from prompt_peel.json_array import delimiters, join_elements
+from prompt_peel.memo import (
+    HASHED_FIELDS,
+    MEMOIZED_TYPES,
+    MemoKey,
+    node_hash,
+    subtree_memo,
+    text_hash,
+)
 from prompt_peel.message import ChatMessage
-from prompt_peel.node import ChatNode, EmptyNode, Node, NodeType, NonChatNode, is_type
+from prompt_peel.node import (
+    ChatNode,
+    ChunkedNode,
+    DedupNode,
+    EmptyNode,
+    FileNode,
+    HistoryNode,
+    ImageNode,
+    JsonArrayNode,
+    LazyNode,
+    MinKNode,
+    Node,
+    NodeType,
+    NonChatNode,
+    ScopeNode,
+    ToolNode,
+    TopKNode,
+    TruncateNode,
+    is_type,
+)
+from prompt_peel.payload import PayloadFormat, encode_payload
 from prompt_peel.token_counter import Cl100kBaseTokenCounter, TokenCounter
+from prompt_peel.tool import ToolDefinition, count_tool_tokens, tool_definition
 
 """
 The core logic of the library.
@@ -19,16 +61,35 @@ Note we use `# type: ignore` to ignore attribute type errors for TypedDicts. In
 """
 
 
+class RenderStats(TypedDict):
+    priority: int  # The priority cutoff that was rendered
+    evaluated: (
+        int  # Number of candidate priorities rendered and counted during the search
+    )
+    elapsed_ms: float
+    degraded: bool  # True if the deadline cut the search short and a sub-optimal priority was used
+    tokens_saved: int  # Tokens removed from the rendered prompt by `Normalize` nodes
+
+
+class MinKConstraint(TypedDict):
+    priority: int  # Effective priority of the `MinK` node
+    min_k: int
+    children: int
+    max_priority: Optional[
+        int
+    ]  # Highest cutoff that keeps `min_k` children. None if there are too few children
+
+
 class Chain:
     def __init__(
         self,
-        prompt_elements: list[Union[ChatNode, EmptyNode]],
+        prompt_elements: list[Union[ChatNode, EmptyNode, HistoryNode, ToolNode]],
         token_counter: TokenCounter = Cl100kBaseTokenCounter(),
     ):
-        self.prompt_elements: list[ChatNode] = [
+        self.prompt_elements: list[Union[ChatNode, HistoryNode, ToolNode]] = [
             element  # type: ignore
             for element in prompt_elements
-            if is_type(element, NodeType.CHAT)
+            if is_type(element, NodeType.CHAT, NodeType.HISTORY, NodeType.TOOL)
         ]
         self.empty_parent_elements: list[EmptyNode] = [
             element  # type: ignore
@@ -36,18 +97,156 @@ class Chain:
             if is_type(element, NodeType.EMPTY)
         ]
         self.token_counter = token_counter
+        if not token_counter.can_tokenize and contains_type(
+            self.prompt_elements, NodeType.TRUNCATE, NodeType.CHUNKED
+        ):
+            raise InvalidPromptError(
+                f"{type(token_counter).__name__} cannot tokenize text, which truncate and chunked nodes need"
+            )
+        self._truncate_tokens: dict[int, list[int]] = {}
+        self._lazy_content: dict[int, str] = {}
+        self._file_tokens: dict[int, int] = {}
+        self._chunks: dict[int, Union[ScopeNode, TopKNode]] = {}
+        self._chunk_ids: set[int] = set()
+        self._deduplicated: dict[int, ScopeNode] = {}
+        self._history_tokens: dict[int, list[int]] = {}
+        self._image_tokens: dict[int, int] = {}
+        self._tool_tokens: dict[int, int] = {}
+        self._json_array_tokens: dict[int, tuple[list[int], int, int, int]] = {}
+        self._subtree_hashes: dict[int, Optional[bytes]] = {}
+        self._capped_nodes: Optional[list[tuple[Union[ChatNode, ScopeNode], int]]] = (
+            None
+        )
+        self._cap_floors: dict[tuple[int, int], int] = {}
+        self._cap_floor_sets: dict[
+            tuple[int, int, frozenset[int]], dict[tuple[int, int], int]
+        ] = {}
+        self._lazy_dropped: set[int] = set()
+        self.last_render_stats: Optional[RenderStats] = None
+        self._token_curve: Optional[tuple[list[int], list[int]]] = None
+        self._min_k_constraints: Optional[list[MinKConstraint]] = None
+
+    def render(
+        self, token_space: int = sys.maxsize, deadline_ms: Optional[float] = None
+    ) -> list[ChatMessage]:
+        """
+        Render the chain with as much context as fits in `token_space`.
+        With `deadline_ms`, the search is bounded in time. If the deadline hits, the best fitting render found
+        so far is returned and `last_render_stats["degraded"]` is set.
+        """
+        started = time.monotonic()
+        deadline = None if deadline_ms is None else started + deadline_ms / 1000
+        stats = self._new_stats()
+        self._reset_dropped()
+        self._set_cap_floors(token_space)
 
-    def render(self, token_space: int = sys.maxsize) -> list[ChatMessage]:
         # 1. Iterate through all prompt elements and build a sorted list of priorities.
         #    These become the candidate priorities that we can binary search through.
         priorities = self.get_priorities()
 
         # 2. Search through the list of priorities and find the smallest priority that satisfies constraint
         #    We are assuming all context is useful and we want to stuff as much context as possible
-        optimal_priority = self.get_optimal_priority(priorities, token_space)
+        #    Lazy nodes are estimated until they survive a cutoff. Once resolved, search again with their real content
+        optimal_priority = self.get_optimal_priority(
+            priorities, token_space, deadline, stats
+        )
+        while self._resolve_lazy(optimal_priority):
+            self._set_cap_floors(token_space)
+            optimal_priority = self.get_optimal_priority(
+                priorities, token_space, deadline, stats
+            )
+
+        # 3. Hand whatever space is left over to the truncate nodes that survived the cutoff
+        allocations = self._allocate_truncated(optimal_priority, token_space)
+
+        # 4. Return materialized prompt chain with the optimal priority in a format the OpenAI API understands
+        stats["tokens_saved"] = self._get_tokens_saved(optimal_priority, allocations)
+        self.last_render_stats = self._finish_stats(stats, optimal_priority, started)
+        return self.render_priority(optimal_priority, allocations)
+
+    async def arender(
+        self, token_space: int = sys.maxsize, deadline_ms: Optional[float] = None
+    ) -> list[ChatMessage]:
+        """
+        Same as `render`, but lazy nodes may have async providers.
+        Providers of nodes that can still make it into the prompt are awaited concurrently.
+        Any provider that misses `deadline_ms` is cancelled and its node is dropped from this render.
+        The same deadline bounds the priority search, as in `render`.
+        """
+        started = time.monotonic()
+        deadline = None if deadline_ms is None else started + deadline_ms / 1000
+        stats = self._new_stats()
+        self._reset_dropped()
+        self._set_cap_floors(token_space)
+
+        priorities = self.get_priorities()
+        optimal_priority = self.get_optimal_priority(
+            priorities, token_space, deadline, stats
+        )
+        while lazy_nodes := self._get_unresolved_lazy(optimal_priority):
+            await self._aresolve_lazy(lazy_nodes, deadline)
+            self._set_cap_floors(token_space)
+            optimal_priority = self.get_optimal_priority(
+                priorities, token_space, deadline, stats
+            )
+
+        allocations = self._allocate_truncated(optimal_priority, token_space)
+        stats["tokens_saved"] = self._get_tokens_saved(optimal_priority, allocations)
+        self.last_render_stats = self._finish_stats(stats, optimal_priority, started)
+        return self.render_priority(optimal_priority, allocations)
+
+    def render_payload(
+        self,
+        token_space: int = sys.maxsize,
+        format: PayloadFormat = "openai",
+        deadline_ms: Optional[float] = None,
+    ) -> bytes:
+        """
+        Convenience wrapper that renders the chain and encodes the JSON request body of a chat completion API
+        (`openai` or `anthropic`) from the rendered messages, tools and images, as compact UTF-8.
+        """
+        messages = self.render(token_space, deadline_ms)
+        return encode_payload(
+            messages, format, self.render_tools(), self.render_images()
+        )
+
+    def render_tools(self, priority: Optional[int] = None) -> list[ToolDefinition]:
+        """Definitions of the tools that survive `priority`, by default the cutoff of the last render"""
+        return [
+            tool_definition(node)  # type: ignore
+            for node, _ in self._get_nodes(
+                self.prompt_elements,
+                self._get_rendered_priority(priority),
+                NodeType.TOOL,
+            )
+        ]
+
+    def render_images(
+        self, priority: Optional[int] = None
+    ) -> dict[int, list[RenderedImage]]:
+        """
+        Load the images that survive `priority`, by default the cutoff of the last render.
+        Returns them by the index of their message in the rendered prompt
+        """
+        priority = self._get_rendered_priority(priority)
+        images: dict[int, list[RenderedImage]] = {}
+        index = 0
+        for element in self.prompt_elements:
+            if is_type(element, NodeType.HISTORY):
+                index += self._get_history_length(element, priority)  # type: ignore
+            elif is_type(element, NodeType.CHAT):
+                nodes = self._get_nodes(element, priority, NodeType.IMAGE)
+                if nodes:
+                    images[index] = [load_image(node["source"]) for node, _ in nodes]  # type: ignore
+                index += 1
+        return images
 
-        # 3. Return materialized prompt chain with the optimal priority in a format the OpenAI API understands
-        return self.render_priority(optimal_priority)
+    def _get_rendered_priority(self, priority: Optional[int]) -> int:
+        if priority is not None:
+            return priority
+        if self.last_render_stats is not None:
+            return self.last_render_stats["priority"]
+        return -sys.maxsize - 1
 
     def get_priorities(self) -> Set[int]:
         return reduce(
@@ -56,124 +255,605 @@ class Chain:
             set(),
         )
 
-    def get_optimal_priority(self, priorities: Set[int], token_space: int) -> int:
+    def get_optimal_priority(
+        self,
+        priorities: Set[int],
+        token_space: int,
+        deadline: Optional[float] = None,
+        stats: Optional[RenderStats] = None,
+    ) -> int:
+        """
+        Find the smallest priority whose render fits in `token_space`.
+        `deadline` is a `time.monotonic()` timestamp that switches to a time-bounded binary search.
+        """
+        stats = stats if stats is not None else self._new_stats()
         if len(priorities) == 0:
             return 0
 
-        # Start with the lowest priority value and work our way up until we find a priority that fits
+        # Never render a priority that filters out children a `MinK` node requires
+        candidates = sorted(
+            priority for priority in priorities if self._satisfies_min_k(priority)
+        )
+        if not candidates:
+            raise self._min_k_error(token_space)
+        pruned = len(candidates) < len(priorities)
+
+        # Jump to the candidate predicted by the token curve rather than rendering every priority from the bottom up
+        start = min(
+            bisect_left(candidates, self._predict_priority(token_space)),
+            len(candidates) - 1,
+        )
+
+        if deadline is not None:
+            return self._get_optimal_priority_before(
+                candidates, start, token_space, deadline, stats, pruned
+            )
+
+        # The prediction is counted per text leaf, so confirm it with exact counts.
+        # Work our way up until a priority fits, then down while lower priorities still fit
+        index = start
+        required_token_space = self.get_required_tokens(candidates[index])
+        stats["evaluated"] += 1
+        while required_token_space > token_space:
+            index += 1
+            if index == len(candidates):
+                raise self._space_error(required_token_space, token_space, pruned)
+            required_token_space = self.get_required_tokens(candidates[index])
+            stats["evaluated"] += 1
+
+        while index > 0:
+            stats["evaluated"] += 1
+            if self.get_required_tokens(candidates[index - 1]) > token_space:
+                break
+            index -= 1
+
+        return candidates[index]
+
+    def _get_optimal_priority_before(
+        self,
+        candidates: list[int],
+        start: int,
+        token_space: int,
+        deadline: float,
+        stats: RenderStats,
+        pruned: bool,
+    ) -> int:
+        """
+        Binary search over sorted candidates, remembering the lowest priority known to fit.
+        The first probe is `start`, the index predicted by the token curve.
+        Once the deadline passes, stop and settle for that priority. The search only continues past the
+        deadline while nothing fitting has been found, as the result must always fit.
+        """
+        low, high = 0, len(candidates) - 1
+        best: Optional[int] = None
         required_token_space = 0
-        for priority in sorted(list(priorities)):
-            rendered_prompt = self.render_priority(priority)
-
-            prompt_token_count = self.token_counter.count_prompt(rendered_prompt)
-            empty_token_count = self._get_empty_tokens(
-                self.prompt_elements, priority
-            ) + sum([element["tokens"] for element in self.empty_parent_elements])
-            required_token_space = prompt_token_count + empty_token_count
+        middle = start
+        while low <= high:
+            if best is not None and time.monotonic() >= deadline:
+                stats["degraded"] = True
+                break
+
+            required_token_space = self.get_required_tokens(candidates[middle])
+            stats["evaluated"] += 1
+
             if required_token_space <= token_space:
-                return priority
+                best = middle
+                high = middle - 1
+            else:
+                low = middle + 1
+            middle = (low + high) // 2
+
+        if best is None:
+            raise self._space_error(required_token_space, token_space, pruned)
+
+        return candidates[best]
 
-        raise PriorityError(
+    def token_curve(self) -> list[tuple[int, int]]:
+        """
+        Required token space (content plus `Empty` reservations) for every candidate priority, sorted by priority.
+        Built once per chain in a single pass that counts every text leaf once.
+        Joined text can tokenize slightly differently than its parts, so treat the totals as close estimates.
+        """
+        priorities, required = self._get_token_curve()
+        return list(zip(priorities, required))
+
+    def _get_token_curve(self) -> tuple[list[int], list[int]]:
+        if self._token_curve is None:
+            tokens_by_priority: dict[int, int] = defaultdict(int)
+            for priority, tokens in self._get_token_contributions(self.prompt_elements):
+                tokens_by_priority[priority] += tokens
+
+            # A priority cutoff keeps everything at or above it, so accumulate from the highest priority down
+            priorities = sorted(self.get_priorities(), reverse=True)
+            required = []
+            total = sum([element["tokens"] for element in self.empty_parent_elements])
+            for priority in priorities:
+                total += tokens_by_priority[priority]
+                required.append(total)
+
+            self._token_curve = (priorities[::-1], required[::-1])
+
+        return self._token_curve
+
+    def _predict_priority(self, token_space: int) -> int:
+        """Smallest priority the token curve expects to fit in `token_space`. O(log n) once the curve is built"""
+        priorities, required = self._get_token_curve()
+        index = bisect_left(required, -token_space, key=neg)
+        return priorities[index] if index < len(priorities) else sys.maxsize
+
+    def _space_error(
+        self, required_token_space: int, token_space: int, pruned: bool
+    ) -> PromptError:
+        # If higher priorities were ruled out by `MinK` nodes, those are what stop the prompt from fitting
+        if pruned:
+            return self._min_k_error(token_space, required_token_space)
+
+        return PriorityError(
             f"The minimum required token space is {required_token_space}"
             f" which cannot satisfy the constraint of {token_space} tokens."
             f" Please increase token space or reduce prompt size. Prompt:\n\n"
             f"{self.prompt_elements}."
         )
 
-    def render_priority(self, priority: int) -> list[ChatMessage]:
-        return [
-            {
-                "role": element["role"],
-                "content": textwrap.dedent(
-                    self._get_content(element, priority)
-                ).strip(),  # Strip to emulate JSX formatting
-            }
+    def _min_k_error(
+        self, token_space: int, required_token_space: Optional[int] = None
+    ) -> InsufficientChildrenError:
+        constraints = "\n".join(
+            f"- MinK node with priority {constraint['priority']} requires {constraint['min_k']} children, "
+            + (
+                f"so the priority cutoff cannot exceed {constraint['max_priority']}"
+                if constraint["max_priority"] is not None
+                else f"but only has {constraint['children']}"
+            )
+            for constraint in self._get_min_k_constraints()
+        )
+        budget = (
+            f"The minimum token space that satisfies every MinK node is {required_token_space},"
+            f" which exceeds the constraint of {token_space} tokens."
+            if required_token_space is not None
+            else "No priority cutoff satisfies every MinK node."
+        )
+        return InsufficientChildrenError(f"{budget} MinK constraints:\n{constraints}")
+
+    def _get_min_k_constraints(self) -> list[MinKConstraint]:
+        if self._min_k_constraints is None:
+            self._min_k_constraints = [
+                min_k_constraint(node, priority)  # type: ignore
+                for node, priority in self._get_nodes(
+                    self.prompt_elements,
+                    -sys.maxsize - 1,
+                    NodeType.MIN_K,
+                    descend=True,
+                )
+            ]
+        return self._min_k_constraints
+
+    def _satisfies_min_k(self, priority: int) -> bool:
+        """A cutoff is infeasible if it keeps a `MinK` node but filters out the children it requires"""
+        return not any(
+            constraint["priority"] >= priority
+            and (
+                constraint["max_priority"] is None
+                or priority > constraint["max_priority"]
+            )
+            for constraint in self._get_min_k_constraints()
+        )
+
+    @staticmethod
+    def _new_stats() -> RenderStats:
+        return RenderStats(
+            priority=0, evaluated=0, elapsed_ms=0, degraded=False, tokens_saved=0
+        )
+
+    @staticmethod
+    def _finish_stats(stats: RenderStats, priority: int, started: float) -> RenderStats:
+        stats["priority"] = priority
+        stats["elapsed_ms"] = (time.monotonic() - started) * 1000
+        return stats
+
+    def get_required_tokens(
+        self, priority: int, allocations: Optional[dict[int, int]] = None
+    ) -> int:
+        """Tokens needed by the rendered prompt plus all space reserved by `Empty` nodes and tool definitions"""
+        # History turns and JSON array elements are counted once per chain, so their surviving counts are added up
+        # rather than re-counted
+        rendered_prompt = self._render(
+            priority, allocations or {}, with_history=False, with_data=False
+        )
+        history_token_count = sum(
+            [
+                self._count_history(element, priority)  # type: ignore
+                for element in self.prompt_elements
+                if is_type(element, NodeType.HISTORY)
+            ]
+        )
+
+        prompt_token_count = (
+            self._count_prompt(rendered_prompt, priority) + history_token_count
+        )
+        empty_token_count = self._get_empty_tokens(
+            self.prompt_elements, priority
+        ) + sum([element["tokens"] for element in self.empty_parent_elements])
+        return prompt_token_count + empty_token_count
+
+    def _count_prompt(self, rendered_prompt: list[ChatMessage], priority: int) -> int:
+        """
+        Count rendered chat messages. Messages whose subtree was already counted at `priority` by this token counter,
+        in any chain, are looked up in the subtree memo rather than counted again
+        """
+        if type(self.token_counter).count_prompt is not TokenCounter.count_prompt:
+            # Counters that add to the sum of their messages only ever see the whole prompt
+            return self.token_counter.count_prompt(rendered_prompt)
+
+        keys = [
+            self._get_memo_key(element, priority, get_priority(element, sys.maxsize))
             for element in self.prompt_elements
             if is_type(element, NodeType.CHAT)
         ]
+        counts = [
+            None if key is None else subtree_memo.get_count(key, self.token_counter)
+            for key in keys
+        ]
+        missing = [index for index, count in enumerate(counts) if count is None]
+        new_counts = self.token_counter.count_batch(
+            [rendered_prompt[index]["content"] for index in missing]
+        )
+        for index, count in zip(missing, new_counts):
+            key = keys[index]
+            if key is not None:
+                subtree_memo.put_count(key, self.token_counter, count)
+        return sum([count for count in counts if count is not None]) + sum(new_counts)
+
+    def render_priority(
+        self, priority: int, allocations: Optional[dict[int, int]] = None
+    ) -> list[ChatMessage]:
+        """
+        Materialize the chain for a priority cutoff.
+        `allocations` maps `id(node)` of truncate nodes to the number of tokens they may keep (none by default)
+        """
+        return self._render(priority, allocations or {}, with_history=True)
+
+    def _render(
+        self,
+        priority: int,
+        allocations: dict[int, int],
+        with_history: bool,
+        with_data: bool = True,
+    ) -> list[ChatMessage]:
+        messages: list[ChatMessage] = []
+        for element in self.prompt_elements:
+            if is_type(element, NodeType.HISTORY):
+                if with_history:
+                    turns = element["turns"]  # type: ignore
+                    length = self._get_history_length(element, priority)  # type: ignore
+                    messages.extend(turns[len(turns) - length :])
+                continue
+
+            if is_type(element, NodeType.TOOL):
+                continue
+
+            messages.append(
+                {
+                    "role": element["role"],  # type: ignore
+                    "content": textwrap.dedent(
+                        self._get_content(
+                            element, priority, allocations, with_data=with_data
+                        )
+                    ).strip(),  # Strip to emulate JSX formatting
+                }
+            )
+        return messages
 
-    def _get_priorities(self, child_node: Node) -> Set[int]:
-        """DFS on a Node and return a set of all priorities in tree"""
-        if isinstance(child_node, List):
+    def _get_priorities(
+        self, child_node: Node, parent_priority: int = sys.maxsize
+    ) -> Set[int]:
+        """DFS on a Node and return a set of all effective priorities in tree"""
+        if isinstance(child_node, list):
             res: Set[int] = set()
             for node in child_node:
-                res = res.union(self._get_priorities(node))
+                res.update(self._get_priorities(node, parent_priority))
             return res
 
         if isinstance(child_node, str):
             return set()
 
+        if is_type(child_node, NodeType.CHUNKED, NodeType.DEDUP):
+            return self._get_priorities(self._expand(child_node), parent_priority)  # type: ignore
+
+        priority = get_priority(child_node, parent_priority)
+        if is_type(
+            child_node,
+            NodeType.CHAT,
+            NodeType.SCOPE,
+            NodeType.TOP_K,
+            NodeType.MIN_K,
+            NodeType.NORMALIZE,
+        ):
+            return {priority}.union(
+                self._get_priorities(child_node["children"], priority)  # type: ignore
+            )
+
+        if is_type(
+            child_node,
+            NodeType.EMPTY,
+            NodeType.TRUNCATE,
+            NodeType.LAZY,
+            NodeType.FILE,
+            NodeType.TOOL,
+            NodeType.IMAGE,
+        ):
+            return {priority}
+
+        if is_type(child_node, NodeType.HISTORY):
+            return set(range(priority - len(child_node["turns"]) + 1, priority + 1))  # type: ignore
+
+        if is_type(child_node, NodeType.JSON_ARRAY):
+            return {priority}.union(
+                min(element_priority, priority)
+                for element_priority in child_node["priorities"]  # type: ignore
+            )
+
+        raise UnknownNodeError(
+            f"Unknown child node type {type(child_node)} - {child_node}"
+        )
+
+    def _get_token_contributions(
+        self, child_node: Node, parent_priority: int = sys.maxsize
+    ) -> list[tuple[int, int]]:
+        """DFS on a Node. Return (effective priority, tokens) for every text leaf and space reservation in tree"""
+        if isinstance(child_node, list):
+            return [
+                contribution
+                for node in child_node
+                for contribution in self._get_token_contributions(node, parent_priority)
+            ]
+
+        if isinstance(child_node, str):
+            return [(parent_priority, self.token_counter.count(child_node))]
+
+        if is_type(child_node, NodeType.CHUNKED, NodeType.DEDUP):
+            return self._get_token_contributions(
+                self._expand(child_node),  # type: ignore
+                parent_priority,
+            )
+
+        priority = get_priority(child_node, parent_priority)
         if is_type(
-            child_node, NodeType.CHAT, NodeType.SCOPE, NodeType.TOP_K, NodeType.MIN_K
+            child_node,
+            NodeType.CHAT,
+            NodeType.SCOPE,
+            NodeType.MIN_K,
+            NodeType.NORMALIZE,
         ):
-            return {child_node["priority"]}.union(
-                self._get_priorities(child_node["children"])  # type: ignore
+            return self._get_token_contributions(child_node["children"], priority)  # type: ignore
+
+        if is_type(child_node, NodeType.TOP_K):
+            sorted_children = sort_by_priority(child_node["children"], priority)  # type: ignore
+            return self._get_token_contributions(
+                sorted_children[: child_node["top_k"]],  # type: ignore
+                priority,
             )
 
         if is_type(child_node, NodeType.EMPTY):
-            return {child_node["priority"]}  # type: ignore
+            return [(priority, child_node["tokens"])]  # type: ignore
+
+        if is_type(child_node, NodeType.TOOL):
+            return [(priority, self._get_tool_tokens(child_node))]  # type: ignore
+
+        if is_type(child_node, NodeType.IMAGE):
+            return [(priority, self._get_image_tokens(child_node))]  # type: ignore
+
+        if is_type(child_node, NodeType.TRUNCATE):
+            return []
+
+        if is_type(child_node, NodeType.JSON_ARRAY):
+            counts, brackets, separator, _ = self._get_json_array_tokens(child_node)  # type: ignore
+            return [(priority, brackets)] + [
+                (min(element_priority, priority), count + separator)
+                for count, element_priority in zip(counts, child_node["priorities"])  # type: ignore
+            ]
+
+        if is_type(child_node, NodeType.HISTORY):
+            # Suffix sums of the turns, so each turn contributes the difference at its own priority
+            history_tokens = self._get_history_tokens(child_node)  # type: ignore
+            return [
+                (priority - age, history_tokens[age + 1] - history_tokens[age])
+                for age in range(len(history_tokens) - 1)
+            ]
+
+        if is_type(child_node, NodeType.LAZY, NodeType.FILE):
+            node_id = id(child_node)
+            if node_id in self._lazy_dropped:
+                return []
+            if node_id in self._chunk_ids:
+                return [(priority, child_node["tokens"])]  # type: ignore
+            if node_id in self._lazy_content:
+                return [
+                    (priority, self.token_counter.count(self._lazy_content[node_id]))
+                ]
+            return [(priority, self._get_reserved_tokens(child_node))]  # type: ignore
 
         raise UnknownNodeError(
             f"Unknown child node type {type(child_node)} - {child_node}"
         )
 
-    def _get_empty_tokens(self, child_node: Node, min_priority: int) -> int:
+    def _get_empty_tokens(
+        self, child_node: Node, min_priority: int, parent_priority: int = sys.maxsize
+    ) -> int:
         """DFS on a Node. Filter lower priorities and count empty tokens in `Empty` nodes"""
-        if isinstance(child_node, List):
+        if isinstance(child_node, list):
             return sum(
-                [self._get_empty_tokens(node, min_priority) for node in child_node]
+                [
+                    self._get_empty_tokens(node, min_priority, parent_priority)
+                    for node in child_node
+                ]
+            )
+
+        if isinstance(child_node, str):
+            return 0
+
+        if is_type(child_node, NodeType.CHUNKED, NodeType.DEDUP):
+            return self._get_empty_tokens(
+                self._expand(child_node),  # type: ignore
+                min_priority,
+                parent_priority,
             )
 
-        if isinstance(child_node, str) or child_node["priority"] < min_priority:
+        priority = get_priority(child_node, parent_priority)
+        if priority < min_priority:
             return 0
+        min_priority = self._get_cap_floor(child_node, min_priority, priority)
 
         if is_type(
-            child_node, NodeType.CHAT, NodeType.SCOPE, NodeType.TOP_K, NodeType.MIN_K
+            child_node,
+            NodeType.CHAT,
+            NodeType.SCOPE,
+            NodeType.TOP_K,
+            NodeType.MIN_K,
+            NodeType.NORMALIZE,
         ):
             children: list[NonChatNode] = child_node["children"]  # type: ignore
             return sum(
-                [self._get_empty_tokens(node, min_priority) for node in children]
+                [
+                    self._get_empty_tokens(node, min_priority, priority)
+                    for node in children
+                ]
             )
 
         if is_type(child_node, NodeType.EMPTY):
             return child_node["tokens"]  # type: ignore
 
+        if is_type(child_node, NodeType.TOOL):
+            # Tool definitions are sent outside the messages, so their schemas hold space like `Empty` nodes
+            return self._get_tool_tokens(child_node)  # type: ignore
+
+        if is_type(child_node, NodeType.IMAGE):
+            # Images are sent as separate content parts, so they also hold space rather than render text
+            return self._get_image_tokens(child_node)  # type: ignore
+
+        if is_type(child_node, NodeType.TRUNCATE, NodeType.HISTORY):
+            return 0
+
+        if is_type(child_node, NodeType.JSON_ARRAY):
+            # Counted here from per-element counts, as content is rendered without them when counting
+            return self._count_json_array(child_node, min_priority, priority)  # type: ignore
+
+        if is_type(child_node, NodeType.LAZY, NodeType.FILE):
+            # Unresolved lazy and file nodes hold space for their tokens. Resolved ones are counted as content,
+            # except chunks, whose exact counts are added up whether they were decoded or not
+            node_id = id(child_node)
+            if node_id in self._lazy_dropped:
+                return 0
+            if node_id in self._chunk_ids:
+                return child_node["tokens"]  # type: ignore
+            if node_id in self._lazy_content:
+                return 0
+            return self._get_reserved_tokens(child_node)  # type: ignore
+
         raise UnknownNodeError(
             f"Unknown child node type {type(child_node)} - {child_node}"
         )
 
     def _get_content(
-        self, child_node: Union[Node, list[Node]], min_priority: int
+        self,
+        child_node: Union[Node, list[Node]],
+        min_priority: int,
+        allocations: dict[int, int],
+        parent_priority: int = sys.maxsize,
+        with_data: bool = True,
     ) -> str:
-        """DFS on a Node. Filter lower priorities and return contents as a string"""
-        if isinstance(child_node, List):
+        """
+        DFS on a Node. Filter lower priorities and return contents as a string.
+        Without `with_data`, `JsonArray` nodes and chunks render nothing, as their tokens are added up from counts
+        taken once per chain
+        """
+        if isinstance(child_node, list):
             return "".join(
-                [self._get_content(child, min_priority) for child in child_node]
+                [
+                    self._get_content(
+                        child, min_priority, allocations, parent_priority, with_data
+                    )
+                    for child in child_node
+                ]
             )
 
         if isinstance(child_node, str):
             return child_node
 
-        if child_node["priority"] < min_priority:
+        if is_type(child_node, NodeType.CHUNKED, NodeType.DEDUP):
+            return self._get_content(
+                self._expand(child_node),  # type: ignore
+                min_priority,
+                allocations,
+                parent_priority,
+                with_data,
+            )
+
+        priority = get_priority(child_node, parent_priority)
+        if priority < min_priority:
             return ""
+        min_priority = self._get_cap_floor(child_node, min_priority, priority)
+
+        # Identical subtrees render the same in every chain, so they are rendered once per cutoff
+        key = self._get_memo_key(child_node, min_priority, priority)
+        if key is None:
+            return self._get_node_content(
+                child_node, min_priority, allocations, priority, with_data
+            )
+        content = subtree_memo.get_text(key)
+        if content is None:
+            # Memoized subtrees never hold `JsonArray` nodes or chunks, so their content does not depend on `with_data`
+            content = self._get_node_content(
+                child_node, min_priority, allocations, priority, with_data
+            )
+            subtree_memo.put_text(key, content)
+        return content
 
+    def _get_node_content(
+        self,
+        child_node: Union[ChatNode, HistoryNode, ToolNode, NonChatNode],
+        min_priority: int,
+        allocations: dict[int, int],
+        priority: int,
+        with_data: bool = True,
+    ) -> str:
+        """Contents of a node with effective `priority` that survives the `min_priority` cutoff"""
         if is_type(child_node, NodeType.CHAT, NodeType.SCOPE):
-            return self._get_content(child_node["children"], min_priority)  # type: ignore
+            return self._get_content(
+                child_node["children"],  # type: ignore
+                min_priority,
+                allocations,
+                priority,
+                with_data,
+            )
+
+        if is_type(child_node, NodeType.NORMALIZE):
+            return normalize_text(
+                self._get_content(
+                    child_node["children"],  # type: ignore
+                    min_priority,
+                    allocations,
+                    priority,
+                    with_data,
+                )
+            )
 
         if is_type(child_node, NodeType.TOP_K):
             sorted_children = sort_by_priority(
                 child_node["children"],  # type: ignore
-                child_node["priority"],  # type: ignore
-            )  # type: ignore
+                priority,
+            )
             return self._get_content(
                 sorted_children[: child_node["top_k"]],  # type: ignore
                 min_priority,
+                allocations,
+                priority,
+                with_data,
             )
 
         if is_type(child_node, NodeType.MIN_K):
             # Also handle when child doesn't have priority key. It should use the current element priority
-            min_k = child_node["min_k"]  # type: ignore
-            priority = child_node["priority"]  # type: ignore
+            min_k: int = child_node["min_k"]  # type: ignore
             sorted_children = sort_by_priority(child_node["children"], priority)  # type: ignore
             filtered_children = [
                 child
@@ -187,15 +867,661 @@ class Chain:
                     f" but requires at least {child_node['min_k']}."  # type: ignore
                 )
 
-            return self._get_content(sorted_children, min_priority)
+            return self._get_content(
+                sorted_children, min_priority, allocations, priority, with_data
+            )
 
-        if is_type(child_node, NodeType.EMPTY):  # type: ignore
+        if is_type(child_node, NodeType.EMPTY, NodeType.IMAGE):  # type: ignore
             return ""
 
+        if is_type(child_node, NodeType.TRUNCATE):
+            return self._truncate(
+                child_node,  # type: ignore
+                allocations.get(id(child_node), 0),
+            )
+
+        if is_type(child_node, NodeType.LAZY, NodeType.FILE):
+            if not with_data and id(child_node) in self._chunk_ids:
+                return ""
+            return self._lazy_content.get(id(child_node), "")
+
+        if is_type(child_node, NodeType.JSON_ARRAY):
+            if not with_data:
+                return ""
+            return self._render_json_array(child_node, min_priority, priority)  # type: ignore
+
         raise UnknownNodeError(
             f"Unknown child node type {type(child_node)} - {child_node}"
         )
 
+    def _get_nodes(
+        self,
+        child_node: Union[Node, list[Node]],
+        min_priority: int,
+        *desired_types: NodeType,
+        parent_priority: int = sys.maxsize,
+        descend: bool = False,
+    ) -> list[tuple[Node, int]]:
+        """
+        DFS on a Node. Return the nodes of the desired types that survive the priority cutoff
+        alongside their effective priority. With `descend`, also search inside the nodes that were found
+        """
+        return [
+            (node, priority)
+            for node, priority, _ in self._find_nodes(
+                child_node,
+                min_priority,
+                *desired_types,
+                parent_priority=parent_priority,
+                descend=descend,
+            )
+        ]
+
+    def _find_nodes(
+        self,
+        child_node: Union[Node, list[Node]],
+        min_priority: int,
+        *desired_types: NodeType,
+        parent_priority: int = sys.maxsize,
+        descend: bool = False,
+    ) -> list[tuple[Node, int, int]]:
+        """Same as `_get_nodes`, but each node also comes with the cutoff its children are filtered at"""
+        if isinstance(child_node, list):
+            return [
+                found
+                for child in child_node
+                for found in self._find_nodes(
+                    child,
+                    min_priority,
+                    *desired_types,
+                    parent_priority=parent_priority,
+                    descend=descend,
+                )
+            ]
+
+        if isinstance(child_node, str):
+            return []
+
+        if is_type(child_node, NodeType.CHUNKED, NodeType.DEDUP):
+            return self._find_nodes(
+                self._expand(child_node),  # type: ignore
+                min_priority,
+                *desired_types,
+                parent_priority=parent_priority,
+                descend=descend,
+            )
+
+        priority = get_priority(child_node, parent_priority)
+        if priority < min_priority:
+            return []
+        min_priority = self._get_cap_floor(child_node, min_priority, priority)
+
+        found: list[tuple[Node, int, int]] = []
+        if is_type(child_node, *desired_types):
+            found.append((child_node, priority, min_priority))
+            if not descend:
+                return found
+
+        if is_type(
+            child_node,
+            NodeType.CHAT,
+            NodeType.SCOPE,
+            NodeType.MIN_K,
+            NodeType.NORMALIZE,
+        ):
+            return found + self._find_nodes(
+                child_node["children"],  # type: ignore
+                min_priority,
+                *desired_types,
+                parent_priority=priority,
+                descend=descend,
+            )
+
+        if is_type(child_node, NodeType.TOP_K):
+            sorted_children = sort_by_priority(
+                child_node["children"],  # type: ignore
+                priority,
+            )
+            return found + self._find_nodes(
+                sorted_children[: child_node["top_k"]],  # type: ignore
+                min_priority,
+                *desired_types,
+                parent_priority=priority,
+                descend=descend,
+            )
+
+        return found
+
+    def _allocate_truncated(self, priority: int, token_space: int) -> dict[int, int]:
+        """
+        Split the space left over at `priority` between surviving truncate nodes, highest priority first.
+        Token boundaries can shift once text is joined, so shrink the allocations until the prompt fits.
+        """
+        truncate_nodes: list[tuple[TruncateNode, int]] = sorted(
+            self._get_nodes(self.prompt_elements, priority, NodeType.TRUNCATE),  # type: ignore
+            key=lambda found: found[1],
+            reverse=True,
+        )
+        if not truncate_nodes:
+            return {}
+
+        # Truncate nodes inside capped nodes also share the space left under each of those caps
+        remaining_caps: list[int] = []
+        capped_ancestors: dict[tuple[int, int], list[int]] = defaultdict(list)
+        for capped_node, capped_priority in self._get_capped_nodes():
+            if capped_priority < priority:
+                continue
+            remaining_caps.append(
+                self._get_cap(capped_node, token_space)
+                - self._count_capped(capped_node, priority, capped_priority)
+            )
+            for node, node_priority in self._get_nodes(
+                capped_node,
+                priority,
+                NodeType.TRUNCATE,
+                parent_priority=capped_priority,
+            ):
+                capped_ancestors[(id(node), node_priority)].append(
+                    len(remaining_caps) - 1
+                )
+
+        remaining = token_space - self.get_required_tokens(priority)
+        allocations: dict[int, int] = {}
+        for node, node_priority in truncate_nodes:
+            # A reused truncate node renders the same text everywhere, so it gets the smallest of its allocations
+            ancestors = capped_ancestors[(id(node), node_priority)]
+            allocations[id(node)] = max(
+                min(
+                    allocations.get(id(node), len(self._get_tokens(node))),
+                    remaining,
+                    *[remaining_caps[index] for index in ancestors],
+                ),
+                0,
+            )
+            remaining -= allocations[id(node)]
+            for index in ancestors:
+                remaining_caps[index] -= allocations[id(node)]
+
+        overflow = self.get_required_tokens(priority, allocations) - token_space
+        while overflow > 0 and any(allocations.values()):
+            for node, _ in reversed(truncate_nodes):
+                removed = min(allocations[id(node)], overflow)
+                allocations[id(node)] -= removed
+                overflow -= removed
+            overflow = self.get_required_tokens(priority, allocations) - token_space
+
+        return allocations
+
+    def _get_tokens_saved(self, priority: int, allocations: dict[int, int]) -> int:
+        """
+        Tokens the surviving `Normalize` nodes save at `priority`. Each node's text is rendered as in the prompt:
+        at the cutoff of any capped node around it, with truncate allocations, JSON arrays and chunks.
+        Counts are cached by content
+        """
+        return sum(
+            [
+                count_saved_tokens(
+                    self._get_content(
+                        node["children"],  # type: ignore
+                        cutoff,
+                        allocations,
+                        node_priority,
+                    ),
+                    self.token_counter,
+                )
+                for node, node_priority, cutoff in self._find_nodes(
+                    self.prompt_elements, priority, NodeType.NORMALIZE
+                )
+            ]
+        )
+
+    def _set_cap_floors(self, token_space: int) -> None:
+        """
+        Precompute a local priority floor for every capped node, innermost first: the lowest cutoff at which the
+        content of the node fits its cap. Capped nodes filter their children at the higher of the floor and the
+        global cutoff, so one search over the global cutoff satisfies every cap and `token_space` together.
+        A capped node reused in several places gets a floor for each effective priority it has there.
+        Finding a floor renders and counts the node at each step of its search, so floors are kept per token space
+        and set of resolved lazy nodes, and later renders of the chain reuse them
+        """
+        key = (token_space, len(self._lazy_content), frozenset(self._lazy_dropped))
+        if key in self._cap_floor_sets:
+            self._cap_floors = self._cap_floor_sets[key]
+            return
+
+        self._cap_floors = {}
+        for node, priority in reversed(self._get_capped_nodes()):
+            # The node's own floor is only stored once its search is over, so the search never filters by it
+            self._cap_floors[(id(node), priority)] = self._find_cap_floor(
+                node, priority, self._get_cap(node, token_space)
+            )
+        if self._capped_nodes:
+            self._cap_floor_sets[key] = self._cap_floors
+
+    def _get_capped_nodes(self) -> list[tuple[Union[ChatNode, ScopeNode], int]]:
+        """
+        Capped messages and scopes with their effective priority, in DFS pre-order. A node reused at the same
+        effective priority is listed once. Found once per chain
+        """
+        if self._capped_nodes is None:
+            floors, self._cap_floors = self._cap_floors, {}
+            capped_nodes = {
+                (id(node), priority): (node, priority)
+                for node, priority in self._get_nodes(
+                    self.prompt_elements,
+                    -sys.maxsize - 1,
+                    NodeType.CHAT,
+                    NodeType.SCOPE,
+                    descend=True,
+                )
+                if "cap" in node  # type: ignore
+            }
+            self._capped_nodes = list(capped_nodes.values())  # type: ignore
+            self._cap_floors = floors
+        return self._capped_nodes
+
+    def _get_cap_floor(
+        self,
+        node: Union[ChatNode, HistoryNode, ToolNode, NonChatNode],
+        min_priority: int,
+        priority: int,
+    ) -> int:
+        """The cutoff a node's children are filtered at, given the node's effective `priority`"""
+        if not self._cap_floors:
+            return min_priority
+        return max(
+            min_priority, self._cap_floors.get((id(node), priority), min_priority)
+        )
+
+    @staticmethod
+    def _get_cap(node: Union[ChatNode, ScopeNode], token_space: int) -> int:
+        cap = node["cap"]  # type: ignore
+        if isinstance(cap, float):
+            return int(cap * token_space)
+        return cap
+
+    def _find_cap_floor(
+        self, node: Union[ChatNode, ScopeNode], priority: int, cap: int
+    ) -> int:
+        """
+        Binary search the priorities inside the node for the lowest cutoff at which its content fits `cap`.
+        Content only shrinks as the cutoff rises, until `MinK` nodes inside run out of children
+        """
+        candidates = sorted(self._get_priorities(node, priority))
+        low, high = 0, len(candidates) - 1
+        floor: Optional[int] = None
+        while low <= high:
+            middle = (low + high) // 2
+            try:
+                fits = self._count_capped(node, candidates[middle], priority) <= cap
+            except InsufficientChildrenError:
+                high = middle - 1
+                continue
+
+            if fits:
+                floor = candidates[middle]
+                high = middle - 1
+            else:
+                low = middle + 1
+
+        if floor is None:
+            kind = "message" if is_type(node, NodeType.CHAT) else "scope"
+            raise PriorityError(
+                f"A {kind} with priority {priority} is capped at {cap} tokens, which its content exceeds at every"
+                f" priority cutoff that satisfies its MinK nodes. Please increase the cap or lower the priority"
+                f" of more of its content: {node}"
+            )
+        return floor
+
+    def _count_capped(
+        self, node: Union[ChatNode, ScopeNode], min_priority: int, priority: int
+    ) -> int:
+        """Tokens of a capped node's content and `Empty` reservations at a cutoff, given its effective priority"""
+        content = self._get_content(node, min_priority, {}, priority, with_data=False)
+        if is_type(node, NodeType.CHAT):
+            content = textwrap.dedent(content).strip()
+        return self.token_counter.count(content) + self._get_empty_tokens(
+            node, min_priority, priority
+        )
+
+    def _reset_dropped(self) -> None:
+        """Lazy nodes dropped for missing a deadline only stay dropped for that render"""
+        if self._lazy_dropped:
+            self._lazy_dropped = set()
+            self._token_curve = None
+
+    def _get_reserved_tokens(self, node: Union[LazyNode, FileNode]) -> int:
+        if is_type(node, NodeType.LAZY):
+            return node["tokens"]  # type: ignore
+
+        # File nodes reserve their exact token count, computed once per chain and cached on disk
+        if id(node) not in self._file_tokens:
+            self._file_tokens[id(node)] = count_file_tokens(node, self.token_counter)  # type: ignore
+        return self._file_tokens[id(node)]
+
+    def _get_unresolved_lazy(self, priority: int) -> list[Union[LazyNode, FileNode]]:
+        """Lazy and file nodes surviving `priority` whose content has not been loaded yet"""
+        return [
+            node  # type: ignore
+            for node, _ in self._get_nodes(
+                self.prompt_elements, priority, NodeType.LAZY, NodeType.FILE
+            )
+            if id(node) not in self._lazy_content and id(node) not in self._lazy_dropped
+        ]
+
+    def _resolve_lazy(self, priority: int) -> bool:
+        """Call the providers of unresolved lazy nodes that survive `priority`. Results live as long as the chain"""
+        lazy_nodes = self._get_unresolved_lazy(priority)
+        for node in lazy_nodes:
+            content = load(node)
+            if not isinstance(content, str):
+                if asyncio.iscoroutine(content):
+                    content.close()
+                raise InvalidPromptError(
+                    "Lazy node has an async provider. Use `await chain.arender(...)` instead"
+                )
+            self._lazy_content[id(node)] = content
+            self._token_curve = None
+
+        return len(lazy_nodes) > 0
+
+    async def _aresolve_lazy(
+        self,
+        lazy_nodes: list[Union[LazyNode, FileNode]],
+        deadline: Optional[float],
+    ) -> None:
+        """Resolve lazy nodes concurrently. Providers still pending at `deadline` are cancelled and dropped"""
+        pending: dict[asyncio.Future[str], Union[LazyNode, FileNode]] = {}
+        self._token_curve = None
+        for node in lazy_nodes:
+            content = load(node)
+            if isinstance(content, str):
+                self._lazy_content[id(node)] = content
+            else:
+                pending[asyncio.ensure_future(content)] = node
+
+        if not pending:
+            return
+
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        done, not_done = await asyncio.wait(pending, timeout=timeout)
+
+        for future in not_done:
+            future.cancel()
+            self._lazy_dropped.add(id(pending[future]))
+
+        for future in done:
+            self._lazy_content[id(pending[future])] = future.result()
+
+    def _get_tool_tokens(self, node: ToolNode) -> int:
+        """Token cost of a tool definition, looked up once per chain"""
+        if id(node) not in self._tool_tokens:
+            self._tool_tokens[id(node)] = count_tool_tokens(node, self.token_counter)
+        return self._tool_tokens[id(node)]
+
+    def _get_image_tokens(self, node: ImageNode) -> int:
+        """Token cost of an image from the dimensions in its header, computed once per chain"""
+        if id(node) not in self._image_tokens:
+            _, width, height = image_size(node["source"])
+            self._image_tokens[id(node)] = node["formula"](width, height)
+        return self._image_tokens[id(node)]
+
+    def _get_json_array_tokens(
+        self, node: JsonArrayNode
+    ) -> tuple[list[int], int, int, int]:
+        """
+        Token counts of each element, of the brackets, of one separator and of an empty array, counted in one batch
+        once per chain. Any subset of elements is costed by adding these up rather than serializing and counting it
+        """
+        if id(node) not in self._json_array_tokens:
+            opening, separator, closing = delimiters(node["indent"])
+            *counts, brackets, separator_count, empty_count = (
+                self.token_counter.count_batch(
+                    [*node["elements"], opening + closing, separator, "[]"]
+                )
+            )
+            self._json_array_tokens[id(node)] = (
+                counts,
+                brackets,
+                separator_count,
+                empty_count,
+            )
+        return self._json_array_tokens[id(node)]
+
+    def _count_json_array(
+        self, node: JsonArrayNode, min_priority: int, priority: int
+    ) -> int:
+        counts, brackets, separator, empty_count = self._get_json_array_tokens(node)
+        kept = [
+            count
+            for count, element_priority in zip(counts, node["priorities"])
+            if min(element_priority, priority) >= min_priority
+        ]
+        if not kept:
+            return empty_count
+        return brackets + sum(kept) + separator * (len(kept) - 1)
+
+    def _render_json_array(
+        self, node: JsonArrayNode, min_priority: int, priority: int
+    ) -> str:
+        """The elements surviving `min_priority` as a JSON array, in their original order"""
+        return join_elements(
+            [
+                element
+                for element, element_priority in zip(
+                    node["elements"], node["priorities"]
+                )
+                if min(element_priority, priority) >= min_priority
+            ],
+            node["indent"],
+        )
+
+    def _get_history_tokens(self, node: HistoryNode) -> list[int]:
+        """
+        Token counts of the newest `n` turns for every `n`, counted in one batch once per chain.
+        Dropping a turn never changes how the others tokenize, so these counts are exact
+        """
+        if id(node) not in self._history_tokens:
+            counts = self.token_counter.count_batch(
+                [turn["content"] for turn in node["turns"]]
+            )
+            self._history_tokens[id(node)] = list(
+                accumulate(reversed(counts), initial=0)
+            )
+        return self._history_tokens[id(node)]
+
+    def _count_history(self, node: HistoryNode, priority: int) -> int:
+        return self._get_history_tokens(node)[self._get_history_length(node, priority)]
+
+    @staticmethod
+    def _get_history_length(node: HistoryNode, priority: int) -> int:
+        """Number of turns surviving `priority`. The newest turn has the node's priority and each older one less"""
+        return max(min(node["priority"] - priority + 1, len(node["turns"])), 0)
+
+    def _get_memo_key(
+        self,
+        node: Union[ChatNode, HistoryNode, ToolNode, NonChatNode],
+        min_priority: int,
+        priority: int,
+    ) -> Optional[MemoKey]:
+        if not is_type(node, *MEMOIZED_TYPES):
+            return None
+        digest = self._get_subtree_hash(node)
+        return None if digest is None else (digest, min_priority, priority)
+
+    def _get_subtree_hash(
+        self, child_node: Union[ChatNode, HistoryNode, ToolNode, NonChatNode]
+    ) -> Optional[bytes]:
+        """
+        Structural hash of a subtree, computed bottom-up once per chain.
+        None if the subtree holds nodes whose content depends on the chain, like lazy, file or truncate nodes
+        """
+        if isinstance(child_node, str):
+            return text_hash(child_node)
+
+        node_id = id(child_node)
+        if node_id in self._subtree_hashes:
+            return self._subtree_hashes[node_id]
+
+        digest: Optional[bytes] = None
+        values = []
+        for field in HASHED_FIELDS:
+            value = child_node[field] if field in child_node else None  # type: ignore
+            values.append(value)
+        fields = repr(values).encode()
+        # The content of capped nodes depends on the token space of each render
+        if "cap" not in child_node and is_type(child_node, *MEMOIZED_TYPES):
+            child_hashes = [
+                self._get_subtree_hash(child)
+                for child in child_node["children"]  # type: ignore
+            ]
+            if None not in child_hashes:
+                digest = node_hash(fields, child_hashes)  # type: ignore
+        elif is_type(child_node, NodeType.EMPTY, NodeType.IMAGE):
+            # Neither renders any text. Their space is counted separately
+            digest = node_hash(fields, [])
+
+        self._subtree_hashes[node_id] = digest
+        return digest
+
+    def _expand(
+        self, node: Union[ChunkedNode, DedupNode]
+    ) -> Union[ScopeNode, TopKNode]:
+        """Nodes that stand for a subtree built once per chain. Traversals descend into that subtree instead"""
+        if is_type(node, NodeType.DEDUP):
+            return self._get_deduplicated(node)  # type: ignore
+        return self._get_chunks(node)  # type: ignore
+
+    def _get_deduplicated(self, node: DedupNode) -> ScopeNode:
+        """
+        Drop children that are near duplicates of a higher priority child, once per chain.
+        Children are compared by their full content. Lazy content is not known yet, so those children are all kept
+        """
+        if id(node) not in self._deduplicated:
+            children = sorted(
+                enumerate(node["children"]),
+                key=lambda child: get_priority(child[1], sys.maxsize),
+                reverse=True,
+            )
+            texts = [
+                self._get_content(child, -sys.maxsize - 1, {}) for _, child in children
+            ]
+            kept = sorted(
+                children[index][0] for index in distinct(texts, node["threshold"])
+            )
+            self._deduplicated[id(node)] = ScopeNode(
+                type=NodeType.SCOPE,
+                priority=node["priority"],
+                children=[node["children"][index] for index in kept],
+            )
+        return self._deduplicated[id(node)]
+
+    def _get_chunks(self, node: ChunkedNode) -> Union[ScopeNode, TopKNode]:
+        """
+        Cut a chunked node into lazy nodes, once per chain. The text is tokenized a single time.
+        Each chunk is costed by its exact token count, before and after it is decoded, so chunk text is never counted.
+        Chunks are only decoded if they survive peeling
+        """
+        if id(node) not in self._chunks:
+            tokens = self.token_counter.tokenize(node["text"])
+            step = node["chunk_tokens"] - node["overlap"]
+            # The last chunk must reach the end of the text. An empty text has no chunks
+            starts = range(
+                0, max(len(tokens) - node["overlap"], min(len(tokens), 1)), step
+            )
+            priority_fn = node["priority_fn"]
+            children: list[NonChatNode] = [
+                LazyNode(
+                    type=NodeType.LAZY,
+                    priority=(
+                        sys.maxsize
+                        if priority_fn is None
+                        else priority_fn(index, len(starts))
+                    ),
+                    provider=partial(
+                        self._decode_chunk, tokens, start, start + node["chunk_tokens"]
+                    ),
+                    tokens=len(tokens[start : start + node["chunk_tokens"]]),
+                )
+                for index, start in enumerate(starts)
+            ]
+            self._chunk_ids.update([id(child) for child in children])
+
+            self._chunks[id(node)] = (
+                ScopeNode(
+                    type=NodeType.SCOPE, priority=node["priority"], children=children
+                )
+                if node["top_k"] is None
+                else TopKNode(
+                    type=NodeType.TOP_K,
+                    priority=node["priority"],
+                    top_k=node["top_k"],
+                    children=children,
+                )
+            )
+        return self._chunks[id(node)]
+
+    def _decode_chunk(self, tokens: list[int], start: int, end: int) -> str:
+        return self._decode(tokens[start:end])
+
+    def _decode(self, tokens: list[int]) -> str:
+        """Decode a slice of tokenized text, dropping characters split by the cut at either end"""
+        return self.token_counter.decode_bytes(tokens).decode("utf-8", errors="ignore")
+
+    def _get_tokens(self, node: TruncateNode) -> list[int]:
+        """Tokenize a truncate node's text once per chain so slicing never re-encodes it"""
+        if id(node) not in self._truncate_tokens:
+            self._truncate_tokens[id(node)] = self.token_counter.tokenize(node["text"])
+        return self._truncate_tokens[id(node)]
+
+    def _truncate(self, node: TruncateNode, token_limit: int) -> str:
+        if token_limit <= 0:
+            return ""
+
+        tokens = self._get_tokens(node)
+        if token_limit >= len(tokens):
+            return node["text"]
+
+        kept = tokens[:token_limit] if node["keep"] == "head" else tokens[-token_limit:]
+        return self._decode(kept)
+
+
+def load(node: Union[LazyNode, FileNode]) -> Union[str, Awaitable[str]]:
+    if is_type(node, NodeType.FILE):
+        return read_file(node)  # type: ignore
+    return node["provider"]()  # type: ignore
+
+
+def min_k_constraint(node: MinKNode, priority: int) -> MinKConstraint:
+    """Precompute the highest cutoff at which a `MinK` node with effective `priority` keeps enough children"""
+    child_priorities = sorted(
+        [get_priority(child, priority) for child in node["children"]], reverse=True
+    )
+    min_k = node["min_k"]
+    max_priority: Optional[int] = None
+    if min_k == 0:
+        max_priority = priority
+    elif len(child_priorities) >= min_k:
+        max_priority = child_priorities[min_k - 1]
+
+    return MinKConstraint(
+        priority=priority,
+        min_k=min_k,
+        children=len(child_priorities),
+        max_priority=max_priority,
+    )
+
+
+def contains_type(node: Node, *node_types: NodeType) -> bool:
+    """True if the tree holds a node of one of `node_types`. Chunked and dedup nodes are not expanded"""
+    if isinstance(node, list):
+        return any([contains_type(child, *node_types) for child in node])
+    if isinstance(node, str):
+        return False
+    return is_type(node, *node_types) or (
+        "children" in node and contains_type(node["children"], *node_types)  # type: ignore
+    )
+
 
 def sort_by_priority(children: list[Node], parent_priority: int) -> list[Node]:
     return sorted(
@@ -206,4 +1532,10 @@ def sort_by_priority(children: list[Node], parent_priority: int) -> list[Node]:
 
 
 def get_priority(node: Node, parent_priority: int) -> int:
-    return node["priority"] if "priority" in node else parent_priority  # type: ignore
+    """
+    Effective priority of a node under a parent with `parent_priority`.
+    Children never outrank their parent and nodes left at the default priority inherit it.
+    """
+    if isinstance(node, str) or "priority" not in node:
+        return parent_priority
+    return min(node["priority"], parent_priority)  # type: ignore
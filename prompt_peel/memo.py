@@ -0,0 +1,129 @@
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+import itertools
+from typing import Optional
+
+from prompt_peel.node import NodeType
+from prompt_peel.token_cache import content_hash
+from prompt_peel.token_counter import TokenCounter
+
+"""
+Process-wide memo of rendered subtrees.
+Subtrees built only from text and structural nodes render the same wherever they appear, so `Chain` gives each
+one a structural hash. Identical subtrees in different chains are then rendered, and their messages counted, once
+per priority cutoff.
+"""
+
+# (subtree hash, priority cutoff, effective priority of the subtree root)
+MemoKey = tuple[bytes, int, int]
+# (counter name, number of the counter instance)
+CounterKey = tuple[str, int]
+
+# Nodes whose rendered text only depends on their fields and children
+MEMOIZED_TYPES = (
+    NodeType.CHAT,
+    NodeType.SCOPE,
+    NodeType.TOP_K,
+    NodeType.MIN_K,
+    NodeType.NORMALIZE,
+)
+HASHED_FIELDS = ("type", "priority", "role", "top_k", "min_k")
+
+
+def text_hash(text: str) -> bytes:
+    """Text leaves are prefixed so that their hashes never collide with those of nodes"""
+    return content_hash(text, prefix=b"t")
+
+
+def node_hash(fields: bytes, child_hashes: list[bytes]) -> bytes:
+    """Children hashes have a fixed size, so prefixing the length of the fields keeps the encoding unambiguous"""
+    return hashlib.blake2b(
+        b"n" + len(fields).to_bytes(8, "little") + fields + b"".join(child_hashes),
+        digest_size=16,
+    ).digest()
+
+
+_counter_numbers: weakref.WeakKeyDictionary[TokenCounter, int] = (
+    weakref.WeakKeyDictionary()
+)
+_next_counter_number = itertools.count()
+_counter_lock = threading.Lock()
+
+
+def counter_key(token_counter: TokenCounter) -> CounterKey:
+    """
+    Counts are only shared between chains using the same counter instance. Two instances of one class can be set
+    up to count differently, and numbers are never reused, unlike `id`s of collected counters
+    """
+    with _counter_lock:
+        if token_counter not in _counter_numbers:
+            _counter_numbers[token_counter] = next(_next_counter_number)
+        return token_counter.name, _counter_numbers[token_counter]
+
+
+class SubtreeMemo:
+    """
+    Bounded LRU table from a subtree at a cutoff to its rendered text and, for chat messages, token counts.
+    Counts are stored per token counter instance and are of the finished message content.
+    Entries are evicted least recently used first once there are more than `max_entries` of them
+    or their text adds up to more than `max_characters`.
+    """
+
+    def __init__(
+        self, max_entries: int = 100_000, max_characters: int = 64_000_000
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_characters = max_characters
+        self._entries: OrderedDict[MemoKey, tuple[str, dict[CounterKey, int]]] = (
+            OrderedDict()
+        )
+        self._characters = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_text(self, key: MemoKey) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put_text(self, key: MemoKey, text: str) -> None:
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (text, {})
+            self._characters += len(text)
+            while self._entries and (
+                len(self._entries) > self.max_entries
+                or self._characters > self.max_characters
+            ):
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._characters -= len(evicted)
+
+    def get_count(self, key: MemoKey, token_counter: TokenCounter) -> Optional[int]:
+        counter = counter_key(token_counter)
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None else entry[1].get(counter)
+
+    def put_count(self, key: MemoKey, token_counter: TokenCounter, count: int) -> None:
+        """Counts are only kept alongside text, so they are dropped if the text was evicted"""
+        counter = counter_key(token_counter)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1][counter] = count
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._characters = 0
+
+
+subtree_memo = SubtreeMemo()
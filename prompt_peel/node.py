@@ -1,10 +1,41 @@
 from enum import Enum
-from typing import Literal, TypedDict, Union
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Literal,
+    Mapping,
+    NotRequired,
+    Optional,
+    TypedDict,
+    Union,
+)
 
-from prompt_peel.message import Role
+from prompt_peel.message import ChatMessage, Role
 
-NonChatNode = Union[str, "ScopeNode", "TopKNode", "EmptyNode"]
-Node = Union[NonChatNode, "ChatNode", list[NonChatNode], list["ChatNode"]]
+NonChatNode = Union[
+    str,
+    "ScopeNode",
+    "TopKNode",
+    "EmptyNode",
+    "TruncateNode",
+    "LazyNode",
+    "FileNode",
+    "ChunkedNode",
+    "ImageNode",
+    "DedupNode",
+    "NormalizeNode",
+    "JsonArrayNode",
+]
+Node = Union[
+    NonChatNode,
+    "ChatNode",
+    "HistoryNode",
+    "ToolNode",
+    list[NonChatNode],
+    list["ChatNode"],
+    list[Union["ChatNode", "HistoryNode", "ToolNode"]],
+]
 
 
 class NodeType(Enum):
@@ -13,6 +44,16 @@ class NodeType(Enum):
     TOP_K = "top_k"
     MIN_K = "min_k"
     EMPTY = "empty"
+    TRUNCATE = "truncate"
+    LAZY = "lazy"
+    FILE = "file"
+    CHUNKED = "chunked"
+    HISTORY = "history"
+    TOOL = "tool"
+    IMAGE = "image"
+    DEDUP = "dedup"
+    NORMALIZE = "normalize"
+    JSON_ARRAY = "json_array"
 
 
 class NodeBase(TypedDict):
@@ -23,14 +64,19 @@ class ParentNode(NodeBase):
     children: list[NonChatNode]
 
 
+# Token limit on the content of a message or scope: a number of tokens, or a share of the token space when a float
+TokenCap = Union[int, float]
+
+
 class ChatNode(ParentNode):
     type: Literal[NodeType.CHAT]
     role: Role
+    cap: NotRequired[TokenCap]
 
 
 class ScopeNode(ParentNode):
     type: Literal[NodeType.SCOPE]
-    pass
+    cap: NotRequired[TokenCap]
 
 
 class TopKNode(ParentNode):
@@ -43,16 +89,234 @@ class MinKNode(ParentNode):
     min_k: int
 
 
+class DedupNode(ParentNode):
+    type: Literal[NodeType.DEDUP]
+    threshold: float
+
+
+class NormalizeNode(ParentNode):
+    type: Literal[NodeType.NORMALIZE]
+
+
 class EmptyNode(NodeBase):
     type: Literal[NodeType.EMPTY]
     tokens: int
 
 
-def is_type(node: Union[ChatNode, NonChatNode], *desired_types: NodeType) -> bool:
+class TruncateNode(NodeBase):
+    type: Literal[NodeType.TRUNCATE]
+    text: str
+    keep: Literal["head", "tail"]
+
+
+class LazyNode(NodeBase):
+    type: Literal[NodeType.LAZY]
+    provider: Callable[[], Union[str, Awaitable[str]]]
+    tokens: int
+
+
+class FileNode(NodeBase):
+    type: Literal[NodeType.FILE]
+    path: str
+    start: int
+    end: Optional[int]
+    encoding: str
+
+
+class ChunkedNode(NodeBase):
+    type: Literal[NodeType.CHUNKED]
+    text: str
+    chunk_tokens: int
+    overlap: int
+    priority_fn: Optional[Callable[[int, int], int]]
+    top_k: Optional[int]
+
+
+class HistoryNode(NodeBase):
+    type: Literal[NodeType.HISTORY]
+    turns: list[ChatMessage]
+
+
+class ToolNode(NodeBase):
+    type: Literal[NodeType.TOOL]
+    name: str
+    description: str
+    parameters: dict[str, Any]
+
+
+class ImageNode(NodeBase):
+    type: Literal[NodeType.IMAGE]
+    source: Union[str, bytes]  # Path to an image file or the image itself
+    formula: Callable[
+        [int, int], int
+    ]  # Token cost of an image from its width and height
+
+
+class JsonArrayNode(NodeBase):
+    type: Literal[NodeType.JSON_ARRAY]
+    elements: list[str]  # Each element serialized as JSON
+    priorities: list[int]
+    indent: Optional[int]
+
+
+class CompactNode:
+    """
+    Slotted alternative to the TypedDict nodes for very large chains. A slotted object has no per-instance dict,
+    which makes it a fraction of the size of the equivalent dict node.
+    Subscript access is kept so that `Chain` can traverse both representations: `node["priority"]` reads the
+    attribute and `"priority" in node` checks the declared fields. This saves memory, not traversal time.
+    Compact nodes are immutable so that subtrees can safely be shared between chains.
+    """
+
+    __slots__ = ("type", "priority")
+    fields: frozenset[str] = frozenset(__slots__)
+
+    __getitem__ = object.__getattribute__
+
+    def __init__(self, **fields: Any) -> None:
+        for key, value in fields.items():
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.fields
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, CompactNode):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
+
+    def to_dict(self) -> dict[str, Any]:
+        return {key: self[key] for key in self.fields}
+
+
+class CompactParentNode(CompactNode):
+    __slots__ = ("children",)
+    fields = CompactNode.fields | frozenset(__slots__)
+
+
+class CompactChatNode(CompactParentNode):
+    __slots__ = ("role",)
+    fields = CompactParentNode.fields | frozenset(__slots__)
+
+
+class CompactCappedChatNode(CompactChatNode):
+    __slots__ = ("cap",)
+    fields = CompactChatNode.fields | frozenset(__slots__)
+
+
+class CompactCappedScopeNode(CompactParentNode):
+    __slots__ = ("cap",)
+    fields = CompactParentNode.fields | frozenset(__slots__)
+
+
+class CompactTopKNode(CompactParentNode):
+    __slots__ = ("top_k",)
+    fields = CompactParentNode.fields | frozenset(__slots__)
+
+
+class CompactMinKNode(CompactParentNode):
+    __slots__ = ("min_k",)
+    fields = CompactParentNode.fields | frozenset(__slots__)
+
+
+class CompactDedupNode(CompactParentNode):
+    __slots__ = ("threshold",)
+    fields = CompactParentNode.fields | frozenset(__slots__)
+
+
+class CompactEmptyNode(CompactNode):
+    __slots__ = ("tokens",)
+    fields = CompactNode.fields | frozenset(__slots__)
+
+
+class CompactTruncateNode(CompactNode):
+    __slots__ = ("text", "keep")
+    fields = CompactNode.fields | frozenset(__slots__)
+
+
+class CompactLazyNode(CompactNode):
+    __slots__ = ("provider", "tokens")
+    fields = CompactNode.fields | frozenset(__slots__)
+
+
+class CompactFileNode(CompactNode):
+    __slots__ = ("path", "start", "end", "encoding")
+    fields = CompactNode.fields | frozenset(__slots__)
+
+
+class CompactChunkedNode(CompactNode):
+    __slots__ = ("text", "chunk_tokens", "overlap", "priority_fn", "top_k")
+    fields = CompactNode.fields | frozenset(__slots__)
+
+
+class CompactHistoryNode(CompactNode):
+    __slots__ = ("turns",)
+    fields = CompactNode.fields | frozenset(__slots__)
+
+
+class CompactToolNode(CompactNode):
+    __slots__ = ("name", "description", "parameters")
+    fields = CompactNode.fields | frozenset(__slots__)
+
+
+class CompactImageNode(CompactNode):
+    __slots__ = ("source", "formula")
+    fields = CompactNode.fields | frozenset(__slots__)
+
+
+class CompactJsonArrayNode(CompactNode):
+    __slots__ = ("elements", "priorities", "indent")
+    fields = CompactNode.fields | frozenset(__slots__)
+
+
+COMPACT_NODE_TYPES: dict[NodeType, type[CompactNode]] = {
+    NodeType.CHAT: CompactChatNode,
+    NodeType.SCOPE: CompactParentNode,
+    NodeType.TOP_K: CompactTopKNode,
+    NodeType.MIN_K: CompactMinKNode,
+    NodeType.EMPTY: CompactEmptyNode,
+    NodeType.TRUNCATE: CompactTruncateNode,
+    NodeType.LAZY: CompactLazyNode,
+    NodeType.FILE: CompactFileNode,
+    NodeType.CHUNKED: CompactChunkedNode,
+    NodeType.HISTORY: CompactHistoryNode,
+    NodeType.TOOL: CompactToolNode,
+    NodeType.IMAGE: CompactImageNode,
+    NodeType.DEDUP: CompactDedupNode,
+    NodeType.NORMALIZE: CompactParentNode,
+    NodeType.JSON_ARRAY: CompactJsonArrayNode,
+}
+
+
+# Caps are rare, so capped nodes get their own classes rather than an empty slot on every message and scope
+COMPACT_CAPPED_NODE_TYPES: dict[NodeType, type[CompactNode]] = {
+    NodeType.CHAT: CompactCappedChatNode,
+    NodeType.SCOPE: CompactCappedScopeNode,
+}
+
+
+def to_compact(node: Mapping[str, Any]) -> CompactNode:
+    """Convert a dict node into its slotted equivalent. Children are expected to be converted already"""
+    if "cap" in node:
+        return COMPACT_CAPPED_NODE_TYPES[node["type"]](**node)
+    return COMPACT_NODE_TYPES[node["type"]](**node)
+
+
+def is_type(
+    node: Union[ChatNode, HistoryNode, ToolNode, NonChatNode], *desired_types: NodeType
+) -> bool:
     """
     Similar to TypeScript, we introduce a type attribute to discern between node types
     We can't simply call isinstance as nodes are TypedDict and it isn't supported in python
     """
     if isinstance(node, str):
         return False
+    if isinstance(node, CompactNode):
+        return node.type in desired_types
     return "type" in node and node["type"] in desired_types
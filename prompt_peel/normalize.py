@@ -0,0 +1,104 @@
+import re
+import textwrap
+import threading
+from collections import OrderedDict
+
+from prompt_peel.token_cache import content_hash
+from prompt_peel.token_counter import TokenCounter
+
+"""
+Whitespace and markup normalization for `Normalize` nodes.
+Collapses whitespace that costs tokens without changing what the text says: trailing spaces, runs of blank lines,
+runs of spaces between words, common indentation and markdown table padding. Fenced code blocks are kept as is.
+Results are cached by content hash in a table bounded by total characters, so normalizing the same text again is free.
+Tokens saved are cached by counter name and content hash in a table bounded by entries.
+"""
+
+CODE_BLOCK = re.compile(
+    r"^([ \t]*)(`{3,}|~{3,}).*?(?:^\1\2[^\n]*$|\Z)", re.DOTALL | re.MULTILINE
+)
+TRAILING_SPACE = re.compile(r"[ \t]+$", re.MULTILINE)
+BLANK_LINES = re.compile(r"\n{3,}")
+INNER_SPACE = re.compile(r"(?<=\S)[ \t]{2,}(?=\S)")
+TABLE_ROW = re.compile(r"^[ \t]*\|.*\|[ \t]*$", re.MULTILINE)
+TABLE_DELIMITER_CELL = re.compile(r"^\s*(:?)-+(:?)\s*$")
+TABLE_CELL_SEPARATOR = re.compile(r"(?<!\\)\|")
+
+MAX_CACHED_COUNTS = (
+    100_000  # Saved token counts kept per process, least recently used first out
+)
+MAX_CACHED_CHARACTERS = (
+    16_000_000  # Normalized text kept per process, least recently used first out
+)
+_saved_tokens: OrderedDict[tuple[str, bytes], int] = OrderedDict()
+_saved_tokens_lock = threading.Lock()
+_normalized: OrderedDict[bytes, str] = OrderedDict()
+_normalized_characters = 0
+_normalized_lock = threading.Lock()
+
+
+def normalize_text(text: str) -> str:
+    global _normalized_characters
+    key = content_hash(text)
+    with _normalized_lock:
+        if key in _normalized:
+            _normalized.move_to_end(key)
+            return _normalized[key]
+
+    normalized = _normalize_text(text)
+    with _normalized_lock:
+        if key not in _normalized:
+            _normalized[key] = normalized
+            _normalized_characters += len(normalized)
+        while _normalized and _normalized_characters > MAX_CACHED_CHARACTERS:
+            _, evicted = _normalized.popitem(last=False)
+            _normalized_characters -= len(evicted)
+    return normalized
+
+
+def _normalize_text(text: str) -> str:
+    parts = []
+    position = 0
+    for code_block in CODE_BLOCK.finditer(text):
+        parts.append(_normalize_prose(text[position : code_block.start()]))
+        parts.append(code_block.group())
+        position = code_block.end()
+    parts.append(_normalize_prose(text[position:]))
+    return "".join(parts)
+
+
+def count_saved_tokens(text: str, token_counter: TokenCounter) -> int:
+    """Tokens saved by normalizing `text`. Cached by token counter and content hash"""
+    key = (token_counter.name, content_hash(text))
+    with _saved_tokens_lock:
+        if key in _saved_tokens:
+            _saved_tokens.move_to_end(key)
+            return _saved_tokens[key]
+
+    original, normalized = token_counter.count_batch([text, normalize_text(text)])
+    with _saved_tokens_lock:
+        _saved_tokens[key] = original - normalized
+        while len(_saved_tokens) > MAX_CACHED_COUNTS:
+            _saved_tokens.popitem(last=False)
+    return original - normalized
+
+
+def _normalize_prose(text: str) -> str:
+    text = TRAILING_SPACE.sub("", text)
+    text = BLANK_LINES.sub("\n\n", text)
+    text = TABLE_ROW.sub(lambda row: _normalize_table_row(row.group()), text)
+    text = INNER_SPACE.sub(" ", text)
+    return textwrap.dedent(text)
+
+
+def _normalize_table_row(row: str) -> str:
+    indent = row[: len(row) - len(row.lstrip())]
+    cells = TABLE_CELL_SEPARATOR.split(row.strip()[1:-1])
+    normalized = []
+    for cell in cells:
+        delimiter = TABLE_DELIMITER_CELL.match(cell)
+        if delimiter:
+            normalized.append(f"{delimiter.group(1)}---{delimiter.group(2)}")
+        else:
+            normalized.append(" ".join(cell.split()))
+    return indent + "|" + "|".join(normalized) + "|"
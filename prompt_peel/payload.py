@@ -0,0 +1,99 @@
+import base64
+import json
+from typing import Any, Callable, Literal, Optional
+
+from prompt_peel.exceptions import InvalidPromptError
+from prompt_peel.image import RenderedImage
+from prompt_peel.message import ChatMessage
+from prompt_peel.tool import ToolDefinition
+
+"""
+Request bodies for chat completion APIs, built from rendered messages and written by `json.dumps`.
+Output is compact UTF-8, so non-ASCII text is sent as is rather than as `\\u` escapes that take up to 12 bytes.
+"""
+
+PayloadFormat = Literal["openai", "anthropic"]
+
+
+def encode_payload(
+    messages: list[ChatMessage],
+    format: PayloadFormat,
+    tools: Optional[list[ToolDefinition]] = None,
+    images: Optional[dict[int, list[RenderedImage]]] = None,
+) -> bytes:
+    """
+    `openai`: `{"messages": [...], "tools": [...]}`
+    `anthropic`: `{"system": "...", "messages": [...], "tools": [...]}`, as Anthropic takes system prompts outside
+    the messages. System messages are joined by blank lines.
+    Fields are left out when there is no system prompt or there are no tools.
+    `images` maps message indices to their images, which turn the content of those messages into a list of parts.
+    """
+    images = images or {}
+    body: dict[str, Any] = {}
+    if format == "openai":
+        body["messages"] = [
+            _message(message, images.get(index, []), _openai_image)
+            for index, message in enumerate(messages)
+        ]
+        if tools:
+            body["tools"] = [{"type": "function", "function": tool} for tool in tools]
+
+    elif format == "anthropic":
+        system = [
+            message["content"] for message in messages if message["role"] == "system"
+        ]
+        if system:
+            body["system"] = "\n\n".join(system)
+        body["messages"] = [
+            _message(message, images.get(index, []), _anthropic_image)
+            for index, message in enumerate(messages)
+            if message["role"] != "system"
+        ]
+        if tools:
+            body["tools"] = [
+                {
+                    "name": tool["name"],
+                    "description": tool["description"],
+                    "input_schema": tool["parameters"],
+                }
+                for tool in tools
+            ]
+
+    else:
+        raise InvalidPromptError(f"Unknown payload format '{format}'")
+
+    return json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode(
+        "utf-8", "surrogatepass"
+    )
+
+
+def _message(
+    message: ChatMessage,
+    images: list[RenderedImage],
+    image_part: Callable[[RenderedImage], dict[str, Any]],
+) -> dict[str, Any]:
+    if not images:
+        return message  # type: ignore
+    content = [image_part(image) for image in images]
+    if message["content"]:
+        content.append({"type": "text", "text": message["content"]})
+    return {"role": message["role"], "content": content}
+
+
+def _openai_image(image: RenderedImage) -> dict[str, Any]:
+    data = base64.b64encode(image["data"]).decode("ascii")
+    return {
+        "type": "image_url",
+        "image_url": {"url": f"data:{image['media_type']};base64,{data}"},
+    }
+
+
+def _anthropic_image(image: RenderedImage) -> dict[str, Any]:
+    return {
+        "type": "image",
+        "source": {
+            "type": "base64",
+            "media_type": image["media_type"],
+            "data": base64.b64encode(image["data"]).decode("ascii"),
+        },
+    }
@@ -0,0 +1,38 @@
+from typing import TYPE_CHECKING, Any
+
+"""
+Vectorized relevance scoring for retrieved chunks. Requires NumPy (`pip install prompt-peel[vectors]`).
+"""
+
+if TYPE_CHECKING:
+    import numpy as np
+    import numpy.typing as npt
+
+
+def select_relevant(
+    query: "npt.ArrayLike", embeddings: "npt.ArrayLike", k: int
+) -> tuple["npt.NDArray[np.intp]", "npt.NDArray[Any]"]:
+    """
+    Indices and scores of the `k` rows of `embeddings` with the highest dot product with `query`, most relevant first.
+    All rows are scored in one matrix-vector product and selected in linear time with `argpartition`.
+    Normalize the embeddings and query to score by cosine similarity.
+    """
+    try:
+        import numpy as np
+    except ImportError as error:
+        raise ImportError(
+            "Relevance scoring requires NumPy. Install it with `pip install prompt-peel[vectors]`"
+        ) from error
+
+    scores = np.asarray(embeddings) @ np.asarray(query)
+    if k <= 0:
+        return np.empty(0, dtype=np.intp), scores[:0]
+
+    if k < len(scores):
+        indices = np.argpartition(-scores, k - 1)[:k]
+    else:
+        indices = np.arange(len(scores))
+
+    # Only the selected rows are sorted
+    indices = indices[np.argsort(-scores[indices], kind="stable")]
+    return indices, scores[indices]
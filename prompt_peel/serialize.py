@@ -0,0 +1,217 @@
+import json
+import sys
+from typing import Any, Union
+
+from prompt_peel.dsl import (
+    MessageBuilder,
+    assistant_message,
+    chunked,
+    dedup,
+    empty,
+    file,
+    history,
+    image,
+    json_array,
+    min_k,
+    normalize,
+    scope,
+    system_message,
+    tool,
+    top_k,
+    truncate,
+    user_message,
+)
+from prompt_peel.exceptions import InvalidPromptError, UnknownNodeError
+from prompt_peel.image import IMAGE_FORMULAS
+from prompt_peel.node import CompactNode, NodeType, NonChatNode, is_type
+
+"""
+JSON encoding of chains, e.g. to render chain definitions produced by data pipelines.
+A node is a JSON object with the fields of its TypedDict in `prompt_peel/node.py` and `type` set to the
+`NodeType` value. Strings are text. `priority` is optional everywhere, as in the DSL:
+
+    {"type": "chat", "role": "user", "children": ["Hello ", {"type": "scope", "priority": 5, "children": ["world"]}]}
+
+Lazy nodes and chunk priority functions wrap Python callables, so they have no JSON encoding. Images are read
+from `path` and their `formula` is named by a key of `IMAGE_FORMULAS`.
+`chain_to_json` is the inverse of `chain_from_json`, e.g. to send chains built with the DSL to a render daemon.
+"""
+
+MESSAGE_BUILDERS = {
+    "system": system_message,
+    "user": user_message,
+    "assistant": assistant_message,
+}
+
+
+def chain_from_json(elements: Any) -> list[MessageBuilder]:
+    """Decode the top level elements of a chain: chat messages, `Empty` nodes, history and tools"""
+    if not isinstance(elements, list):
+        raise InvalidPromptError(f"Chain elements must be a list, not {elements!r}")
+
+    nodes = [node_from_json(element) for element in elements]
+    for node in nodes:
+        if not is_type(
+            node, NodeType.CHAT, NodeType.EMPTY, NodeType.HISTORY, NodeType.TOOL
+        ):
+            raise InvalidPromptError(
+                f"Only chat, empty, history and tool nodes can be top level elements, not {node!r}"
+            )
+    return nodes  # type: ignore
+
+
+def node_from_json(data: Any) -> Union[MessageBuilder, NonChatNode]:
+    if isinstance(data, str):
+        return data
+    if not isinstance(data, dict):
+        raise InvalidPromptError(f"Nodes must be strings or objects, not {data!r}")
+
+    node_type = _field(data, "type")
+    priority = data.get("priority", sys.maxsize)
+    children = [node_from_json(child) for child in data.get("children", [])]
+
+    if node_type == NodeType.CHAT.value:
+        role = _field(data, "role")
+        if role not in MESSAGE_BUILDERS:
+            raise InvalidPromptError(f"Unknown chat role '{role}'")
+        return MESSAGE_BUILDERS[role](*children, priority=priority, cap=data.get("cap"))  # type: ignore
+
+    if node_type == NodeType.SCOPE.value:
+        return scope(*children, priority=priority, cap=data.get("cap"))  # type: ignore
+
+    if node_type == NodeType.TOP_K.value:
+        return top_k(*children, top_k_value=_field(data, "top_k"), priority=priority)  # type: ignore
+
+    if node_type == NodeType.MIN_K.value:
+        return min_k(*children, min_k_value=_field(data, "min_k"), priority=priority)  # type: ignore
+
+    if node_type == NodeType.DEDUP.value:
+        return dedup(*children, threshold=data.get("threshold", 0.8), priority=priority)  # type: ignore
+
+    if node_type == NodeType.NORMALIZE.value:
+        return normalize(*children, priority=priority)  # type: ignore
+
+    if node_type == NodeType.EMPTY.value:
+        return empty(_field(data, "tokens"), priority=priority)
+
+    if node_type == NodeType.TRUNCATE.value:
+        return truncate(
+            _field(data, "text"), priority=priority, keep=data.get("keep", "head")
+        )
+
+    if node_type == NodeType.FILE.value:
+        return file(
+            _field(data, "path"),
+            start=data.get("start", 0),
+            end=data.get("end"),
+            encoding=data.get("encoding", "utf-8"),
+            priority=priority,
+        )
+
+    if node_type == NodeType.CHUNKED.value:
+        return chunked(
+            _field(data, "text"),
+            chunk_tokens=_field(data, "chunk_tokens"),
+            overlap=data.get("overlap", 0),
+            top_k_value=data.get("top_k"),
+            priority=priority,
+        )
+
+    if node_type == NodeType.HISTORY.value:
+        return history(*_turns(data), priority=priority)
+
+    if node_type == NodeType.TOOL.value:
+        return tool(
+            _field(data, "name"),
+            data.get("description", ""),
+            data.get("parameters", {}),
+            priority=priority,
+        )
+
+    if node_type == NodeType.IMAGE.value:
+        formula = data.get("formula", "openai")
+        if formula not in IMAGE_FORMULAS:
+            raise InvalidPromptError(f"Unknown image formula '{formula}'")
+        return image(_field(data, "path"), IMAGE_FORMULAS[formula], priority=priority)
+
+    if node_type == NodeType.JSON_ARRAY.value:
+        return json_array(
+            _field(data, "items"),
+            data.get("priorities"),
+            data.get("indent"),
+            priority=priority,
+        )
+
+    if node_type == NodeType.LAZY.value:
+        raise InvalidPromptError(
+            "Lazy nodes wrap a Python provider and cannot be decoded from JSON"
+        )
+
+    raise UnknownNodeError(f"Unknown node type '{node_type}'")
+
+
+def chain_to_json(elements: list[MessageBuilder]) -> list[Any]:
+    return [node_to_json(element) for element in elements]
+
+
+def node_to_json(node: Union[MessageBuilder, NonChatNode]) -> Any:
+    if isinstance(node, str):
+        return node
+
+    fields: dict[str, Any] = (
+        node.to_dict() if isinstance(node, CompactNode) else dict(node)
+    )
+    node_type: NodeType = fields.pop("type")
+    if fields.get("priority") == sys.maxsize:
+        del fields["priority"]
+
+    if node_type == NodeType.LAZY:
+        raise InvalidPromptError(
+            "Lazy nodes wrap a Python provider and cannot be encoded as JSON"
+        )
+
+    if node_type == NodeType.CHUNKED:
+        if fields.pop("priority_fn") is not None:
+            raise InvalidPromptError(
+                "Chunk priority functions are Python callables and cannot be encoded as JSON"
+            )
+
+    if node_type == NodeType.IMAGE:
+        source = fields.pop("source")
+        formula = fields.pop("formula")
+        names = [name for name, known in IMAGE_FORMULAS.items() if known is formula]
+        if not isinstance(source, str) or not names:
+            raise InvalidPromptError(
+                "Only images read from a path with a formula from IMAGE_FORMULAS can be encoded as JSON"
+            )
+        fields.update(path=source, formula=names[0])
+
+    if node_type == NodeType.JSON_ARRAY:
+        fields["items"] = [json.loads(element) for element in fields.pop("elements")]
+
+    if "children" in fields:
+        fields["children"] = [node_to_json(child) for child in fields["children"]]
+
+    return {"type": node_type.value, **fields}
+
+
+def _turns(data: dict[str, Any]) -> list[Any]:
+    turns = _field(data, "turns")
+    if not isinstance(turns, list) or not all(
+        [
+            isinstance(turn, dict)
+            and isinstance(turn.get("role"), str)
+            and isinstance(turn.get("content"), str)
+            for turn in turns
+        ]
+    ):
+        raise InvalidPromptError(
+            f"History turns must be objects with a string 'role' and 'content': {turns!r}"
+        )
+    return turns
+
+
+def _field(data: dict[str, Any], key: str) -> Any:
+    if key not in data:
+        raise InvalidPromptError(f"Node is missing '{key}': {data}")
+    return data[key]
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Optional, Union
+
+from prompt_peel.token_counter import TokenCounter
+
+"""
+Persistent token counts shared between processes.
+Counts are stored in SQLite keyed by (token counter name, content hash), so workers that restart or run side by
+side on one host only tokenize each piece of text once.
+"""
+
+
+def content_hash(text: str, prefix: bytes = b"") -> bytes:
+    """16 byte blake2b digest of the text. Every cache keyed by content uses it"""
+    return hashlib.blake2b(
+        prefix + text.encode("utf-8", errors="surrogatepass"), digest_size=16
+    ).digest()
+
+
+class SqliteTokenCache:
+    """
+    Token counts in a SQLite database. WAL journaling lets any number of processes read while one writes.
+    Once more than `max_entries` counts are stored, the oldest are evicted first.
+    The cache is best effort: if the database is locked or unwritable, lookups miss and writes are skipped.
+    """
+
+    batch_size = 500  # Hashes per query, below SQLite's limit on bound parameters
+
+    def __init__(
+        self,
+        path: Union[str, os.PathLike[str]],
+        max_entries: int = 1_000_000,
+        timeout: float = 5.0,
+    ) -> None:
+        self.path = os.fspath(path)
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._local = threading.local()
+
+        connection = self._connect()
+        if connection is not None:
+            try:
+                with connection:
+                    connection.execute(
+                        "CREATE TABLE IF NOT EXISTS token_counts ("
+                        " id INTEGER PRIMARY KEY,"
+                        " name TEXT NOT NULL,"
+                        " hash BLOB NOT NULL,"
+                        " tokens INTEGER NOT NULL,"
+                        " UNIQUE (name, hash))"
+                    )
+            except sqlite3.Error:
+                pass
+
+    def get_many(self, name: str, hashes: list[bytes]) -> dict[bytes, int]:
+        connection = self._connect()
+        if connection is None:
+            return {}
+
+        found: dict[bytes, int] = {}
+        try:
+            for start in range(0, len(hashes), self.batch_size):
+                batch = hashes[start : start + self.batch_size]
+                rows = connection.execute(
+                    "SELECT hash, tokens FROM token_counts WHERE name = ?"
+                    f" AND hash IN ({','.join('?' * len(batch))})",
+                    [name, *batch],
+                )
+                found.update(rows)
+        except sqlite3.Error:
+            pass
+        return found
+
+    def put_many(self, name: str, counts: dict[bytes, int]) -> None:
+        connection = self._connect()
+        if connection is None or not counts:
+            return
+
+        try:
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO token_counts (name, hash, tokens) VALUES (?, ?, ?)",
+                    [(name, digest, tokens) for digest, tokens in counts.items()],
+                )
+                # Ids only grow, so everything more than `max_entries` ids behind the newest row is the oldest data
+                connection.execute(
+                    "DELETE FROM token_counts WHERE id <= (SELECT max(id) FROM token_counts) - ?",
+                    (self.max_entries,),
+                )
+        except sqlite3.Error:
+            pass
+
+    def clear(self) -> None:
+        connection = self._connect()
+        if connection is not None:
+            with connection:
+                connection.execute("DELETE FROM token_counts")
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        # SQLite connections cannot be shared between threads or survive a fork, so keep one per thread and process
+        connection: Optional[sqlite3.Connection] = getattr(
+            self._local, "connection", None
+        )
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+
+        try:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+        except sqlite3.Error:
+            return None
+
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+
+
+class CachedTokenCounter(TokenCounter):
+    """
+    Wrap any `TokenCounter` so that counts are looked up in a persistent cache before tokenizing.
+    Texts shorter than `min_chars` are cheaper to tokenize than to look up, so they always go to `token_counter`.
+    """
+
+    def __init__(
+        self,
+        token_counter: TokenCounter,
+        cache: SqliteTokenCache,
+        min_chars: int = 256,
+    ) -> None:
+        self.token_counter = token_counter
+        self.cache = cache
+        self.min_chars = min_chars
+
+    @property
+    def name(self) -> str:
+        return self.token_counter.name
+
+    def count(self, text: str) -> int:
+        return self.count_batch([text])[0]
+
+    def count_batch(self, texts: list[str]) -> list[int]:
+        counts: list[Optional[int]] = [None] * len(texts)
+        hashes: dict[bytes, list[int]] = {}
+        for index, text in enumerate(texts):
+            if len(text) >= self.min_chars:
+                hashes.setdefault(content_hash(text), []).append(index)
+
+        for digest, tokens in self.cache.get_many(self.name, list(hashes)).items():
+            for index in hashes.pop(digest):
+                counts[index] = tokens
+
+        missing = [index for index, count in enumerate(counts) if count is None]
+        for index, tokens in zip(
+            missing, self.token_counter.count_batch([texts[index] for index in missing])
+        ):
+            counts[index] = tokens
+
+        self.cache.put_many(
+            self.name,
+            {digest: counts[indices[0]] for digest, indices in hashes.items()},  # type: ignore
+        )
+        return counts  # type: ignore
+
+    @property
+    def can_tokenize(self) -> bool:
+        return self.token_counter.can_tokenize
+
+    def tokenize(self, text: str) -> list[int]:
+        return self.token_counter.tokenize(text)
+
+    def decode(self, tokens: list[int]) -> str:
+        return self.token_counter.decode(tokens)
+
+    def decode_bytes(self, tokens: list[int]) -> bytes:
+        return self.token_counter.decode_bytes(tokens)
@@ -1,4 +1,8 @@
+import os
+import re
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
 
 from tiktoken import get_encoding
 
@@ -6,20 +10,121 @@ from prompt_peel.message import ChatMessage
 
 
 class TokenCounter(ABC):
+    @property
+    @abstractmethod
+    def name(self) -> str:
+        """
+        Identifies the tokenizer and its configuration, e.g. "cl100k_base". Token counts are cached under this name
+        across chains and processes, so counters that count the same text differently must have different names
+        """
+
     @abstractmethod
     def count(self, text: str) -> int:
         pass
 
+    def count_batch(self, texts: list[str]) -> list[int]:
+        return [self.count(text) for text in texts]
+
+    @property
+    def can_tokenize(self) -> bool:
+        """
+        True if the counter implements `tokenize` and `decode`. Truncate and chunked nodes cut text on token
+        boundaries, so chains holding them are rejected up front by counters that cannot
+        """
+        return (
+            type(self).tokenize is not TokenCounter.tokenize
+            and type(self).decode is not TokenCounter.decode
+        )
+
+    def tokenize(self, text: str) -> list[int]:
+        raise NotImplementedError(
+            f"{type(self).__name__} does not support tokenization"
+        )
+
+    def decode(self, tokens: list[int]) -> str:
+        raise NotImplementedError(f"{type(self).__name__} does not support decoding")
+
+    def decode_bytes(self, tokens: list[int]) -> bytes:
+        """
+        UTF-8 bytes of `tokens`. A token slice can start or end inside a multi-byte character, so text cut on token
+        boundaries is decoded from bytes and the incomplete character at the cut is dropped
+        """
+        return self.decode(tokens).encode("utf-8", "surrogatepass")
+
     def count_prompt(self, prompt: list[ChatMessage]) -> int:
-        return sum([self.count(message["content"]) for message in prompt])
+        return sum(self.count_batch([message["content"] for message in prompt]))
+
+
+# cl100k never merges a newline with a following letter, so text split there counts exactly the same
+SPLIT_BOUNDARY = re.compile(r"\n(?=[^\W\d_])")
 
 
 class Cl100kBaseTokenCounter(TokenCounter):
-    def __init__(self) -> None:
+    """
+    Special tokens are never allowed in prompts, so text is encoded with the "ordinary" path that skips scanning for them.
+    Large batches are split on safe boundaries and encoded across a thread pool as tiktoken releases the GIL.
+    """
+
+    parallel_threshold = (
+        100_000  # Characters in a batch before tokenization is spread across threads
+    )
+    piece_size = 32_000  # Approximate characters per piece handed to a thread
+
+    def __init__(self, max_workers: Optional[int] = None) -> None:
         self.encoding = get_encoding("cl100k_base")
+        self.max_workers = max_workers or min(32, os.cpu_count() or 1)
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def name(self) -> str:
+        return self.encoding.name
 
     def count(self, text: str) -> int:
         return len(self.tokenize(text))
 
+    def count_batch(self, texts: list[str]) -> list[int]:
+        if self.max_workers == 1 or sum(map(len, texts)) < self.parallel_threshold:
+            return [self.count(text) for text in texts]
+
+        pieces: list[str] = []
+        owners: list[int] = []
+        for index, text in enumerate(texts):
+            for piece in split_text(text, self.piece_size):
+                pieces.append(piece)
+                owners.append(index)
+
+        counts = [0] * len(texts)
+        for index, piece_count in zip(
+            owners, self._get_executor().map(self.count, pieces)
+        ):
+            counts[index] += piece_count
+        return counts
+
     def tokenize(self, text: str) -> list[int]:
-        return self.encoding.encode(text)
+        return self.encoding.encode_ordinary(text)
+
+    def decode(self, tokens: list[int]) -> str:
+        return self.encoding.decode(tokens)
+
+    def decode_bytes(self, tokens: list[int]) -> bytes:
+        return self.encoding.decode_bytes(tokens)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="prompt-peel-tokenizer"
+            )
+        return self._executor
+
+
+def split_text(text: str, piece_size: int) -> Iterator[str]:
+    """Split text into pieces of roughly `piece_size` characters without changing how it tokenizes"""
+    start = 0
+    while len(text) - start > piece_size:
+        boundary = SPLIT_BOUNDARY.search(text, start + piece_size)
+        if boundary is None:
+            break
+        yield text[start : boundary.end()]
+        start = boundary.end()
+
+    yield text[start:]
@@ -0,0 +1,56 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, TypedDict
+
+from prompt_peel.node import ToolNode
+from prompt_peel.token_counter import TokenCounter
+
+"""
+Helpers for tool (function calling) definitions.
+The same tools are usually sent with every request, so the token cost of a schema is counted once per process
+and shared between chains. Chains look each tool up once and keep its cost.
+"""
+
+
+class ToolDefinition(TypedDict):
+    name: str
+    description: str
+    parameters: dict[str, Any]
+
+
+MAX_CACHED_SCHEMAS = (
+    4096  # Schema costs kept per process, least recently used first out
+)
+
+_schema_tokens: OrderedDict[tuple[str, bytes], int] = OrderedDict()
+_schema_lock = threading.Lock()
+
+
+def tool_definition(node: ToolNode) -> ToolDefinition:
+    return ToolDefinition(
+        name=node["name"],
+        description=node["description"],
+        parameters=node["parameters"],
+    )
+
+
+def count_tool_tokens(node: ToolNode, token_counter: TokenCounter) -> int:
+    """Tokens of the definition's canonical JSON. Cached by token counter and schema hash"""
+    schema = json.dumps(tool_definition(node), sort_keys=True, separators=(",", ":"))
+    key = (
+        token_counter.name,
+        hashlib.sha256(schema.encode("utf-8", errors="surrogatepass")).digest(),
+    )
+    with _schema_lock:
+        if key in _schema_tokens:
+            _schema_tokens.move_to_end(key)
+            return _schema_tokens[key]
+
+    tokens = token_counter.count(schema)
+    with _schema_lock:
+        _schema_tokens[key] = tokens
+        while len(_schema_tokens) > MAX_CACHED_SCHEMAS:
+            _schema_tokens.popitem(last=False)
+    return tokens
@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from prompt_peel.dsl import lazy, peel, scope, user_message
+from prompt_peel.exceptions import InvalidPromptError
+
+
+@pytest.mark.asyncio
+async def test_async_providers_resolved_concurrently() -> None:
+    # Each provider waits on the other, so this only completes if both run at the same time
+    first_started, second_started = asyncio.Event(), asyncio.Event()
+
+    async def first() -> str:
+        first_started.set()
+        await second_started.wait()
+        return "Hello"
+
+    async def second() -> str:
+        second_started.set()
+        await first_started.wait()
+        return " World"
+
+    actual = await asyncio.wait_for(
+        peel(user_message(lazy(first, tokens=1), lazy(second, tokens=1))).arender(),
+        timeout=1,
+    )
+
+    assert actual == [{"role": "user", "content": "Hello World"}]
+
+
+@pytest.mark.asyncio
+async def test_provider_missing_deadline_is_dropped() -> None:
+    cancelled = asyncio.Event()
+
+    async def slow() -> str:
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        return " slow"
+
+    async def fast() -> str:
+        return "fast"
+
+    actual = await peel(
+        user_message(lazy(fast, tokens=1), lazy(slow, tokens=1)),
+    ).arender(deadline_ms=20)
+
+    assert actual == [{"role": "user", "content": "fast"}]
+    await asyncio.wait_for(cancelled.wait(), timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_dropped_branch_is_never_awaited() -> None:
+    calls = []
+
+    async def provider() -> str:
+        calls.append(1)
+        return "expensive"
+
+    actual = await peel(
+        user_message(
+            scope("hello", priority=10),
+            lazy(provider, tokens=100, priority=1),
+            priority=10,
+        ),
+    ).arender(10)
+
+    assert actual == [{"role": "user", "content": "hello"}]
+    assert calls == []
+
+
+@pytest.mark.asyncio
+async def test_sync_providers_in_arender() -> None:
+    actual = await peel(user_message(lazy(lambda: "Hello", tokens=1))).arender()
+
+    assert actual == [{"role": "user", "content": "Hello"}]
+
+
+def test_render_rejects_async_provider() -> None:
+    async def provider() -> str:
+        return "Hello"
+
+    with pytest.raises(InvalidPromptError):
+        peel(user_message(lazy(provider, tokens=1))).render()
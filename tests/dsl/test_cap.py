@@ -0,0 +1,285 @@
+from typing import Any, Callable, Optional
+
+import pytest
+from pytest_mock import MockerFixture
+from tests.utils import parameterized_messages
+
+from prompt_peel.dsl import (
+    compact_nodes,
+    empty,
+    min_k,
+    scope,
+    system_message,
+    top_k,
+    truncate,
+    user_message,
+)
+from prompt_peel.exceptions import InvalidPromptError, PriorityError
+from prompt_peel.lib import Chain
+from prompt_peel.message import Role
+from prompt_peel.node import ChatNode, CompactNode
+from prompt_peel.serialize import node_from_json
+from prompt_peel.token_counter import TokenCounter
+
+
+class SpaceCounter(TokenCounter):
+    """One token per word, with a tokenizer so that truncate nodes can be cut"""
+
+    @property
+    def name(self) -> str:
+        return "space-counter"
+
+    def count(self, text: str) -> int:
+        return len(text.split())
+
+    def tokenize(self, text: str) -> list[int]:
+        return list(range(len(text.split())))
+
+    def decode(self, tokens: list[int]) -> str:
+        return " word" * len(tokens)
+
+
+def render(elements: list[Any], token_space: int) -> list[str]:
+    chain = Chain(elements, SpaceCounter())
+    return [message["content"] for message in chain.render(token_space)]
+
+
+@parameterized_messages
+def test_message_cap(
+    message_function: Callable[..., ChatNode], expected_role: Role
+) -> None:
+    chain = Chain(
+        [
+            message_function(
+                "rules",
+                scope(" one two", priority=1),
+                scope(" three four", priority=2),
+                cap=3,
+            )
+        ],
+        SpaceCounter(),
+    )
+
+    assert chain.render(100) == [{"role": expected_role, "content": "rules three four"}]
+
+
+def test_other_messages_keep_low_priorities() -> None:
+    actual = render(
+        [
+            system_message(
+                "rules",
+                scope(" one two", priority=1),
+                scope(" three four", priority=2),
+                cap=3,
+            ),
+            user_message("question", scope(" five six", priority=1)),
+        ],
+        100,
+    )
+
+    assert actual == ["rules three four", "question five six"]
+
+
+def test_token_space_cuts_deeper_than_cap() -> None:
+    actual = render(
+        [
+            system_message(
+                "rules",
+                scope(" one two", priority=1),
+                scope(" three four", priority=2),
+                cap=3,
+            ),
+            user_message("question", scope(" five six", priority=2)),
+        ],
+        4,
+    )
+
+    assert actual == ["rules", "question"]
+
+
+def test_scope_cap_share_of_token_space() -> None:
+    chunks = [scope(f" chunk{i}", priority=i) for i in range(10)]
+    elements = [user_message("question", scope(*chunks, cap=0.5))]
+
+    assert render(elements, 8) == ["question chunk6 chunk7 chunk8 chunk9"]
+    assert render(elements, 12) == [
+        "question chunk4 chunk5 chunk6 chunk7 chunk8 chunk9"
+    ]
+
+
+def test_nested_caps() -> None:
+    actual = render(
+        [
+            user_message(
+                scope(
+                    scope("a1", priority=1),
+                    scope(" a2", priority=2),
+                    scope(" a3", priority=3),
+                    cap=1,
+                ),
+                scope(" b1", priority=1),
+                scope(" b2", priority=2),
+                cap=2,
+            )
+        ],
+        100,
+    )
+
+    assert actual == ["a3 b2"]
+
+
+def test_reused_capped_scope() -> None:
+    shared = scope(scope(" x x x", priority=3), scope(" y", priority=8), cap=1)
+
+    assert render([user_message("A:", shared), user_message("B:", shared)], 100) == [
+        "A: y",
+        "B: y",
+    ]
+
+
+def test_reused_capped_scope_under_different_priorities() -> None:
+    shared = scope(scope(" x x", priority=3), scope(" y", priority=8), cap=1)
+    actual = render(
+        [
+            user_message("A:", scope(shared, priority=10)),
+            user_message("B:", scope(shared, priority=6)),
+        ],
+        100,
+    )
+
+    assert actual == ["A: y", "B: y"]
+
+
+def test_cap_with_empty_reservation() -> None:
+    actual = render(
+        [
+            system_message(
+                "rules",
+                empty(2),
+                scope(" one", priority=1),
+                cap=3,
+            )
+        ],
+        100,
+    )
+
+    assert actual == ["rules"]
+
+
+def test_cap_keeps_min_k_children() -> None:
+    actual = render(
+        [
+            system_message(
+                min_k(
+                    scope(" one", priority=1),
+                    scope(" two", priority=2),
+                    scope(" three", priority=3),
+                    min_k_value=2,
+                ),
+                cap=2,
+            )
+        ],
+        100,
+    )
+
+    assert actual == ["three two"]
+
+
+def test_cap_below_required_content() -> None:
+    elements = [
+        system_message(
+            "rules that must stay",
+            scope(" one", priority=1),
+            cap=2,
+        )
+    ]
+
+    with pytest.raises(PriorityError):
+        render(elements, 100)
+
+
+def test_cap_conflicting_with_min_k() -> None:
+    elements = [
+        system_message(
+            min_k(scope(" one", priority=1), scope(" two", priority=2), min_k_value=2),
+            cap=1,
+        )
+    ]
+
+    with pytest.raises(PriorityError):
+        render(elements, 100)
+
+
+def test_truncate_fills_up_to_cap() -> None:
+    actual = render(
+        [
+            system_message("rules", truncate(" a b c d e f"), cap=4),
+            user_message("question"),
+        ],
+        100,
+    )
+
+    assert actual == ["rules word word word", "question"]
+
+
+def test_top_k_inside_capped_scope() -> None:
+    actual = render(
+        [
+            user_message(
+                top_k(
+                    *[scope(f" chunk{i}", priority=i) for i in range(5)],
+                    top_k_value=3,
+                ),
+                cap=2,
+            )
+        ],
+        100,
+    )
+
+    assert actual == ["chunk4 chunk3"]
+
+
+def test_cap_floors_reused_across_renders(mocker: MockerFixture) -> None:
+    chain = Chain(
+        [
+            system_message(
+                "rules",
+                scope(" one two", priority=1),
+                scope(" three four", priority=2),
+                cap=0.5,
+            )
+        ],
+        SpaceCounter(),
+    )
+    searches = mocker.spy(chain, "_find_cap_floor")
+
+    for _ in range(3):
+        assert chain.render(6)[0]["content"] == "rules three four"
+    assert searches.call_count == 1
+
+    assert chain.render(100)[0]["content"] == "rules one two three four"
+    assert searches.call_count == 2
+
+
+def test_compact_capped_nodes() -> None:
+    with compact_nodes():
+        message = system_message(scope("one", cap=1), cap=2)
+
+    assert isinstance(message, CompactNode)
+    assert message["cap"] == 2
+    assert message == system_message(scope("one", cap=1), cap=2)
+    assert "cap" not in system_message("one")
+
+
+def test_cap_from_json() -> None:
+    node = node_from_json(
+        {"type": "chat", "role": "user", "cap": 0.25, "children": ["one"]}
+    )
+
+    assert node == user_message("one", cap=0.25)
+
+
+@pytest.mark.parametrize("cap", [-1, 0.0, 1.5, True, "10"])
+def test_invalid_caps(cap: Optional[Any]) -> None:
+    with pytest.raises(InvalidPromptError):
+        scope("one", cap=cap)
@@ -0,0 +1,129 @@
+import sys
+from typing import Callable
+
+import pytest
+from tests.utils import ByteCounter, RecordingCounter, parameterized_messages
+
+from prompt_peel.dsl import chunked, compact_nodes, peel, user_message
+from prompt_peel.exceptions import InvalidPromptError
+from prompt_peel.lib import Chain
+from prompt_peel.message import Role
+from prompt_peel.node import ChatNode
+
+DOCUMENT = " one two three four five six seven"
+
+
+@parameterized_messages
+def test_chunks_render_whole_document(
+    message_function: Callable[..., ChatNode], expected_role: Role
+) -> None:
+    actual = peel(
+        message_function(chunked(DOCUMENT, chunk_tokens=3)),
+    ).render()
+
+    assert actual == [{"role": expected_role, "content": DOCUMENT.strip()}]
+
+
+def test_chunks_peel_by_priority() -> None:
+    chain = peel(
+        user_message(
+            chunked(
+                DOCUMENT, chunk_tokens=2, priority_fn=lambda index, count: count - index
+            ),
+        ),
+    )
+
+    assert chain.render(4) == [{"role": "user", "content": "one two three four"}]
+    assert chain.render(2) == [{"role": "user", "content": "one two"}]
+
+
+def test_chunks_overlap() -> None:
+    actual = peel(
+        user_message(chunked(" one two three four five", chunk_tokens=3, overlap=1)),
+    ).render()
+
+    assert actual == [{"role": "user", "content": "one two three three four five"}]
+
+
+def test_chunks_top_k() -> None:
+    actual = peel(
+        user_message(
+            chunked(
+                DOCUMENT,
+                chunk_tokens=2,
+                priority_fn=lambda index, count: index,
+                top_k_value=2,
+            ),
+        ),
+    ).render()
+
+    # Highest priority first, as with `top_k`
+    assert actual == [{"role": "user", "content": "seven five six"}]
+
+
+def test_document_tokenized_once_and_dropped_chunks_never_decoded() -> None:
+    counter = RecordingCounter()
+    chain = Chain(
+        [
+            user_message(
+                chunked(DOCUMENT, chunk_tokens=1, priority_fn=lambda i, count: -i),
+            )
+        ],
+        token_counter=counter,
+    )
+
+    assert chain.render(3) == [{"role": "user", "content": "one two three"}]
+    assert counter.tokenized.count(DOCUMENT) == 1
+    assert counter.decoded == 3
+
+
+def test_chunks_reserve_exact_counts() -> None:
+    chain = peel(user_message(chunked(DOCUMENT, chunk_tokens=3)))
+
+    assert chain.token_curve() == [(sys.maxsize, 7)]
+
+
+def test_empty_document_has_no_chunks() -> None:
+    actual = peel(user_message("hello", chunked("", chunk_tokens=3))).render()
+
+    assert actual == [{"role": "user", "content": "hello"}]
+
+
+def test_compact_chunked_node() -> None:
+    with compact_nodes():
+        chain = peel(user_message(chunked(DOCUMENT, chunk_tokens=3)))
+
+    assert chain.render() == [{"role": "user", "content": DOCUMENT.strip()}]
+
+
+def test_chunks_drop_split_characters() -> None:
+    chain = Chain(
+        [user_message(chunked("😀 end", chunk_tokens=3))], token_counter=ByteCounter()
+    )
+
+    assert chain.render() == [{"role": "user", "content": "end"}]
+
+
+@pytest.mark.parametrize("chunk_tokens, overlap", [(0, 0), (3, 3), (3, -1)])
+def test_invalid_chunking(chunk_tokens: int, overlap: int) -> None:
+    with pytest.raises(InvalidPromptError):
+        chunked(DOCUMENT, chunk_tokens=chunk_tokens, overlap=overlap)
+
+
+def test_decoded_chunks_are_never_counted() -> None:
+    counter = RecordingCounter()
+    chain = Chain(
+        [
+            user_message(
+                "Document:",
+                chunked(DOCUMENT, chunk_tokens=2, priority_fn=lambda i, count: -i),
+            )
+        ],
+        token_counter=counter,
+    )
+
+    for token_space in (3, 5, 100):
+        chain.render(token_space)
+
+    assert chain.render(5) == [{"role": "user", "content": "Document: one two"}]
+    assert not any(["one" in text for text in counter.counted])
@@ -0,0 +1,68 @@
+import sys
+
+from prompt_peel.dsl import (
+    compact_nodes,
+    empty,
+    min_k,
+    peel,
+    scope,
+    system_message,
+    top_k,
+    truncate,
+    user_message,
+)
+from prompt_peel.lib import Chain
+from prompt_peel.node import CompactNode, NodeType, is_type
+
+
+def build_chain() -> Chain:
+    return peel(
+        empty(2),
+        system_message(
+            "Context:",
+            top_k(
+                *[scope(f" {i}", priority=100 - i) for i in range(20)],
+                top_k_value=5,
+            ),
+            min_k(scope(" a"), scope(" b", priority=40), min_k_value=1),
+            priority=100,
+        ),
+        user_message(truncate(" one two three four", priority=60), priority=60),
+    )
+
+
+def test_compact_nodes_render_identically() -> None:
+    expected = build_chain()
+    with compact_nodes():
+        actual = build_chain()
+
+    for token_space in [1000, 12, 8, 7]:
+        assert actual.render(token_space) == expected.render(token_space)
+
+
+def test_compact_nodes_are_slotted() -> None:
+    with compact_nodes():
+        node = scope("Hello", priority=1)
+
+    assert isinstance(node, CompactNode)
+    assert not hasattr(node, "__dict__")
+    assert is_type(node, NodeType.SCOPE)
+    assert not is_type(node, NodeType.CHAT)
+    assert node["priority"] == 1
+    assert "children" in node and "tokens" not in node
+    assert node == {"type": NodeType.SCOPE, "priority": 1, "children": ["Hello"]}
+
+
+def test_compact_nodes_are_smaller() -> None:
+    node = empty(10)
+    with compact_nodes():
+        compact = empty(10)
+
+    assert sys.getsizeof(compact) < sys.getsizeof(node)
+
+
+def test_context_restores_dict_nodes() -> None:
+    with compact_nodes():
+        pass
+
+    assert isinstance(scope("Hello"), dict)
@@ -0,0 +1,107 @@
+import pytest
+
+from prompt_peel.dsl import min_k, peel, scope, system_message
+from prompt_peel.exceptions import PriorityError
+from prompt_peel.lib import Chain
+from prompt_peel.message import ChatMessage
+from prompt_peel.token_counter import TokenCounter
+
+
+def numbered_chain() -> Chain:
+    return peel(
+        system_message(
+            *[scope(f"{i + 1} ", priority=10 - i) for i in range(10)],
+            priority=100,
+        ),
+    )
+
+
+def test_generous_deadline_matches_exact_search() -> None:
+    chain = numbered_chain()
+    expected = chain.render(6)
+
+    assert chain.render(6, deadline_ms=60_000) == expected
+    assert chain.last_render_stats is not None
+    assert chain.last_render_stats["degraded"] is False
+    assert chain.last_render_stats["priority"] == 8
+
+
+def indented_chain() -> Chain:
+    # Every leaf is counted with its indent, but the rendered message is de-dented.
+    # The token curve therefore overestimates and predicts fewer items than actually fit
+    return peel(
+        system_message(
+            *[scope(f"\n    {i + 1}", priority=10 - i) for i in range(10)],
+            priority=100,
+        ),
+    )
+
+
+def test_expired_deadline_returns_fitting_render() -> None:
+    chain = indented_chain()
+    actual = chain.render(10, deadline_ms=0)
+
+    assert actual == [{"role": "system", "content": "1\n2"}]
+    assert chain.last_render_stats is not None
+    assert chain.last_render_stats["degraded"] is True
+    assert chain.last_render_stats["evaluated"] == 1
+
+    assert chain.render(10) == [{"role": "system", "content": "1\n2\n3\n4\n5"}]
+
+
+class OverheadCounter(TokenCounter):
+    """Counts words plus a fixed overhead per message, which the token curve does not see"""
+
+    @property
+    def name(self) -> str:
+        return "overhead-counter"
+
+    def count(self, text: str) -> int:
+        return len(text.split())
+
+    def count_prompt(self, prompt: list[ChatMessage]) -> int:
+        return super().count_prompt(prompt) + 3 * len(prompt)
+
+
+def test_search_continues_past_deadline_until_something_fits() -> None:
+    chain = Chain(numbered_chain().prompt_elements, OverheadCounter())
+    actual = chain.render(5, deadline_ms=0)
+
+    assert actual == [{"role": "system", "content": "1 2"}]
+    assert chain.last_render_stats is not None
+    assert chain.last_render_stats["evaluated"] > 1
+
+
+def test_min_k_limits_search_with_deadline() -> None:
+    actual = peel(
+        system_message(
+            min_k(
+                scope("\n1 ", priority=10),
+                scope("\n2 ", priority=10),
+                scope("\n3 ", priority=200),
+                scope("\n4 ", priority=20),
+                scope("\n5 ", priority=100),
+                scope("\n6 ", priority=300),
+                scope("\n7 ", priority=200),
+                scope("\n8 ", priority=400),
+                min_k_value=2,
+            ),
+        )
+    ).render(4, deadline_ms=60_000)
+
+    assert actual == [{"role": "system", "content": "8 \n6"}]
+
+
+def test_error_if_nothing_fits_before_deadline() -> None:
+    with pytest.raises(PriorityError):
+        peel(system_message("1 2 3", priority=1)).render(1, deadline_ms=0)
+
+
+def test_stats_recorded_without_deadline() -> None:
+    chain = numbered_chain()
+    chain.render()
+
+    assert chain.last_render_stats is not None
+    assert chain.last_render_stats["priority"] == 1
+    assert chain.last_render_stats["evaluated"] == 1
+    assert chain.last_render_stats["degraded"] is False
@@ -0,0 +1,97 @@
+import sys
+from collections import OrderedDict
+
+import pytest
+
+import prompt_peel.dedup
+from prompt_peel.dedup import distinct, minhash_signature, similarity
+from prompt_peel.dsl import dedup, peel, scope, user_message
+from prompt_peel.exceptions import InvalidPromptError
+from prompt_peel.token_cache import content_hash
+
+PASSAGE = (
+    "The quick brown fox jumps over the lazy dog while the farmer watches"
+    " from the porch and drinks his morning coffee before the rain starts"
+)
+OVERLAPPING = PASSAGE.replace("morning", "evening")
+OTHER = "Binary search finds the optimal priority in logarithmic time over sorted candidates"
+
+
+def test_near_duplicates_keep_highest_priority() -> None:
+    actual = peel(
+        user_message(
+            dedup(
+                scope(PASSAGE, priority=1),
+                scope("\n" + OTHER, priority=2),
+                scope("\n" + OVERLAPPING, priority=3),
+                threshold=0.6,
+            ),
+        ),
+    ).render()
+
+    assert actual == [{"role": "user", "content": f"{OTHER}\n{OVERLAPPING}"}]
+
+
+def test_distinct_children_are_kept() -> None:
+    actual = peel(user_message(dedup(PASSAGE, " ", OTHER))).render()
+
+    assert actual == [{"role": "user", "content": f"{PASSAGE} {OTHER}"}]
+
+
+def test_duplicates_do_not_use_budget() -> None:
+    chain = peel(
+        user_message(
+            dedup(
+                *[scope(PASSAGE, priority=1) for _ in range(100)], scope(" " + OTHER)
+            ),
+        ),
+    )
+
+    assert chain.render() == [{"role": "user", "content": f"{PASSAGE} {OTHER}"}]
+    assert chain.token_curve()[0] == (1, chain.get_required_tokens(1))
+
+
+def test_similarity_estimate() -> None:
+    same = minhash_signature(PASSAGE)
+    close = minhash_signature(OVERLAPPING)
+    other = minhash_signature(OTHER)
+    assert same is not None and close is not None and other is not None
+
+    assert similarity(same, same) == 1
+    assert similarity(same, close) > 0.6
+    assert similarity(same, other) < 0.2
+
+
+def test_signature_without_numpy(monkeypatch: pytest.MonkeyPatch) -> None:
+    pytest.importorskip("numpy")
+    vectorized = prompt_peel.dedup._minhash_signature(PASSAGE)
+    monkeypatch.setitem(sys.modules, "numpy", None)
+
+    assert prompt_peel.dedup._minhash_signature(PASSAGE) == vectorized
+
+
+def test_signatures_bounded(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(prompt_peel.dedup, "MAX_CACHED_SIGNATURES", 2)
+    monkeypatch.setattr(prompt_peel.dedup, "_signatures", OrderedDict())
+    for text in (PASSAGE, OVERLAPPING, OTHER, PASSAGE):
+        minhash_signature(text)
+
+    assert len(prompt_peel.dedup._signatures) == 2
+    assert list(prompt_peel.dedup._signatures)[-1] == content_hash(PASSAGE)
+
+
+def test_many_chunks() -> None:
+    texts = [f"chunk number {index} about topic {index % 50}" for index in range(3_000)]
+
+    kept = distinct(texts + texts, threshold=0.9)
+
+    assert kept == list(range(3_000))
+
+
+def test_texts_without_words_are_kept() -> None:
+    assert distinct(["", "", "!!"], threshold=0.5) == [0, 1, 2]
+
+
+def test_invalid_threshold() -> None:
+    with pytest.raises(InvalidPromptError):
+        dedup("a", threshold=0)
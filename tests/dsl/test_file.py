@@ -0,0 +1,92 @@
+import json
+import os
+from pathlib import Path
+
+from pytest_mock import MockerFixture
+
+from prompt_peel.dsl import file, peel, scope, user_message
+from prompt_peel.file import SIDECAR_SUFFIX, count_file_tokens, read_file
+from prompt_peel.lib import Chain
+from prompt_peel.token_counter import Cl100kBaseTokenCounter
+
+
+def write(tmp_path: Path, text: str) -> Path:
+    path = tmp_path / "source.txt"
+    path.write_text(text)
+    return path
+
+
+def test_file_content_rendered(tmp_path: Path) -> None:
+    path = write(tmp_path, "one two three")
+    actual = peel(user_message("Read: ", file(path))).render()
+
+    assert actual == [{"role": "user", "content": "Read: one two three"}]
+
+
+def test_byte_range(tmp_path: Path) -> None:
+    path = write(tmp_path, "one two three")
+    actual = peel(user_message(file(path, start=4, end=7))).render()
+
+    assert actual == [{"role": "user", "content": "two"}]
+
+
+def test_empty_file(tmp_path: Path) -> None:
+    path = write(tmp_path, "")
+    actual = peel(user_message("Empty", file(path))).render()
+
+    assert actual == [{"role": "user", "content": "Empty"}]
+
+
+def test_dropped_file_is_never_read(tmp_path: Path, mocker: MockerFixture) -> None:
+    path = write(tmp_path, " one two three four five")
+    count_file_tokens(file(path), Cl100kBaseTokenCounter())
+    spy = mocker.patch("prompt_peel.lib.read_file", wraps=read_file)
+
+    actual = peel(
+        user_message(
+            scope("hello", priority=10),
+            file(path, priority=1),
+            priority=10,
+        )
+    ).render(3)
+
+    assert actual == [{"role": "user", "content": "hello"}]
+    spy.assert_not_called()
+
+
+def test_token_count_cached_next_to_file(tmp_path: Path, mocker: MockerFixture) -> None:
+    path = write(tmp_path, "one two three")
+    counter = Cl100kBaseTokenCounter()
+    spy = mocker.spy(counter, "count_batch")
+
+    assert count_file_tokens(file(path), counter) == 3
+    assert count_file_tokens(file(path), counter) == 3
+    assert spy.call_count == 1
+
+    entries = json.loads(Path(f"{path}{SIDECAR_SUFFIX}").read_text())
+    assert [entry["tokens"] for entry in entries.values()] == [3]
+
+
+def test_modified_file_is_recounted(tmp_path: Path) -> None:
+    path = write(tmp_path, "one two three")
+    counter = Cl100kBaseTokenCounter()
+    assert count_file_tokens(file(path), counter) == 3
+
+    path.write_text("one two three four five")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    assert count_file_tokens(file(path), counter) == 5
+
+
+def test_file_reserves_its_tokens(tmp_path: Path) -> None:
+    path = write(tmp_path, " one two three four five")
+    chain = Chain(
+        [user_message(scope("hello", priority=10), file(path, priority=1))],
+        Cl100kBaseTokenCounter(),
+    )
+
+    assert chain.render(5) == [{"role": "user", "content": "hello"}]
+    assert chain.render(6) == [
+        {"role": "user", "content": "hello one two three four five"}
+    ]
@@ -0,0 +1,90 @@
+from typing import Callable
+
+from tests.utils import RecordingCounter, parameterized_messages
+
+from prompt_peel.dsl import compact_nodes, empty, history, peel, system_message
+from prompt_peel.lib import Chain
+from prompt_peel.message import ChatMessage, Role
+from prompt_peel.node import ChatNode
+
+TURNS: list[ChatMessage] = [
+    {"role": "user", "content": "one"},
+    {"role": "assistant", "content": "two"},
+    {"role": "user", "content": "three"},
+]
+
+
+def test_history_rendered_after_messages() -> None:
+    actual = peel(system_message("Be brief"), history(*TURNS)).render()
+
+    assert actual == [{"role": "system", "content": "Be brief"}, *TURNS]
+
+
+def test_history_drops_oldest_turns_first() -> None:
+    chain = peel(system_message("Be brief"), history(*TURNS, priority=100))
+
+    assert chain.render(4) == [{"role": "system", "content": "Be brief"}, *TURNS[1:]]
+    assert chain.render(3) == [{"role": "system", "content": "Be brief"}, TURNS[2]]
+
+
+def test_history_never_emits_empty_messages() -> None:
+    actual = peel(system_message("Be brief"), history(*TURNS, priority=100)).render(2)
+
+    assert actual == [{"role": "system", "content": "Be brief"}]
+
+
+def test_history_competes_with_priorities() -> None:
+    actual = peel(
+        system_message("Be brief", priority=98),
+        history(*TURNS, priority=100),
+    ).render(2)
+
+    # The system message only outranks the oldest turn. Unlike history turns, chat messages are always emitted
+    assert actual == [{"role": "system", "content": ""}, TURNS[1], TURNS[2]]
+
+
+def test_history_with_empty() -> None:
+    actual = peel(history(*TURNS), empty(2)).render(3)
+
+    assert actual == [TURNS[2]]
+
+
+@parameterized_messages
+def test_history_between_messages(
+    message_function: Callable[..., ChatNode], expected_role: Role
+) -> None:
+    actual = peel(
+        message_function("before"),
+        history(*TURNS, priority=100),
+        message_function("after"),
+    ).render(3)
+
+    assert actual == [
+        {"role": expected_role, "content": "before"},
+        TURNS[2],
+        {"role": expected_role, "content": "after"},
+    ]
+
+
+def test_long_history_fits_in_few_renders() -> None:
+    turns: list[ChatMessage] = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": "one"}
+        for i in range(5_000)
+    ]
+    counter = RecordingCounter()
+    chain = Chain([history(*turns, priority=10_000)], token_counter=counter)
+
+    actual = chain.render(500)
+
+    assert actual == turns[-500:]
+    assert chain.last_render_stats is not None
+    assert chain.last_render_stats["evaluated"] <= 2
+    # Every turn is counted once, in a single batch
+    assert sum([len(batch) for batch in counter.batches]) == len(turns)
+
+
+def test_compact_history() -> None:
+    with compact_nodes():
+        chain = peel(history(*TURNS, priority=100))
+
+    assert chain.render(2) == TURNS[1:]
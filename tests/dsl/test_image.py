@@ -0,0 +1,154 @@
+import json
+import struct
+from base64 import b64encode
+from pathlib import Path
+from typing import Callable
+
+import pytest
+from pytest_mock import MockerFixture
+
+import prompt_peel.lib
+from prompt_peel.dsl import compact_nodes, image, peel, scope, user_message
+from prompt_peel.exceptions import InvalidPromptError
+from prompt_peel.image import (
+    anthropic_image_tokens,
+    image_size,
+    openai_image_tokens,
+    openai_low_detail_image_tokens,
+)
+
+
+def png(width: int, height: int) -> bytes:
+    return (
+        b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR"
+        + struct.pack(">II", width, height)
+        + b"\x08\x02\x00\x00\x00"
+    )
+
+
+def gif(width: int, height: int) -> bytes:
+    return b"GIF89a" + struct.pack("<HH", width, height) + b"\x00" * 20
+
+
+def jpeg(width: int, height: int) -> bytes:
+    app0 = b"\xff\xe0" + struct.pack(">H", 16) + b"JFIF\x00" + b"\x00" * 9
+    start_of_frame = (
+        b"\xff\xc0" + struct.pack(">HBHH", 17, 8, height, width) + b"\x00" * 10
+    )
+    return b"\xff\xd8" + app0 + start_of_frame
+
+
+def webp_lossless(width: int, height: int) -> bytes:
+    bits = (width - 1) | (height - 1) << 14
+    return (
+        b"RIFF\x00\x00\x00\x00WEBPVP8L\x00\x00\x00\x00\x2f"
+        + bits.to_bytes(4, "little")
+        + b"\x00" * 5
+    )
+
+
+def webp_extended(width: int, height: int) -> bytes:
+    return (
+        b"RIFF\x00\x00\x00\x00WEBPVP8X\x0a\x00\x00\x00\x00\x00\x00\x00"
+        + (width - 1).to_bytes(3, "little")
+        + (height - 1).to_bytes(3, "little")
+    )
+
+
+@pytest.mark.parametrize(
+    "encode, image_format",
+    [
+        (png, "png"),
+        (gif, "gif"),
+        (jpeg, "jpeg"),
+        (webp_lossless, "webp"),
+        (webp_extended, "webp"),
+    ],
+)
+def test_image_size(
+    encode: Callable[[int, int], bytes], image_format: str, tmp_path: Path
+) -> None:
+    path = tmp_path / "image"
+    path.write_bytes(encode(640, 480))
+
+    assert image_size(encode(640, 480)) == (image_format, 640, 480)
+    assert image_size(str(path)) == (image_format, 640, 480)
+
+
+def test_unknown_image_format() -> None:
+    with pytest.raises(InvalidPromptError):
+        image_size(b"not an image")
+
+
+def test_formulas() -> None:
+    assert openai_image_tokens(1024, 1024) == 765
+    assert openai_image_tokens(2048, 4096) == 1105
+    assert openai_image_tokens(100, 100) == 255
+    assert openai_low_detail_image_tokens(4096, 4096) == 85
+    assert anthropic_image_tokens(1000, 1000) == 1334
+
+
+def test_image_peeled_by_priority() -> None:
+    chain = peel(
+        user_message(
+            "one", image(png(512, 512), priority=1), scope(" two", priority=2)
+        ),
+    )
+
+    assert chain.render(2) == [{"role": "user", "content": "one two"}]
+    assert chain.render_images() == {}
+
+    assert chain.render(2 + 255) == [{"role": "user", "content": "one two"}]
+    assert chain.render_images() == {
+        0: [{"media_type": "image/png", "data": png(512, 512)}]
+    }
+
+
+def test_dropped_image_is_never_loaded(tmp_path: Path, mocker: MockerFixture) -> None:
+    path = tmp_path / "image.gif"
+    path.write_bytes(gif(4096, 4096))
+    load_image = mocker.spy(prompt_peel.lib, "load_image")
+
+    chain = peel(user_message("one", image(path, priority=1)))
+    chain.render_payload(1)
+
+    assert load_image.call_count == 0
+
+
+def test_images_in_payload() -> None:
+    data = png(512, 512)
+    chain = peel(user_message("one"), user_message("two", image(data)))
+
+    openai = json.loads(chain.render_payload(format="openai"))
+    anthropic = json.loads(chain.render_payload(format="anthropic"))
+
+    encoded = b64encode(data).decode()
+    assert openai["messages"] == [
+        {"role": "user", "content": "one"},
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image_url",
+                    "image_url": {"url": f"data:image/png;base64,{encoded}"},
+                },
+                {"type": "text", "text": "two"},
+            ],
+        },
+    ]
+    assert anthropic["messages"][1]["content"][0] == {
+        "type": "image",
+        "source": {"type": "base64", "media_type": "image/png", "data": encoded},
+    }
+
+
+def test_compact_image() -> None:
+    with compact_nodes():
+        chain = peel(
+            user_message(
+                "one", image(png(512, 512), formula=openai_low_detail_image_tokens)
+            )
+        )
+
+    assert chain.render(86) == [{"role": "user", "content": "one"}]
+    assert list(chain.render_images()) == [0]
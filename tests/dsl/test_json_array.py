@@ -0,0 +1,153 @@
+import json
+import sys
+
+import pytest
+from tests.utils import CharacterCounter
+
+from prompt_peel.dsl import compact_nodes, json_array, peel, user_message
+from prompt_peel.exceptions import InvalidPromptError, PriorityError
+from prompt_peel.lib import Chain
+from prompt_peel.node import CompactNode
+from prompt_peel.serialize import node_from_json, node_to_json
+
+ITEMS = [
+    {"id": 1, "title": "Peeling prompts"},
+    {"id": 2, "title": "Pricing", "tags": ["a", "b"]},
+    {"id": 3, "title": "Ünïcode"},
+    {"id": 4, "title": "Last"},
+]
+
+
+def render(chain: Chain, token_space: int = sys.maxsize) -> str:
+    return chain.render(token_space)[0]["content"]
+
+
+def render_priority(chain: Chain, priority: int) -> str:
+    return chain.render_priority(priority)[0]["content"]
+
+
+def test_renders_like_json_dumps() -> None:
+    chain = peel(user_message(json_array(ITEMS)))
+
+    assert render(chain) == json.dumps(ITEMS, ensure_ascii=False, separators=(",", ":"))
+    assert json.loads(render(chain)) == ITEMS
+
+
+def test_indent_renders_like_json_dumps() -> None:
+    chain = peel(user_message("Results:\n", json_array(ITEMS, indent=2)))
+
+    # Messages are dedented and stripped, which leaves the indented array as is
+    assert render(chain) == "Results:\n" + json.dumps(
+        ITEMS, ensure_ascii=False, indent=2
+    )
+
+
+def test_drops_low_priority_items_as_valid_json() -> None:
+    array = json_array(ITEMS, priorities=[4, 1, 3, 2], priority=10)
+
+    assert [
+        json.loads(render_priority(peel(user_message(array)), priority))
+        for priority in range(1, 6)
+    ] == [
+        ITEMS,
+        [ITEMS[0], ITEMS[2], ITEMS[3]],
+        [ITEMS[0], ITEMS[2]],
+        [ITEMS[0]],
+        [],
+    ]
+
+
+def test_token_space_peels_items() -> None:
+    chain = Chain(
+        [user_message(json_array(ITEMS, priorities=[4, 1, 3, 2], priority=10))],
+        CharacterCounter(),
+    )
+    full = len(json.dumps(ITEMS, ensure_ascii=False, separators=(",", ":")))
+
+    for token_space in range(2, full + 1):
+        rendered = render(chain, token_space)
+        assert len(rendered) <= token_space
+        json.loads(rendered)
+    assert render(chain, full) == json.dumps(
+        ITEMS, ensure_ascii=False, separators=(",", ":")
+    )
+    assert json.loads(render(chain, full - 1)) == [ITEMS[0], ITEMS[2], ITEMS[3]]
+
+
+def test_items_are_counted_once() -> None:
+    counter = CharacterCounter()
+    chain = Chain(
+        [user_message(json_array(ITEMS, priorities=[4, 1, 3, 2]))],
+        counter,
+    )
+    elements = [
+        json.dumps(item, ensure_ascii=False, separators=(",", ":")) for item in ITEMS
+    ]
+
+    for token_space in (20, 60, 100, 200):
+        chain.render(token_space)
+
+    # The search adds up element counts rather than counting candidate arrays
+    assert sorted(counter.counted.count(element) for element in elements) == [1] * 4
+    assert not any(text.startswith("[{") for text in counter.counted)
+
+
+def test_counts_add_up_to_rendered_tokens() -> None:
+    chain = Chain(
+        [user_message(json_array(ITEMS, priorities=[4, 1, 3, 2], indent=4))],
+        CharacterCounter(),
+    )
+
+    for priority in range(1, 6):
+        assert chain.get_required_tokens(priority) == len(
+            render(chain, chain.get_required_tokens(priority))
+        )
+
+
+def test_token_curve() -> None:
+    chain = Chain(
+        [user_message(json_array(ITEMS, priorities=[4, 1, 3, 2], priority=10))],
+        CharacterCounter(),
+    )
+
+    assert chain.get_priorities() == {1, 2, 3, 4, 10, sys.maxsize}
+    assert (
+        chain.get_optimal_priority(chain.get_priorities(), chain.get_required_tokens(3))
+        == 3
+    )
+    assert chain.token_curve()[0][1] >= chain.get_required_tokens(1)
+
+
+def test_compact_nodes() -> None:
+    with compact_nodes():
+        array = json_array(ITEMS, priorities=[4, 1, 3, 2], priority=10)
+
+    assert isinstance(array, CompactNode)
+    assert array == json_array(ITEMS, priorities=[4, 1, 3, 2], priority=10)
+    assert json.loads(render_priority(peel(user_message(array)), 3)) == [
+        ITEMS[0],
+        ITEMS[2],
+    ]
+
+
+def test_json_round_trip() -> None:
+    array = json_array(ITEMS, priorities=[4, 1, 3, 2], indent=2, priority=10)
+    encoded = node_to_json(array)
+
+    assert encoded["items"] == ITEMS
+    assert node_from_json(json.loads(json.dumps(encoded))) == array
+
+
+def test_priorities_must_match_items() -> None:
+    with pytest.raises(InvalidPromptError):
+        json_array(ITEMS, priorities=[1, 2])
+
+
+def test_items_must_be_serializable() -> None:
+    with pytest.raises(InvalidPromptError):
+        json_array([object()])
+
+
+def test_item_priority_above_node() -> None:
+    with pytest.raises(PriorityError):
+        json_array(ITEMS, priorities=[1, 2, 3, 20], priority=10)
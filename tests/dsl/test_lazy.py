@@ -0,0 +1,84 @@
+from typing import Callable
+
+from tests.utils import parameterized_messages
+
+from prompt_peel.dsl import lazy, peel, scope, top_k, user_message
+from prompt_peel.message import Role
+from prompt_peel.node import ChatNode
+
+
+class Provider:
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.calls = 0
+
+    def __call__(self) -> str:
+        self.calls += 1
+        return self.text
+
+
+@parameterized_messages
+def test_lazy_content_rendered(
+    message_function: Callable[..., ChatNode], expected_role: Role
+) -> None:
+    provider = Provider("World")
+    actual = peel(
+        message_function("Hello ", lazy(provider, tokens=1)),
+    ).render()
+
+    assert actual == [{"role": expected_role, "content": "Hello World"}]
+    assert provider.calls == 1
+
+
+def test_dropped_lazy_node_is_never_called() -> None:
+    provider = Provider("expensive")
+    actual = peel(
+        user_message(
+            scope("hello", priority=10),
+            lazy(provider, tokens=100, priority=1),
+            priority=10,
+        ),
+    ).render(10)
+
+    assert actual == [{"role": "user", "content": "hello"}]
+    assert provider.calls == 0
+
+
+def test_lazy_node_outside_top_k_is_never_called() -> None:
+    provider = Provider("expensive")
+    actual = peel(
+        user_message(
+            top_k(
+                scope("kept", priority=10),
+                lazy(provider, tokens=1, priority=1),
+                top_k_value=1,
+            ),
+        ),
+    ).render()
+
+    assert actual == [{"role": "user", "content": "kept"}]
+    assert provider.calls == 0
+
+
+def test_result_memoized_across_renders() -> None:
+    provider = Provider("World")
+    chain = peel(user_message("Hello ", lazy(provider, tokens=1)))
+
+    chain.render()
+    chain.render(10)
+
+    assert provider.calls == 1
+
+
+def test_underestimated_lazy_node_is_peeled() -> None:
+    provider = Provider(" one two three four")
+    actual = peel(
+        user_message(
+            scope("hello", priority=10),
+            lazy(provider, tokens=1, priority=1),
+            priority=10,
+        ),
+    ).render(3)
+
+    assert actual == [{"role": "user", "content": "hello"}]
+    assert provider.calls == 1
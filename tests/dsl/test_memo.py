@@ -0,0 +1,137 @@
+from tests.utils import WordCounter
+
+from prompt_peel.dsl import lazy, peel, scope, top_k, truncate, user_message
+from prompt_peel.lib import Chain
+from prompt_peel.memo import SubtreeMemo, subtree_memo
+from prompt_peel.token_counter import TokenCounter
+
+
+def retrieval_chain(counter: TokenCounter) -> Chain:
+    # Built fresh for every chain, so chains share structure but no node objects
+    chunks = top_k(
+        scope("memo one", priority=1),
+        scope(" memo two", priority=2),
+        scope(" memo three", priority=3),
+        top_k_value=2,
+    )
+    return Chain([user_message(chunks, priority=10)], counter)
+
+
+def test_identical_subtrees_hash_the_same() -> None:
+    first = retrieval_chain(WordCounter())
+    second = retrieval_chain(WordCounter())
+
+    assert first._get_subtree_hash(first.prompt_elements[0]) is not None
+    assert first._get_subtree_hash(
+        first.prompt_elements[0]
+    ) == second._get_subtree_hash(second.prompt_elements[0])
+
+
+def test_hash_depends_on_priorities() -> None:
+    chain = peel(user_message(scope("memo", priority=1), scope("memo", priority=2)))
+    first, second = chain.prompt_elements[0]["children"]  # type: ignore
+
+    assert chain._get_subtree_hash(first) != chain._get_subtree_hash(second)
+
+
+def test_identical_subtrees_counted_once() -> None:
+    subtree_memo.clear()
+    counter = WordCounter()
+    first = retrieval_chain(counter)
+    second = retrieval_chain(counter)
+
+    assert first.get_required_tokens(2) == 4
+    assert counter.counted == ["memo three memo two"]
+
+    assert second.get_required_tokens(2) == 4
+    assert counter.counted == ["memo three memo two"]
+    assert second.render_priority(2) == first.render_priority(2)
+
+
+def test_cutoffs_memoized_separately() -> None:
+    subtree_memo.clear()
+    chain = retrieval_chain(WordCounter())
+
+    assert chain.render_priority(3)[0]["content"] == "memo three"
+    assert chain.render_priority(2)[0]["content"] == "memo three memo two"
+    assert chain.render_priority(3)[0]["content"] == "memo three"
+
+
+def test_chain_dependent_subtrees_not_memoized() -> None:
+    chain = peel(
+        user_message(
+            scope("memo", lazy(lambda: " resolved", tokens=1)),
+            scope("memo", truncate(" truncated", keep="head")),
+            scope("memo"),
+        )
+    )
+    lazy_scope, truncate_scope, text_scope = chain.prompt_elements[0]["children"]  # type: ignore
+
+    assert chain._get_subtree_hash(lazy_scope) is None
+    assert chain._get_subtree_hash(truncate_scope) is None
+    assert chain._get_subtree_hash(text_scope) is not None
+    assert chain._get_subtree_hash(chain.prompt_elements[0]) is None
+
+    assert chain.render()[0]["content"] == "memo resolvedmemo truncatedmemo"
+
+
+def test_counters_with_overhead_count_whole_prompt() -> None:
+    class OverheadCounter(WordCounter):
+        def count_prompt(self, prompt: list) -> int:  # type: ignore
+            return super().count_prompt(prompt) + 3
+
+    subtree_memo.clear()
+    retrieval_chain(WordCounter()).get_required_tokens(2)
+    counter = OverheadCounter()
+
+    assert retrieval_chain(counter).get_required_tokens(2) == 7
+    assert counter.counted == ["memo three memo two"]
+
+
+def test_memo_evicts_least_recently_used() -> None:
+    memo = SubtreeMemo(max_entries=2)
+    memo.put_text((b"a", 0, 0), "a")
+    memo.put_text((b"b", 0, 0), "b")
+    counter = WordCounter()
+    memo.put_count((b"b", 0, 0), counter, 1)
+    assert memo.get_text((b"a", 0, 0)) == "a"
+
+    memo.put_text((b"c", 0, 0), "c")
+    assert memo.get_text((b"b", 0, 0)) is None
+    assert memo.get_count((b"b", 0, 0), counter) is None
+    assert memo.get_text((b"a", 0, 0)) == "a"
+    assert len(memo) == 2
+
+
+def test_memo_bounded_by_characters() -> None:
+    memo = SubtreeMemo(max_characters=5)
+    memo.put_text((b"a", 0, 0), "abc")
+    memo.put_text((b"b", 0, 0), "def")
+
+    assert memo.get_text((b"a", 0, 0)) is None
+    assert memo.get_text((b"b", 0, 0)) == "def"
+
+
+class ScaledCounter(TokenCounter):
+    """Same class and name, counting differently by `scale`"""
+
+    def __init__(self, scale: int) -> None:
+        self.scale = scale
+
+    @property
+    def name(self) -> str:
+        return "scaled-counter"
+
+    def count(self, text: str) -> int:
+        return self.scale * len(text.split())
+
+
+def test_counts_not_shared_between_counter_instances() -> None:
+    def scaled_chain(scale: int) -> Chain:
+        return Chain(
+            [user_message("a b c d", scope(" e f", priority=1), priority=10)],
+            ScaledCounter(scale),
+        )
+
+    assert scaled_chain(1).render(50) == [{"role": "user", "content": "a b c d e f"}]
+    assert scaled_chain(10).render(50) == [{"role": "user", "content": "a b c d"}]
@@ -1,9 +1,10 @@
 from typing import Callable
 
 import pytest
+from pytest_mock import MockerFixture
 from tests.utils import parameterized_messages
 
-from prompt_peel.dsl import min_k, peel, scope
+from prompt_peel.dsl import min_k, peel, scope, system_message
 from prompt_peel.exceptions import InsufficientChildrenError
 from prompt_peel.message import Role
 from prompt_peel.node import ChatNode
@@ -149,3 +150,55 @@ def test_correct_priority_used(
         }
     ]
     assert actual == expected
+
+
+def test_infeasible_priorities_skipped() -> None:
+    # Cutting at priority 25 would keep the MinK node but only one of its children
+    actual = peel(
+        system_message(
+            min_k(
+                scope("a"),
+                scope(" b", priority=5),
+                min_k_value=2,
+                priority=25,
+            ),
+            scope(" c"),
+            priority=100,
+        )
+    ).render(1)
+
+    assert actual == [{"role": "system", "content": "c"}]
+
+
+def test_diagnostic_when_nothing_satisfies_budget_and_min_k() -> None:
+    with pytest.raises(InsufficientChildrenError, match="cannot exceed 20"):
+        peel(
+            system_message(
+                min_k(
+                    scope("0 0", priority=30),
+                    scope("1 1", priority=20),
+                    scope("2 2", priority=10),
+                    min_k_value=2,
+                ),
+            )
+        ).render(3)
+
+
+def test_infeasible_priorities_never_rendered(mocker: MockerFixture) -> None:
+    chain = peel(
+        system_message(
+            min_k(
+                scope("0 0", priority=30),
+                scope("1 1", priority=20),
+                scope("2 2", priority=10),
+                min_k_value=2,
+            ),
+        )
+    )
+    spy = mocker.spy(chain, "_render")
+
+    with pytest.raises(InsufficientChildrenError):
+        chain.render(3)
+
+    assert spy.call_args_list
+    assert all(call.args[0] <= 20 for call in spy.call_args_list)
@@ -0,0 +1,144 @@
+import sys
+from collections import OrderedDict
+
+import pytest
+from tests.utils import CharacterCounter, RecordingCounter
+
+import prompt_peel.normalize
+from prompt_peel.dsl import json_array, normalize, peel, scope, user_message
+from prompt_peel.lib import Chain
+from prompt_peel.normalize import count_saved_tokens, normalize_text
+from prompt_peel.token_cache import content_hash
+
+TABLE = """\
+| Name      | Role        |
+|:----------|------------:|
+| Asim      | Maintainer  |
+"""
+
+CODE = """\
+```python
+def f():
+    return  1    # spacing kept
+
+
+```
+"""
+
+
+def test_whitespace_collapsed() -> None:
+    assert normalize_text("one  two \t\n\n\n\nthree   \n") == "one two\n\nthree\n"
+
+
+def test_common_indentation_removed() -> None:
+    assert normalize_text("    one\n      two\n") == "one\n  two\n"
+
+
+def test_table_padding_removed() -> None:
+    assert normalize_text(TABLE) == "|Name|Role|\n|:---|---:|\n|Asim|Maintainer|\n"
+
+
+def test_escaped_table_pipes_kept() -> None:
+    assert normalize_text("|  a \\| b  |  c |") == "|a \\| b|c|"
+
+
+def test_code_blocks_kept() -> None:
+    assert normalize_text("one   two\n" + CODE + "three   four") == (
+        "one two\n" + CODE + "three four"
+    )
+
+
+def test_unclosed_code_block_kept() -> None:
+    text = "one   two\n~~~\nthree   four\n\n\n\n"
+    assert normalize_text(text) == "one two\n~~~\nthree   four\n\n\n\n"
+
+
+def test_normalize_is_opt_in() -> None:
+    actual = peel(
+        user_message(normalize("one   two\n\n\n\n"), "three   four"),
+    ).render()
+
+    assert actual == [{"role": "user", "content": "one two\n\nthree   four"}]
+
+
+def test_tokens_saved_reported() -> None:
+    chain = peel(user_message(normalize(TABLE), scope(normalize(TABLE), priority=1)))
+
+    chain.render()
+    assert chain.last_render_stats is not None
+    saved = chain.last_render_stats["tokens_saved"]
+    assert saved > 0
+
+    # Only the normalized text that survives peeling counts
+    chain.render(chain.get_required_tokens(sys.maxsize))
+    assert chain.last_render_stats["priority"] == sys.maxsize
+    assert chain.last_render_stats["tokens_saved"] == saved // 2
+
+
+def test_tokens_saved_under_cap() -> None:
+    chain = Chain(
+        [
+            user_message(
+                scope(
+                    normalize(scope("a   b", priority=1), scope(" c   d", priority=5)),
+                    cap=6,
+                )
+            )
+        ],
+        CharacterCounter(),
+    )
+
+    assert chain.render() == [{"role": "user", "content": "c d"}]
+    assert chain.last_render_stats is not None
+    # Saved on " c   d", the text that survives the cap, not on all of the text
+    assert chain.last_render_stats["tokens_saved"] == 3
+
+
+def test_tokens_saved_in_json_array() -> None:
+    chain = Chain([user_message(normalize(json_array(["a    b"])))], CharacterCounter())
+
+    assert chain.render() == [{"role": "user", "content": '["a b"]'}]
+    assert chain.last_render_stats is not None
+    assert chain.last_render_stats["tokens_saved"] == 3
+
+
+def test_normalized_text_fits_smaller_budget() -> None:
+    text = "one" + " " * 50 + "two"
+    chain = peel(user_message(scope(normalize(text), priority=1), "three"))
+
+    assert chain.render(3) == [{"role": "user", "content": "one twothree"}]
+
+
+def test_saved_tokens_cached_by_content() -> None:
+    counter = RecordingCounter()
+    for _ in range(3):
+        Chain([user_message(normalize(TABLE))], token_counter=counter).render()
+
+    assert count_saved_tokens(TABLE, counter) > 0
+    assert sum(TABLE in batch for batch in counter.batches) == 1
+
+
+def test_normalized_texts_bounded_by_characters(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(prompt_peel.normalize, "MAX_CACHED_CHARACTERS", 10)
+    texts = [f"text   {index}\ud800" for index in range(5)]
+
+    assert [normalize_text(text) for text in texts] == [
+        f"text {index}\ud800" for index in range(5)
+    ]
+    assert prompt_peel.normalize._normalized_characters <= 10
+    assert len(prompt_peel.normalize._normalized) == 1
+
+
+def test_saved_tokens_bounded(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(prompt_peel.normalize, "MAX_CACHED_COUNTS", 2)
+    monkeypatch.setattr(prompt_peel.normalize, "_saved_tokens", OrderedDict())
+    counter = CharacterCounter()
+    for text in ("one  two", "three  four", "five  six", "one  two"):
+        assert count_saved_tokens(text, counter) == 1
+
+    assert list(prompt_peel.normalize._saved_tokens) == [
+        ("characters", content_hash("five  six")),
+        ("characters", content_hash("one  two")),
+    ]
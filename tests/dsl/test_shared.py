@@ -0,0 +1,82 @@
+import copy
+import sys
+
+import pytest
+
+from prompt_peel.dsl import (
+    compact_nodes,
+    peel,
+    scope,
+    system_message,
+    top_k,
+    user_message,
+)
+from prompt_peel.node import NonChatNode
+
+"""
+Subtrees are never modified when they are placed under a parent.
+One fragment can therefore be shared between parents and chains with different priorities.
+"""
+
+
+def tool_catalog() -> list[NonChatNode]:
+    return [
+        scope("Tools:"),
+        top_k(
+            scope(" search", priority=30),
+            scope(" browse", priority=20),
+            scope(" email", priority=10),
+            top_k_value=2,
+        ),
+    ]
+
+
+def test_children_are_not_modified() -> None:
+    fragment = tool_catalog()
+    before = copy.deepcopy(fragment)
+
+    system_message(*fragment, priority=5)
+
+    assert fragment == before
+
+
+def test_fragment_shared_between_parents() -> None:
+    fragment = tool_catalog()
+    chain = peel(
+        system_message(*fragment, priority=100),
+        user_message(*fragment, priority=5),
+    )
+
+    # Under the low priority parent, every node is capped at 5
+    assert chain.get_priorities() == {5, 10, 20, 30, 100}
+    assert chain.render(6) == [
+        {"role": "system", "content": "Tools: search browse"},
+        {"role": "user", "content": ""},
+    ]
+
+
+def test_fragment_shared_between_chains() -> None:
+    fragment = tool_catalog()
+    first = peel(system_message(*fragment, priority=100))
+    second = peel(user_message(scope(*fragment, priority=25)))
+
+    assert first.render() == [{"role": "system", "content": "Tools: search browse"}]
+    assert second.render(3) == [{"role": "user", "content": "Tools: search"}]
+    assert second.get_priorities() == {sys.maxsize, 25, 20, 10}
+
+
+def test_nested_default_priorities_inherit_from_ancestor() -> None:
+    chain = peel(
+        user_message(scope(scope(scope("deep"))), scope(" low", priority=1), priority=3)
+    )
+
+    assert chain.get_priorities() == {1, 3}
+    assert chain.render(1) == [{"role": "user", "content": "deep"}]
+
+
+def test_compact_nodes_are_immutable() -> None:
+    with compact_nodes():
+        node = scope("Hello")
+
+    with pytest.raises(AttributeError):
+        node.priority = 1  # type: ignore
@@ -0,0 +1,56 @@
+import pytest
+
+from prompt_peel.dsl import empty, peel, scope, system_message, top_k, user_message
+from prompt_peel.lib import Chain
+
+
+def build_chain() -> Chain:
+    return peel(
+        empty(2),
+        system_message(
+            "1",
+            top_k(scope(" 2", priority=30), scope(" 3", priority=20), top_k_value=1),
+            priority=100,
+        ),
+        user_message(scope("4", priority=10), empty(3, priority=5), priority=50),
+    )
+
+
+def test_token_curve() -> None:
+    assert build_chain().token_curve() == [
+        (5, 2 + 1 + 2 + 1 + 3),
+        (10, 2 + 1 + 2 + 1),
+        (20, 2 + 1 + 2),
+        (30, 2 + 1 + 2),
+        (50, 2 + 1),
+        (100, 2 + 1),
+    ]
+
+
+def test_empty_chain_curve() -> None:
+    assert peel().token_curve() == []
+
+
+@pytest.mark.parametrize("token_space", [3, 4, 5, 6, 9, 1000])
+def test_render_matches_exhaustive_search(token_space: int) -> None:
+    chain = build_chain()
+    expected_priority = next(
+        priority
+        for priority in sorted(chain.get_priorities())
+        if chain.get_required_tokens(priority) <= token_space
+    )
+
+    assert chain.get_optimal_priority(chain.get_priorities(), token_space) == (
+        expected_priority
+    )
+    assert chain.render(token_space) == chain.render_priority(expected_priority)
+
+
+def test_render_uses_curve_to_skip_candidates() -> None:
+    chain = peel(
+        system_message(*[scope(f"{i} ", priority=i) for i in range(100)]),
+    )
+    chain.render(20)
+
+    assert chain.last_render_stats is not None
+    assert chain.last_render_stats["evaluated"] <= 3
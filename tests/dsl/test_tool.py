@@ -0,0 +1,109 @@
+import json
+from typing import Any
+
+import pytest
+from pytest_mock import MockerFixture
+from tests.utils import RecordingCounter
+
+import prompt_peel.lib
+import prompt_peel.tool
+from prompt_peel.dsl import peel, scope, tool, user_message
+from prompt_peel.lib import Chain
+from prompt_peel.tool import count_tool_tokens
+
+PARAMETERS: dict[str, Any] = {
+    "type": "object",
+    "properties": {"query": {"type": "string"}},
+    "required": ["query"],
+}
+
+
+def schemas(counter: RecordingCounter) -> list[str]:
+    return [text for text in counter.counted if text.startswith("{")]
+
+
+def test_tool_schema_counts_against_budget() -> None:
+    search = tool("search", "Search the web", PARAMETERS, priority=1)
+    chain = peel(user_message("one"), search)
+    schema_tokens = count_tool_tokens(search, chain.token_counter)
+
+    assert chain.render(1 + schema_tokens) == [{"role": "user", "content": "one"}]
+    assert chain.render_tools() == [
+        {"name": "search", "description": "Search the web", "parameters": PARAMETERS}
+    ]
+
+    assert chain.render(schema_tokens) == [{"role": "user", "content": "one"}]
+    assert chain.render_tools() == []
+
+
+def test_low_priority_tools_peel_first() -> None:
+    chain = peel(
+        user_message("one", scope(" two", priority=2)),
+        tool("search", "Search the web", PARAMETERS, priority=3),
+        tool("browse", "Open a page", PARAMETERS, priority=1),
+    )
+    search_tokens = count_tool_tokens(
+        tool("search", "Search the web", PARAMETERS), chain.token_counter
+    )
+
+    assert chain.render(2 + search_tokens) == [{"role": "user", "content": "one two"}]
+    assert [tool["name"] for tool in chain.render_tools()] == ["search"]
+
+
+def test_schema_counted_once_across_chains() -> None:
+    counter = RecordingCounter()
+    for _ in range(3):
+        chain = Chain(
+            [user_message("one"), tool("search", "Search the web", PARAMETERS)],
+            token_counter=counter,
+        )
+        chain.render(1_000)
+
+    assert len(schemas(counter)) == 1
+
+
+def test_schema_looked_up_once_per_chain(mocker: MockerFixture) -> None:
+    lookups = mocker.spy(prompt_peel.lib, "count_tool_tokens")
+    chain = peel(
+        user_message("one", scope(" two", priority=1)),
+        tool("search", "Search the web", PARAMETERS, priority=2),
+    )
+
+    for token_space in (5, 50, 1_000):
+        chain.render(token_space)
+
+    assert lookups.call_count == 1
+
+
+def test_schema_table_is_bounded(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(prompt_peel.tool, "MAX_CACHED_SCHEMAS", 2)
+    counter = RecordingCounter()
+    for name in ("one", "two", "three", "one"):
+        count_tool_tokens(tool(name, "A tool", PARAMETERS), counter)
+
+    assert len(prompt_peel.tool._schema_tokens) == 2
+    assert len(schemas(counter)) == 4
+
+
+def test_tools_in_payload() -> None:
+    chain = peel(
+        user_message("one"),
+        tool("search", "Search the web", PARAMETERS),
+    )
+
+    openai = json.loads(chain.render_payload(format="openai"))
+    anthropic = json.loads(chain.render_payload(format="anthropic"))
+
+    assert openai["tools"] == [
+        {
+            "type": "function",
+            "function": {
+                "name": "search",
+                "description": "Search the web",
+                "parameters": PARAMETERS,
+            },
+        }
+    ]
+    assert anthropic["tools"] == [
+        {"name": "search", "description": "Search the web", "input_schema": PARAMETERS}
+    ]
@@ -0,0 +1,63 @@
+import pytest
+
+from prompt_peel.dsl import peel, top_k_relevant, user_message
+from prompt_peel.exceptions import InvalidPromptError
+from prompt_peel.relevance import select_relevant
+
+np = pytest.importorskip("numpy")
+
+EMBEDDINGS = np.array([[1.0, 0.0], [0.0, 1.0], [0.6, 0.8], [0.8, 0.6]])
+TEXTS = [" one", " two", " three", " four"]
+
+
+def test_select_relevant() -> None:
+    indices, scores = select_relevant(np.array([1.0, 0.0]), EMBEDDINGS, 3)
+
+    assert indices.tolist() == [0, 3, 2]
+    assert scores.tolist() == [1.0, 0.8, 0.6]
+
+
+def test_select_more_than_available() -> None:
+    indices, _ = select_relevant(np.array([0.0, 1.0]), EMBEDDINGS, 10)
+
+    assert indices.tolist() == [1, 2, 3, 0]
+
+
+def test_most_relevant_rendered_first() -> None:
+    actual = peel(
+        user_message(
+            top_k_relevant(np.array([1.0, 0.0]), EMBEDDINGS, TEXTS, top_k_value=2),
+        ),
+    ).render()
+
+    assert actual == [{"role": "user", "content": "one four"}]
+
+
+def test_least_relevant_peeled_first() -> None:
+    actual = peel(
+        user_message(
+            top_k_relevant(
+                np.array([1.0, 0.0]), EMBEDDINGS, TEXTS, top_k_value=3, priority=10
+            ),
+        ),
+    ).render(2)
+
+    assert actual == [{"role": "user", "content": "one four"}]
+
+
+def test_many_candidates() -> None:
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((100_000, 8))
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    texts = [f" {index}" for index in range(len(embeddings))]
+    query = embeddings[42]
+
+    node = top_k_relevant(query, embeddings, texts, top_k_value=5)
+
+    assert len(node["children"]) == 5
+    assert node["children"][0]["children"] == [" 42"]
+
+
+def test_mismatched_texts() -> None:
+    with pytest.raises(InvalidPromptError):
+        top_k_relevant(np.array([1.0, 0.0]), EMBEDDINGS, TEXTS[:2], top_k_value=1)
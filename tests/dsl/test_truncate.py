@@ -0,0 +1,107 @@
+from typing import Callable, Literal
+
+import pytest
+from tests.utils import ByteCounter, WordCounter, parameterized_messages
+
+from prompt_peel.dsl import chunked, peel, scope, truncate, user_message
+from prompt_peel.exceptions import InvalidPromptError
+from prompt_peel.lib import Chain
+from prompt_peel.message import Role
+from prompt_peel.node import ChatNode, NonChatNode
+from prompt_peel.token_counter import Cl100kBaseTokenCounter
+
+
+@parameterized_messages
+def test_full_text_when_space_allows(
+    message_function: Callable[..., ChatNode], expected_role: Role
+) -> None:
+    actual = peel(
+        message_function("Numbers: ", truncate("one two three four five")),
+    ).render()
+
+    assert actual == [
+        {"role": expected_role, "content": "Numbers: one two three four five"}
+    ]
+
+
+@parameterized_messages
+def test_keep_head(
+    message_function: Callable[..., ChatNode], expected_role: Role
+) -> None:
+    actual = peel(
+        message_function(truncate("one two three four five")),
+    ).render(2)
+
+    assert actual == [{"role": expected_role, "content": "one two"}]
+
+
+@parameterized_messages
+def test_keep_tail(
+    message_function: Callable[..., ChatNode], expected_role: Role
+) -> None:
+    actual = peel(
+        message_function(truncate("one two three four five", keep="tail")),
+    ).render(2)
+
+    assert actual == [{"role": expected_role, "content": "four five"}]
+
+
+def test_higher_priority_truncate_filled_first() -> None:
+    actual = peel(
+        user_message(
+            truncate("one two three", priority=1),
+            truncate(" four five six", priority=2),
+            priority=2,
+        ),
+    ).render(4)
+
+    assert actual == [{"role": "user", "content": "one four five six"}]
+
+
+def test_truncate_below_cutoff_is_dropped() -> None:
+    actual = peel(
+        user_message(
+            scope("hello", priority=10),
+            scope(" there big", priority=1),
+            truncate(" one two", priority=1),
+            priority=10,
+        ),
+    ).render(2)
+
+    assert actual == [{"role": "user", "content": "hello"}]
+
+
+@pytest.mark.parametrize(
+    "token_space, keep, expected",
+    [
+        (3, "head", ""),
+        (7, "head", "😀"),
+        (8, "head", "😀😀"),
+        (6, "tail", "end"),
+        (10, "tail", "😀 end"),
+    ],
+)
+def test_split_characters_are_dropped(
+    token_space: int, keep: Literal["head", "tail"], expected: str
+) -> None:
+    chain = Chain(
+        [user_message(truncate("😀😀😀 end", keep=keep))], token_counter=ByteCounter()
+    )
+
+    assert chain.render(token_space) == [{"role": "user", "content": expected}]
+
+
+def test_invalid_keep() -> None:
+    with pytest.raises(InvalidPromptError):
+        truncate("text", keep="middle")  # type: ignore
+
+
+@pytest.mark.parametrize(
+    "node", [truncate("one two three"), chunked("one two three", chunk_tokens=1)]
+)
+def test_counter_without_tokenization(node: NonChatNode) -> None:
+    with pytest.raises(InvalidPromptError):
+        Chain([user_message(scope(node))], WordCounter())
+
+    assert not WordCounter().can_tokenize
+    assert Cl100kBaseTokenCounter().can_tokenize
@@ -0,0 +1,125 @@
+import json
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from prompt_peel.cli import main
+
+
+def chain(request_id: int, **fields: object) -> str:
+    return json.dumps(
+        {
+            "id": request_id,
+            "elements": [
+                {
+                    "type": "chat",
+                    "role": "user",
+                    "children": [
+                        "one",
+                        {"type": "scope", "priority": 1, "children": [" two"]},
+                    ],
+                }
+            ],
+            **fields,
+        }
+    )
+
+
+def run(
+    tmp_path: Path, lines: list[str], *args: str
+) -> tuple[int, list[dict[str, Any]]]:
+    input, output = tmp_path / "chains.jsonl", tmp_path / "rendered.jsonl"
+    input.write_text("\n".join(lines) + "\n")
+    code = main([str(input), "-o", str(output), *args])
+    return code, [json.loads(line) for line in output.read_text().splitlines()]
+
+
+@pytest.mark.parametrize("workers", ["1", "2"])
+def test_renders_in_input_order(tmp_path: Path, workers: str) -> None:
+    code, results = run(
+        tmp_path,
+        [chain(index) for index in range(10)],
+        "--workers",
+        workers,
+        "--batch-size",
+        "3",
+    )
+
+    assert code == 0
+    assert [result["id"] for result in results] == list(range(10))
+    assert results[0]["messages"] == [{"role": "user", "content": "one two"}]
+
+
+def test_token_space(tmp_path: Path) -> None:
+    _, results = run(
+        tmp_path,
+        [chain(0), chain(1, token_space=2)],
+        "--token-space",
+        "1",
+        "--workers",
+        "1",
+    )
+
+    assert results[0]["messages"] == [{"role": "user", "content": "one"}]
+    assert results[1]["messages"] == [{"role": "user", "content": "one two"}]
+
+
+def test_errors_are_reported_per_line(tmp_path: Path) -> None:
+    code, results = run(
+        tmp_path,
+        [
+            chain(0),
+            "not json",
+            json.dumps({"id": 2, "elements": [{"type": "what"}]}),
+            chain(3),
+        ],
+        "--workers",
+        "1",
+    )
+
+    assert code == 1
+    assert [result["id"] for result in results] == [0, None, 2, 3]
+    assert "error" in results[1] and "error" in results[2]
+    assert "messages" in results[3]
+
+
+@pytest.mark.parametrize("workers", ["1", "2"])
+def test_unreadable_and_malformed_chains(tmp_path: Path, workers: str) -> None:
+    code, results = run(
+        tmp_path,
+        [
+            json.dumps(
+                {
+                    "id": 0,
+                    "elements": [
+                        {
+                            "type": "chat",
+                            "role": "user",
+                            "children": [{"type": "file", "path": "/nonexistent"}],
+                        }
+                    ],
+                }
+            ),
+            json.dumps(
+                {
+                    "id": 1,
+                    "elements": [{"type": "history", "turns": [{"role": "user"}]}],
+                }
+            ),
+            chain(2),
+        ],
+        "--workers",
+        workers,
+    )
+
+    assert code == 1
+    assert results[0]["error"].startswith("FileNotFoundError")
+    assert results[1]["error"].startswith("InvalidPromptError")
+    assert "messages" in results[2]
+
+
+def test_prints_throughput(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    run(tmp_path, [chain(0), chain(1)], "--workers", "1")
+
+    assert "Rendered 2 chains (0 failed)" in capsys.readouterr().err
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import os
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+from pytest_mock import MockerFixture
+
+import prompt_peel.daemon
+from prompt_peel.daemon import RenderClient, RenderServer, percentile
+from prompt_peel.dsl import peel, scope, system_message, tool, user_message
+from prompt_peel.exceptions import PriorityError
+
+
+def start(server: RenderServer) -> Iterator[RenderServer]:
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(server.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+@pytest.fixture
+def server(tmp_path: Path) -> Iterator[RenderServer]:
+    yield from start(RenderServer(str(tmp_path / "peel.sock"), workers=1))
+
+
+@pytest.fixture
+def client(server: RenderServer) -> Iterator[RenderClient]:
+    client = RenderClient(server.path)
+    yield client
+    client.close()
+
+
+def elements() -> list:  # type: ignore
+    return [
+        system_message("You are a helpful assistant"),
+        user_message("one", scope(" two", priority=1), priority=10),
+        tool("search", "Search the web", {"type": "object"}, priority=1),
+    ]
+
+
+def test_renders_like_chain(client: RenderClient) -> None:
+    remote = client.chain(*elements())
+    local = peel(*elements())
+
+    assert remote.render() == local.render()
+    assert remote.render_tools() == local.render_tools()
+    assert remote.last_render_stats["priority"] == 1  # type: ignore
+
+
+def test_token_space(client: RenderClient) -> None:
+    remote = client.chain(*elements())
+    local = peel(*elements())
+    token_space = local.get_required_tokens(10)
+
+    assert remote.render(token_space) == local.render(token_space)
+    assert remote.render(token_space)[1]["content"] == "one"
+    assert remote.render_tools() == []
+
+
+def test_errors_keep_their_type(client: RenderClient) -> None:
+    with pytest.raises(PriorityError):
+        client.chain(*elements()).render(1)
+
+
+def test_concurrent_requests(client: RenderClient) -> None:
+    remote = client.chain(*elements())
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda _: remote.render(), range(32)))
+
+    assert all(result == results[0] for result in results)
+
+
+def test_stats(client: RenderClient) -> None:
+    remote = client.chain(*elements())
+    remote.render()
+    with pytest.raises(PriorityError):
+        remote.render(1)
+
+    stats = client.stats()
+    assert stats["requests"] == 2
+    assert stats["failed"] == 1
+    assert stats["in_flight"] == 0
+    assert stats["latency_ms"]["p99"] >= stats["latency_ms"]["p50"] > 0
+
+
+def test_tcp() -> None:
+    for server in start(RenderServer(port=0, workers=1)):
+        host, port = server.address
+        client = RenderClient(host=host, port=port)
+
+        assert client.chain(*elements()).render() == peel(*elements()).render()
+        client.close()
+
+
+def test_worker_processes(tmp_path: Path) -> None:
+    for server in start(RenderServer(str(tmp_path / "peel.sock"), workers=2)):
+        client = RenderClient(server.path)
+
+        assert client.chain(*elements()).render() == peel(*elements()).render()
+        client.close()
+
+
+def test_unreadable_file_is_an_error_line(client: RenderClient) -> None:
+    response = client.request(
+        json.dumps(
+            {
+                "id": 7,
+                "elements": [
+                    {
+                        "type": "chat",
+                        "role": "user",
+                        "children": [{"type": "file", "path": "/nonexistent"}],
+                    }
+                ],
+            }
+        )
+    )
+
+    assert response["id"] == 7
+    assert response["error"].startswith("FileNotFoundError")
+    assert client.stats()["failed"] == 1
+
+
+def test_worker_failure_is_an_error_line(
+    client: RenderClient, mocker: MockerFixture
+) -> None:
+    mocker.patch.object(
+        prompt_peel.daemon, "render_line", side_effect=RuntimeError("worker died")
+    )
+
+    response = client.request(json.dumps({"id": 3, "elements": []}))
+
+    assert response == {"id": 3, "error": "RuntimeError: worker died"}
+    assert client.stats()["failed"] == 1
+
+
+def test_socket_only_open_to_owner(server: RenderServer) -> None:
+    assert stat.S_IMODE(os.stat(server.path).st_mode) & 0o077 == 0  # type: ignore
+
+
+def test_umask_restored(tmp_path: Path) -> None:
+    umask = os.umask(0o022)
+    for _ in start(RenderServer(str(tmp_path / "peel.sock"), workers=1)):
+        assert os.umask(umask) == 0o022
+
+
+def test_tcp_rejects_files(tmp_path: Path) -> None:
+    path = tmp_path / "secret.txt"
+    path.write_text("secret")
+    request = json.dumps(
+        {
+            "elements": [
+                {
+                    "type": "chat",
+                    "role": "user",
+                    "children": [{"type": "file", "path": str(path)}],
+                }
+            ]
+        }
+    )
+    for server in start(RenderServer(port=0, workers=1)):
+        host, port = server.address
+        client = RenderClient(host=host, port=port)
+
+        assert client.request(request)["error"].startswith("InvalidPromptError")
+        client.close()
+
+    for server in start(RenderServer(str(tmp_path / "peel.sock"), workers=1)):
+        client = RenderClient(server.path)
+
+        assert client.request(request)["messages"] == [
+            {"role": "user", "content": "secret"}
+        ]
+        client.close()
+
+
+def test_only_listens_on_loopback() -> None:
+    with pytest.raises(ValueError):
+        RenderServer(host="0.0.0.0")
+    RenderServer(host="::1")
+    RenderServer(host="localhost")
+
+
+def test_percentile() -> None:
+    ordered = [float(value) for value in range(1, 101)]
+
+    assert percentile(ordered, 0.5) == 50
+    assert percentile(ordered, 0.99) == 99
+    assert percentile([], 0.5) == 0
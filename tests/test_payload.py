@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from prompt_peel.dsl import assistant_message, peel, scope, system_message, user_message
+from prompt_peel.exceptions import InvalidPromptError
+from prompt_peel.payload import encode_payload
+
+
+def dumps(payload: object) -> bytes:
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def test_openai_payload() -> None:
+    chain = peel(
+        system_message("Be brief"),
+        user_message('Quote "this"\n\ttab \\ émoji 🎉', scope(" extra", priority=1)),
+    )
+
+    actual = chain.render_payload(format="openai")
+
+    assert actual == dumps({"messages": chain.render()})
+    assert (
+        json.loads(actual)["messages"][1]["content"]
+        == 'Quote "this"\n\ttab \\ émoji 🎉 extra'
+    )
+    assert "émoji 🎉".encode() in actual
+
+
+def test_payload_is_peeled() -> None:
+    chain = peel(user_message("one", scope(" two", priority=1)))
+
+    assert chain.render_payload(1) == dumps(
+        {"messages": [{"role": "user", "content": "one"}]}
+    )
+
+
+def test_anthropic_payload_moves_system_messages() -> None:
+    chain = peel(
+        system_message("Be brief"),
+        user_message("one"),
+        system_message("Be kind"),
+        assistant_message("two"),
+    )
+
+    assert chain.render_payload(format="anthropic") == dumps(
+        {
+            "system": "Be brief\n\nBe kind",
+            "messages": [
+                {"role": "user", "content": "one"},
+                {"role": "assistant", "content": "two"},
+            ],
+        }
+    )
+
+
+def test_anthropic_payload_without_system() -> None:
+    assert encode_payload([{"role": "user", "content": "one"}], "anthropic") == dumps(
+        {"messages": [{"role": "user", "content": "one"}]}
+    )
+
+
+def test_unknown_format() -> None:
+    with pytest.raises(InvalidPromptError):
+        encode_payload([], "gemini")  # type: ignore
@@ -0,0 +1,132 @@
+import pytest
+
+from prompt_peel.dsl import (
+    chunked,
+    compact_nodes,
+    empty,
+    history,
+    lazy,
+    min_k,
+    scope,
+    system_message,
+    tool,
+    top_k,
+    truncate,
+    user_message,
+)
+from prompt_peel.exceptions import InvalidPromptError, UnknownNodeError
+from prompt_peel.serialize import (
+    chain_from_json,
+    chain_to_json,
+    node_from_json,
+    node_to_json,
+)
+
+
+def test_chain_from_json() -> None:
+    actual = chain_from_json(
+        [
+            {"type": "chat", "role": "system", "children": ["Hello"]},
+            {
+                "type": "chat",
+                "role": "user",
+                "priority": 10,
+                "children": [
+                    {"type": "scope", "priority": 5, "children": ["a"]},
+                    {"type": "top_k", "top_k": 1, "children": ["b", "c"]},
+                    {"type": "min_k", "min_k": 1, "children": ["d"]},
+                    {"type": "truncate", "text": "e", "keep": "tail"},
+                    {"type": "chunked", "text": "f", "chunk_tokens": 2},
+                ],
+            },
+            {"type": "empty", "tokens": 3},
+            {"type": "history", "turns": [{"role": "user", "content": "g"}]},
+            {
+                "type": "tool",
+                "name": "h",
+                "priority": 1,
+                "parameters": {"type": "object"},
+            },
+        ]
+    )
+
+    assert actual == [
+        system_message("Hello"),
+        user_message(
+            scope("a", priority=5),
+            top_k("b", "c", top_k_value=1),
+            min_k("d", min_k_value=1),
+            truncate("e", keep="tail"),
+            chunked("f", chunk_tokens=2),
+            priority=10,
+        ),
+        empty(3),
+        history({"role": "user", "content": "g"}),
+        tool("h", "", {"type": "object"}, priority=1),
+    ]
+
+
+@pytest.mark.parametrize(
+    "data, error",
+    [
+        ({"type": "scope"}, None),
+        ({"type": "unknown"}, UnknownNodeError),
+        ({"type": "top_k", "children": []}, InvalidPromptError),
+        ({"type": "chat", "role": "tool", "children": []}, InvalidPromptError),
+        ({"type": "lazy", "tokens": 1}, InvalidPromptError),
+        (1, InvalidPromptError),
+    ],
+)
+def test_node_from_json_errors(data: object, error: type[Exception] | None) -> None:
+    if error is None:
+        assert node_from_json(data) == scope()
+        return
+
+    with pytest.raises(error):
+        node_from_json(data)
+
+
+def test_top_level_elements_must_be_messages() -> None:
+    with pytest.raises(InvalidPromptError):
+        chain_from_json([{"type": "scope", "children": ["a"]}])
+
+
+def chain_elements() -> list:  # type: ignore
+    return [
+        system_message("Hello", cap=0.5),
+        user_message(
+            scope("a", priority=5, cap=3),
+            top_k("b", "c", top_k_value=1),
+            min_k("d", min_k_value=1),
+            truncate("e", keep="tail"),
+            chunked("f", chunk_tokens=2, top_k_value=1),
+            priority=10,
+        ),
+        empty(3),
+        history({"role": "user", "content": "g"}),
+        tool("h", "", {"type": "object"}, priority=1),
+    ]
+
+
+def test_chain_to_json_round_trip() -> None:
+    encoded = chain_to_json(chain_elements())
+
+    assert encoded[0] == {
+        "type": "chat",
+        "role": "system",
+        "cap": 0.5,
+        "children": ["Hello"],
+    }
+    assert chain_from_json(encoded) == chain_elements()
+
+
+def test_compact_chain_to_json() -> None:
+    with compact_nodes():
+        compact = chain_elements()
+
+    assert chain_to_json(compact) == chain_to_json(chain_elements())
+
+
+def test_lazy_nodes_cannot_be_encoded() -> None:
+    with pytest.raises(InvalidPromptError):
+        node_to_json(scope(lazy(lambda: "a", tokens=1)))
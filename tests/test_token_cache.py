@@ -0,0 +1,93 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from tests.utils import WordCounter
+
+from prompt_peel.token_cache import CachedTokenCounter, SqliteTokenCache, content_hash
+
+
+def long_text(words: int) -> str:
+    return " ".join(["word"] * words)
+
+
+def test_counts_match_wrapped_counter(tmp_path: Path) -> None:
+    counter = CachedTokenCounter(
+        WordCounter(), SqliteTokenCache(tmp_path / "tokens.db"), min_chars=0
+    )
+    texts = [long_text(3), long_text(5), long_text(3), ""]
+
+    assert counter.count_batch(texts) == [3, 5, 3, 0]
+    assert counter.count_batch(texts) == [3, 5, 3, 0]
+    assert counter.count(long_text(5)) == 5
+
+
+def test_counts_survive_restart(tmp_path: Path) -> None:
+    texts = [long_text(100), long_text(200)]
+    CachedTokenCounter(
+        WordCounter(), SqliteTokenCache(tmp_path / "tokens.db")
+    ).count_batch(texts)
+
+    restarted = WordCounter()
+    counter = CachedTokenCounter(restarted, SqliteTokenCache(tmp_path / "tokens.db"))
+
+    assert counter.count_batch(texts) == [100, 200]
+    assert restarted.counted == []
+
+
+def test_counts_keyed_by_counter_name(tmp_path: Path) -> None:
+    class OtherCounter(WordCounter):
+        @property
+        def name(self) -> str:
+            return "double-word-counter"
+
+        def count(self, text: str) -> int:
+            return 2 * super().count(text)
+
+    cache = SqliteTokenCache(tmp_path / "tokens.db")
+    text = long_text(100)
+
+    assert CachedTokenCounter(WordCounter(), cache).count(text) == 100
+    assert CachedTokenCounter(OtherCounter(), cache).count(text) == 200
+
+
+def test_short_texts_are_not_cached(tmp_path: Path) -> None:
+    inner = WordCounter()
+    counter = CachedTokenCounter(inner, SqliteTokenCache(tmp_path / "tokens.db"))
+
+    counter.count("short")
+    counter.count("short")
+
+    assert inner.counted == ["short", "short"]
+
+
+def test_oldest_entries_evicted(tmp_path: Path) -> None:
+    cache = SqliteTokenCache(tmp_path / "tokens.db", max_entries=2)
+    for tokens in range(3):
+        cache.put_many("words", {content_hash(str(tokens)): tokens})
+
+    hashes = [content_hash(str(tokens)) for tokens in range(3)]
+    assert cache.get_many("words", hashes) == {hashes[1]: 1, hashes[2]: 2}
+
+
+def test_concurrent_writers(tmp_path: Path) -> None:
+    texts = [long_text(words) for words in range(100, 200)]
+
+    def count(offset: int) -> list[int]:
+        # Each worker opens the database separately, as a separate process would
+        cache = SqliteTokenCache(tmp_path / "tokens.db")
+        return CachedTokenCounter(WordCounter(), cache).count_batch(
+            texts[offset:] + texts[:offset]
+        )
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(count, range(0, 80, 10)))
+
+    for offset, result in zip(range(0, 80, 10), results):
+        assert result == [len(text.split()) for text in texts[offset:] + texts[:offset]]
+
+
+def test_unusable_cache_falls_back_to_counting(tmp_path: Path) -> None:
+    cache = SqliteTokenCache(tmp_path / "missing" / "tokens.db")
+    counter = CachedTokenCounter(WordCounter(), cache)
+
+    assert counter.count(long_text(300)) == 300
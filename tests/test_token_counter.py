@@ -1,7 +1,7 @@
 import pytest
 import tiktoken
 
-from prompt_peel.token_counter import Cl100kBaseTokenCounter
+from prompt_peel.token_counter import Cl100kBaseTokenCounter, TokenCounter, split_text
 
 encoding = tiktoken.get_encoding("cl100k_base")
 
@@ -24,3 +24,42 @@ Oh well. I guess it's long enough now""",
 )
 def test_count(text: str, expected: int) -> None:
     assert Cl100kBaseTokenCounter().count(text) == expected
+
+
+def test_count_batch_matches_count() -> None:
+    counter = Cl100kBaseTokenCounter()
+    texts = ["", "Hello my name is asim", "<|endoftext|> is just text in a prompt"]
+    assert counter.count_batch(texts) == [counter.count(text) for text in texts]
+
+
+def test_parallel_count_batch_is_exact() -> None:
+    counter = Cl100kBaseTokenCounter(max_workers=4)
+    document = "\n".join(
+        f"Line {i}: retrieved context\n\n    indented {i}!\nAnother paragraph"
+        for i in range(5_000)
+    )
+    texts = [document, "Short message", document[:50_000]]
+    assert sum(map(len, texts)) > counter.parallel_threshold
+
+    assert counter.count_batch(texts) == [
+        len(encoding.encode_ordinary(text)) for text in texts
+    ]
+
+
+@pytest.mark.parametrize("piece_size", [1, 10, 1_000])
+def test_split_text_round_trips(piece_size: int) -> None:
+    text = "First line\nSecond line\n\n  third\n4th\nfifth"
+    pieces = list(split_text(text, piece_size))
+
+    assert "".join(pieces) == text
+    assert all(piece.startswith(("First", "Second", "fifth")) for piece in pieces)
+
+
+def test_counters_must_name_their_tokenizer() -> None:
+    class UnnamedCounter(TokenCounter):
+        def count(self, text: str) -> int:
+            return len(text)
+
+    with pytest.raises(TypeError):
+        UnnamedCounter()  # type: ignore
+    assert Cl100kBaseTokenCounter().name == "cl100k_base"
@@ -1,9 +1,13 @@
+from itertools import count
 from typing import Any, Callable, Tuple
 
 import pytest
 
 from prompt_peel.dsl import assistant_message, system_message, user_message
 from prompt_peel.message import Role
+from prompt_peel.token_counter import Cl100kBaseTokenCounter, TokenCounter
+
+_recording_counters = count()
 
 
 def message_dsl_and_role() -> list[Tuple[Callable[..., Any], Role]]:
@@ -23,3 +27,88 @@ def parameterized_messages(func: Callable[..., Any]) -> Callable[..., Any]:
     return pytest.mark.parametrize(
         "message_function, expected_role", message_dsl_and_role()
     )(func)
+
+
+class WordCounter(TokenCounter):
+    """One token per word. Records every text it counts"""
+
+    def __init__(self) -> None:
+        self.counted: list[str] = []
+
+    @property
+    def name(self) -> str:
+        return "words"
+
+    def count(self, text: str) -> int:
+        self.counted.append(text)
+        return len(text.split())
+
+
+class CharacterCounter(TokenCounter):
+    """One token per character. Records every text it counts"""
+
+    def __init__(self) -> None:
+        self.counted: list[str] = []
+
+    @property
+    def name(self) -> str:
+        return "characters"
+
+    def count(self, text: str) -> int:
+        self.counted.append(text)
+        return len(text)
+
+
+class ByteCounter(TokenCounter):
+    """One token per UTF-8 byte, so token slices can split a character"""
+
+    @property
+    def name(self) -> str:
+        return "bytes"
+
+    def count(self, text: str) -> int:
+        return len(text.encode())
+
+    def tokenize(self, text: str) -> list[int]:
+        return list(text.encode())
+
+    def decode(self, tokens: list[int]) -> str:
+        return bytes(tokens).decode(errors="replace")
+
+    def decode_bytes(self, tokens: list[int]) -> bytes:
+        return bytes(tokens)
+
+
+class RecordingCounter(Cl100kBaseTokenCounter):
+    """
+    Counts like cl100k and records what it counts, tokenizes and decodes.
+    Every instance has its own name, so counts cached by name in other tests never hide its calls
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._name = f"recording-{next(_recording_counters)}"
+        self.counted: list[str] = []
+        self.batches: list[list[str]] = []
+        self.tokenized: list[str] = []
+        self.decoded = 0
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    def count(self, text: str) -> int:
+        self.counted.append(text)
+        return super().count(text)
+
+    def count_batch(self, texts: list[str]) -> list[int]:
+        self.batches.append(texts)
+        return super().count_batch(texts)
+
+    def tokenize(self, text: str) -> list[int]:
+        self.tokenized.append(text)
+        return super().tokenize(text)
+
+    def decode_bytes(self, tokens: list[int]) -> bytes:
+        self.decoded += 1
+        return super().decode_bytes(tokens)